@@ -0,0 +1,282 @@
+"""
+Benchmarks of the bot's hot paths with regression tracking.
+Results are saved as json and compared with baseline results:
+the command fails if any benchmark became slower than baseline by more than threshold.
+
+Usage:
+    python -m benchmarks.hot_paths --save-baseline
+    python -m benchmarks.hot_paths --threshold 0.2
+    python -m benchmarks.hot_paths --only sort_hotels,calendar
+"""
+
+from datetime import date, datetime, timedelta
+from statistics import median
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Dict, Any, Callable, List, Optional
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def prepare_environment(data_dir: str) -> None:
+    """
+    Points user states and history DBs to temporary directory.
+    Must be called before any import of bot modules.
+
+    :param data_dir: directory for DBs.
+    :type data_dir: str
+    :return: None
+    """
+
+    import bot_settings
+
+    bot_settings.STATE_BACKEND = f"sqlite:{os.path.join(data_dir, 'user_states.sqlite')}"
+    os.makedirs(os.path.join(data_dir, "db"), exist_ok=True)
+    os.chdir(data_dir)
+
+
+def hotels_payload(hotels: int = 25) -> List[Dict[str, Any]]:
+    """
+    Creates realistic list of hotels as in properties/list response (see loadtest.fake_hotels_api).
+
+    :param hotels: number of hotels.
+    :type hotels: int
+    :return: list of hotels.
+    :rtype: List[Dict[str, Any]]
+    """
+
+    from loadtest.fake_hotels_api import FakeHotelsServer
+
+    generator = FakeHotelsServer(hotels=hotels)
+    generator.server_close()
+    response = generator.generate_hotels({"destinationId": "1506246", "checkIn": "2026-11-01", "pageSize": "25"})
+    return response["data"]["body"]["searchResults"]["results"]
+
+
+def filled_user(user_id: int = 1):
+    """
+    Creates user which has filled the main message and two rooms (as before search).
+
+    :param user_id: id of user.
+    :type user_id: int
+    :return: UserRequest instance.
+    """
+
+    from src.base import UserRequest, ScenarioKeyboards
+    from src.bot_text import main_message_text_dict
+
+    user = UserRequest(user_id)
+    user.command = "/bestdeal"
+    user.destination_id, user.location_name = "1506246", "Москва, Россия"
+    user.hotel_count = "5"
+    user.check_in = date.today() + timedelta(days=10)
+    user.check_out = user.check_in + timedelta(days=3)
+    user.total_room, user.adults = 2, [2, 1]
+    user.children = {"children1": [5, 12], "children2": []}
+    user.min_price, user.max_price, user.distance = 50, 300, 5
+    user.memory["location"] = {
+        "text": main_message_text_dict["location"].format(user.location_name),
+        "markup": ScenarioKeyboards.generate_set_location_kb({user.location_name: user.destination_id,
+                                                              "Москва Центр": "1", "Москва Аэропорт": "2"})
+    }
+    user.memory["hotel_count"] = {"text": main_message_text_dict["hotel_count"].format(user.hotel_count),
+                                  "markup": ScenarioKeyboards.num_of_hotels()}
+    for stage in ("check_in", "check_out"):
+        user.memory["dates"][stage] = {"text": main_message_text_dict["dates"][stage].format(getattr(user, stage)),
+                                       "last_callback": f"cbcal_1_s_d_{getattr(user, stage):%Y_%m_%d}"}
+    for room, adults in enumerate(user.adults):
+        user.memory["rooms"][room] = {"adults": {"text": main_message_text_dict["adults"].format(adults),
+                                                 "markup": ScenarioKeyboards.generate_adults_keyboard(room)}}
+    user.memory["rooms"][0]["children"] = {"text": main_message_text_dict["children"].format(2)}
+    return user
+
+
+def create_benchmarks() -> Dict[str, Callable[[], Any]]:
+    """
+    Prepares data and creates benchmarks. Every benchmark is a function making one operation.
+
+    :return: benchmarks by name.
+    :rtype: Dict[str, Callable[[], Any]]
+    """
+
+    from src.hotels_api import sort_hotels, format_hotel_info
+    from src.base import ScenarioKeyboards
+    from src.scenario_models import generate_main_message_text, build_calendar, build_calendar_callback
+    from db.userstates_db import update_user_state, get_user_state_from_db
+    from db.history_db import push_to_db, get_from_db, prepare_message_text, get_session, History
+
+    hotels = hotels_payload()
+    user = filled_user()
+
+    for i in range(30):
+        push_to_db(telegram_id=user.user_id, date=datetime.now(), command=user.command,
+                   location=user.location_name,
+                   hotel=[f"{hotel['id']}***{hotel['name']}" for hotel in hotels[i % 20:i % 20 + 5]])
+
+    history_item = get_session().query(History).filter(History.telegram_id == user.user_id).first()
+
+    def state_round_trip() -> None:
+        update_user_state(user)
+        get_user_state_from_db(user.user_id)
+
+    def calendar_callback() -> None:
+        build_calendar_callback(call_data=f"cbcal_1_g_m_{user.check_in:%Y_%m_%d}", user=user, _id=1)
+
+    return {
+        "sort_hotels.lowprice": lambda: sort_hotels(command="/lowprice", hotels=hotels),
+        "sort_hotels.bestdeal": lambda: sort_hotels(command="/bestdeal", hotels=hotels, distance=5),
+        "format_hotel_info": lambda: [format_hotel_info(hotel=hotel, timedelta=3) for hotel in hotels[:10]],
+        "user_state.round_trip": state_round_trip,
+        "generate_main_message_text": lambda: generate_main_message_text(user_memory=user.memory),
+        "generate_main_message_text.rooms": lambda: generate_main_message_text(user_memory=user.memory["rooms"],
+                                                                               without_rooms=False),
+        "keyboards.adults": lambda: ScenarioKeyboards.generate_adults_keyboard(cur_room=1),
+        "keyboards.children": lambda: ScenarioKeyboards.generate_keyboard_for_children_step(usr=user, room=0),
+        "keyboards.edit_prev_data": lambda: ScenarioKeyboards.generate_edit_prev_data_kb(user),
+        "keyboards.photos": lambda: ScenarioKeyboards.is_photo(need=True),
+        "calendar.build": lambda: build_calendar(user=user, _id=1),
+        "calendar.callback": calendar_callback,
+        "history.get_from_db": lambda: get_from_db(user.user_id),
+        "history.prepare_message_text": lambda: prepare_message_text(history_item)
+    }
+
+
+def measure(func: Callable[[], Any], repeats: int, min_time: float) -> float:
+    """
+    Measures time of one call: runs the function at least min_time seconds in every repeat
+    and takes median of repeats.
+
+    :param func: benchmark.
+    :type func: Callable[[], Any]
+    :param repeats: number of repeats.
+    :type repeats: int
+    :param min_time: min duration of repeat in seconds.
+    :type min_time: float
+    :return: time of one call in microseconds.
+    :rtype: float
+    """
+
+    func()
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        if perf_counter() - start >= min_time / 10:
+            break
+        number *= 2
+    times = []
+    for _ in range(repeats):
+        calls, start = 0, perf_counter()
+        while perf_counter() - start < min_time:
+            for _ in range(number):
+                func()
+            calls += number
+        times.append((perf_counter() - start) / calls)
+    return median(times) * 10 ** 6
+
+
+def run(only: Optional[List[str]] = None, repeats: int = 5, min_time: float = 0.2) -> Dict[str, Any]:
+    """
+    Runs benchmarks.
+
+    :param only: names (or prefixes of names) of benchmarks to run. All benchmarks are run if it isn't passed.
+    :type only: Optional[List[str]]
+    :param repeats: number of repeats of every benchmark.
+    :type repeats: int
+    :param min_time: min duration of repeat in seconds.
+    :type min_time: float
+    :return: results with environment info.
+    :rtype: Dict[str, Any]
+    """
+
+    cwd = os.getcwd()
+    data_dir = mkdtemp(prefix="hotels_bot_bench_")
+    try:
+        prepare_environment(data_dir)
+        results = dict()
+        for name, func in create_benchmarks().items():
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            us_per_op = measure(func, repeats=repeats, min_time=min_time)
+            results[name] = {"us_per_op": round(us_per_op, 2), "ops_per_sec": round(10 ** 6 / us_per_op)}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Compares results with baseline and prints the table.
+
+    :param results: current results.
+    :type results: Dict[str, Any]
+    :param baseline: baseline results.
+    :type baseline: Dict[str, Any]
+    :param threshold: allowed slowdown (0.2 means 20%).
+    :type threshold: float
+    :return: names of regressed benchmarks.
+    :rtype: List[str]
+    """
+
+    regressions = []
+    print(f"{'benchmark':36}{'us/op':>12}{'baseline':>12}{'change':>10}")
+    for name, result in results["results"].items():
+        base = baseline.get("results", dict()).get(name)
+        if base is None:
+            print(f"{name:36}{result['us_per_op']:>12}{'-':>12}{'new':>10}")
+            continue
+        change = result["us_per_op"] / base["us_per_op"] - 1
+        mark = ""
+        if change > threshold:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print(f"{name:36}{result['us_per_op']:>12}{base['us_per_op']:>12}{change:>+10.1%}{mark}")
+    return regressions
+
+
+def save(results: Dict[str, Any], path: str) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hot paths benchmarks with regression tracking")
+    parser.add_argument("--only", help="comma separated names (or prefixes) of benchmarks")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="min duration of repeat in seconds")
+    parser.add_argument("--output", default=os.path.join(results_dir, "hot_paths.json"))
+    parser.add_argument("--baseline", default=os.path.join(results_dir, "baseline.json"))
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown (0.2 means 20%%)")
+    parser.add_argument("--save-baseline", action="store_true", help="save results as new baseline")
+    options = parser.parse_args()
+
+    current = run(only=options.only.split(",") if options.only else None,
+                  repeats=options.repeats, min_time=options.min_time)
+    save(current, options.output)
+    if options.save_baseline:
+        save(current, options.baseline)
+        print(f"Baseline is saved to {options.baseline}")
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            regressed = compare(current, json.load(baseline_file), threshold=options.threshold)
+    else:
+        regressed = compare(current, dict(), threshold=options.threshold)
+        print(f"There is no baseline {options.baseline}, use --save-baseline to create it")
+    if regressed:
+        print(f"Regressions (slower than baseline by more than {options.threshold:.0%}): {', '.join(regressed)}")
+        sys.exit(1)
@@ -0,0 +1,141 @@
+"""
+Benchmark of cold start: time of `import main` in a new interpreter (python -X importtime)
+with the slowest modules. Fails if the start is slower than budget or if importing
+creates files (DBs have to be initialized lazily, see src.bootstrap).
+
+Usage:
+    python -m benchmarks.startup --budget 1.0
+    python -m benchmarks.startup --runs 10 --top 15 --json benchmarks/results/startup.json
+"""
+
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, Any, List, Tuple
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import_script = (
+    "import bot_settings\n"
+    "bot_settings.STATE_BACKEND = 'sqlite:user_states.sqlite'\n"
+    "import main\n"
+)
+
+
+def parse_importtime(output: str) -> List[Tuple[str, int, int, int]]:
+    """
+    Parses -X importtime report.
+
+    :param output: stderr of interpreter.
+    :type output: str
+    :return: list of (module, self time in us, cumulative time in us, nesting level).
+    :rtype: List[Tuple[str, int, int, int]]
+    """
+
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_time), int(cumulative), level))
+    return modules
+
+
+def measure_start(data_dir: str) -> Dict[str, Any]:
+    """
+    Imports main in new interpreter.
+
+    :param data_dir: working directory of interpreter.
+    :type data_dir: str
+    :return: wall time in seconds, import time of main in seconds, imported modules and created files.
+    :rtype: Dict[str, Any]
+    """
+
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    start = perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", import_script],
+                             cwd=data_dir, env=env, capture_output=True, text=True)
+    wall = perf_counter() - start
+    if process.returncode:
+        raise RuntimeError(process.stderr[-2000:])
+    modules = parse_importtime(process.stderr)
+    top_level = [cumulative for name, _, cumulative, level in modules if level == 0]
+    created = []
+    for root, _, files in os.walk(data_dir):
+        created.extend(os.path.relpath(os.path.join(root, name), data_dir) for name in files)
+    return {"wall": wall, "imports": sum(top_level) / 10 ** 6, "modules": modules, "created": created}
+
+
+def run(runs: int = 5, top: int = 10) -> Dict[str, Any]:
+    """
+    Measures cold start several times.
+
+    :param runs: number of starts.
+    :type runs: int
+    :param top: number of the slowest modules in result.
+    :type top: int
+    :return: median wall and import times, the slowest modules and created files.
+    :rtype: Dict[str, Any]
+    """
+
+    measures = []
+    for _ in range(runs):
+        with TemporaryDirectory() as data_dir:
+            os.makedirs(os.path.join(data_dir, "db"))
+            measures.append(measure_start(data_dir))
+
+    last = measures[-1]
+    by_self = sorted(last["modules"], key=lambda module: module[1], reverse=True)[:top]
+    packages: Dict[str, int] = dict()
+    for name, _, cumulative, level in last["modules"]:
+        if level == 0:
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + cumulative
+    return {
+        "wall_sec": round(median(measure["wall"] for measure in measures), 3),
+        "imports_sec": round(median(measure["imports"] for measure in measures), 3),
+        "modules": len(last["modules"]),
+        "slowest_modules_ms": {name: round(self_time / 1000, 1) for name, self_time, _, _ in by_self},
+        "slowest_packages_ms": {name: round(cumulative / 1000, 1) for name, cumulative in
+                                sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]},
+        "created_files": sorted(set(name for measure in measures for name in measure["created"]))
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=1.0, help="max median wall time of start in seconds")
+    parser.add_argument("--json", help="path to save results")
+    options = parser.parse_args()
+
+    result = run(runs=options.runs, top=options.top)
+    print(f"cold start: {result['wall_sec']} s (imports {result['imports_sec']} s, {result['modules']} modules)")
+    print("\nslowest packages (cumulative ms):")
+    for package_name, package_time in result["slowest_packages_ms"].items():
+        print(f"{package_time:>10}  {package_name}")
+    print("\nslowest modules (self ms):")
+    for module_name, module_time in result["slowest_modules_ms"].items():
+        print(f"{module_time:>10}  {module_name}")
+    if options.json:
+        os.makedirs(os.path.dirname(os.path.abspath(options.json)), exist_ok=True)
+        with open(options.json, "w") as json_file:
+            json.dump(result, json_file, indent=2)
+
+    failed = False
+    if result["created_files"]:
+        print(f"\nImport has side effects, files are created: {', '.join(result['created_files'])}")
+        failed = True
+    if result["wall_sec"] > options.budget:
+        print(f"\nCold start {result['wall_sec']} s exceeds budget {options.budget} s")
+        failed = True
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,79 @@
+"""
+Benchmark of user states storages: reads and compare-and-set writes per second.
+
+Usage:
+    python -m benchmarks.state_backends --ops 2000
+"""
+
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict
+from db.state_backends import StateBackend, SQLiteBackend, RedisBackend, VedisBackend
+from loadtest.fake_redis import FakeRedisServer
+import argparse
+import os
+
+
+def bench_backend(backend: StateBackend, ops: int, value_size: int = 4096) -> Dict[str, float]:
+    """
+    Makes `ops` reads and `ops` compare-and-set writes of one key.
+
+    :param backend: storage to benchmark.
+    :type backend: StateBackend
+    :param ops: number of operations of every kind.
+    :type ops: int
+    :param value_size: size of written value in bytes.
+    :type value_size: int
+    :return: dict with reads and writes per second.
+    :rtype: Dict[str, float]
+    """
+
+    value = os.urandom(value_size)
+    backend.set("bench", value)
+    _, version = backend.get("bench")
+
+    start = perf_counter()
+    for _ in range(ops):
+        backend.get("bench")
+    reads = ops / (perf_counter() - start)
+
+    start = perf_counter()
+    for _ in range(ops):
+        backend.set("bench", value, version)
+        version += 1
+    writes = ops / (perf_counter() - start)
+
+    return {"reads_per_sec": round(reads), "cas_writes_per_sec": round(writes)}
+
+
+def run(ops: int) -> Dict[str, Dict[str, float]]:
+    """
+    Benchmarks all available storages.
+
+    :param ops: number of operations of every kind.
+    :type ops: int
+    :return: results by storage name.
+    :rtype: Dict[str, Dict[str, float]]
+    """
+
+    results = dict()
+    with TemporaryDirectory() as tmp:
+        results["sqlite"] = bench_backend(SQLiteBackend(os.path.join(tmp, "states.sqlite")), ops)
+        try:
+            results["vedis"] = bench_backend(VedisBackend(os.path.join(tmp, "states.dbv")), ops)
+        except ImportError:
+            pass
+
+    server = FakeRedisServer().start()
+    host, port = server.server_address
+    results["redis (fake server)"] = bench_backend(RedisBackend(host=host, port=port), ops)
+    server.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="User states storages benchmark")
+    parser.add_argument("--ops", type=int, default=2000)
+    options = parser.parse_args()
+    for name, result in run(options.ops).items():
+        print(f"{name:20} {result['reads_per_sec']:>10} reads/s {result['cas_writes_per_sec']:>10} CAS writes/s")
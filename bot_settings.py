@@ -9,5 +9,100 @@ headers = {
     "X-RapidAPI-Host": "hotels4.p.rapidapi.com"
 }
 
+HOTELS_API_URL = "https://hotels4.p.rapidapi.com/"
+
+RAPIDAPI_LIMITS = {
+    "per_second": 5,
+    "monthly": 500
+}
+
+HEDGED_REQUESTS = {
+    "enabled": False,
+    "percentile": 95,
+    "budget": 0.1
+}
+
+PREFETCH = {
+    "enabled": True,
+    "photos": True,
+    "ttl": 300
+}
+
+FRESH_RESPONSES = {
+    "location": 60 * 60 * 24,
+    "photo": 60 * 60 * 24,
+    "hotels_list": 60 * 15
+}
+
+STATE_BACKEND = "vedis:db/user_states.dbv"
+
+METRICS_SINKS = "log:300"
+
+ADMIN_IDS = []
+
+PROFILING = {
+    "enabled": False,
+    "sample_rate": 0.01,
+    "slow_threshold": 5,
+    "directory": "profiles",
+    "max_files": 200
+}
+
+TRACING = {
+    "enabled": False,
+    "sample_rate": 1.0,
+    "exporter": "json:traces/traces.jsonl"
+}
+
+LIFECYCLE = {
+    "drain_timeout": 20,
+    "snapshot": "db/caches_snapshot.pickle"
+}
+
+SHARDING = {
+    "workers": 4,
+    "health_interval": 10,
+    "shared_cache": "db/shared_cache.sqlite"
+}
+
+GAZETTEER = {
+    "enabled": True,
+    "fuzzy_threshold": 0.5,
+    "min_prefix": 4,
+    "max_results": 10
+}
+
+INLINE_MODE = {
+    "enabled": True,
+    "max_results": 10,
+    "cache_time": 300,
+    "fallback_min_length": 3,
+    "fallback_interval": 2,
+    "fallback_concurrency": 2
+}
+
+COMPARISON = {
+    "max_destinations": 3,
+    "deadline": 12
+}
+
+DATE_FLEX = {
+    "enabled": True,
+    "options": [0, 1, 2, 3],
+    "concurrency": 4,
+    "deadline": 12
+}
+
+PRICE_WATCH = {
+    "enabled": True,
+    "interval": 60 * 60 * 6,
+    "tick": 60,
+    "checks_per_tick": 5,
+    "max_per_user": 5,
+    "min_drop": 0.05,
+    "batch_size": 20,
+    "batch_interval": 1
+}
+
 
 bot = telebot.TeleBot(f"{TOKEN}")
\ No newline at end of file
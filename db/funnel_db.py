@@ -0,0 +1,71 @@
+"""
+Keeps aggregated funnel of search scenarios by days (SQLite, the same DB as history).
+"""
+
+from typing import Dict, Tuple
+from datetime import date
+from db.history_db import register_tables, get_engine
+
+funnel = None
+
+
+@register_tables
+def create_funnel_table(db_metadata) -> None:
+    """
+    Describes 'funnel' table (called when DB is initialized, see db.history_db.init_db).
+
+    :param db_metadata: metadata of DB.
+    :return: None
+    """
+
+    from sqlalchemy import Table, Column, Date, String, Float
+
+    global funnel
+    funnel = Table("funnel", db_metadata,
+                   Column(name="day", type_=Date, primary_key=True),
+                   Column(name="stage", type_=String, primary_key=True),
+                   Column(name="metric", type_=String, primary_key=True),
+                   Column(name="value", type_=Float, nullable=False))
+
+
+def add_funnel_values(day: date, values: Dict[Tuple[str, str], float]) -> None:
+    """
+    Adds values to funnel counters of the day with one upsert (INSERT ... ON CONFLICT DO UPDATE),
+    so processes adding the same counters concurrently don't conflict.
+
+    :param day: day of values.
+    :type day: date
+    :param values: dict (stage, metric): value.
+    :type values: Dict[Tuple[str, str], float]
+    :return: None
+    """
+
+    from sqlalchemy.dialects.sqlite import insert
+
+    engine = get_engine()
+    statement = insert(funnel)
+    statement = statement.on_conflict_do_update(index_elements=[funnel.c.day, funnel.c.stage, funnel.c.metric],
+                                                set_={"value": funnel.c.value + statement.excluded.value})
+    with engine.begin() as connection:
+        connection.execute(statement, [{"day": day, "stage": stage, "metric": metric, "value": value}
+                                       for (stage, metric), value in values.items()])
+
+
+def get_funnel_values(since: date) -> Dict[Tuple[str, str], float]:
+    """
+    Sums funnel counters of days since passed day (inclusive).
+
+    :param since: the first day.
+    :type since: date
+    :return: dict (stage, metric): value.
+    :rtype: Dict[Tuple[str, str], float]
+    """
+
+    from sqlalchemy import select, func
+
+    engine = get_engine()
+    query = select(funnel.c.stage, funnel.c.metric, func.sum(funnel.c.value)) \
+        .where(funnel.c.day >= since) \
+        .group_by(funnel.c.stage, funnel.c.metric)
+    with engine.connect() as connection:
+        return {(stage, metric): value for stage, metric, value in connection.execute(query)}
@@ -0,0 +1,65 @@
+"""
+Keeps rapidapi responses to location searches for the local gazetteer
+(SQLite, the same DB as history, see src.gazetteer).
+"""
+
+from typing import Dict, List, Tuple
+from db.history_db import register_tables, get_engine
+
+gazetteer = None
+
+
+@register_tables
+def create_gazetteer_table(db_metadata) -> None:
+    """
+    Describes 'gazetteer' table (called when DB is initialized, see db.history_db.init_db).
+
+    :param db_metadata: metadata of DB.
+    :return: None
+    """
+
+    from sqlalchemy import Table, Column, Integer, String
+
+    global gazetteer
+    gazetteer = Table("gazetteer", db_metadata,
+                      Column(name="query", type_=String, primary_key=True),
+                      Column(name="position", type_=Integer, primary_key=True),
+                      Column(name="caption", type_=String, nullable=False),
+                      Column(name="destination_id", type_=String, nullable=False))
+
+
+def save_locations(query: str, locations: Dict[str, str]) -> None:
+    """
+    Replaces locations found by query.
+
+    :param query: normalised query (see src.gazetteer.normalise).
+    :type query: str
+    :param locations: dict "location name": "destinationId" in order of rapidapi response.
+    :type locations: Dict[str, str]
+    :return: None
+    """
+
+    with get_engine().begin() as connection:
+        connection.execute(gazetteer.delete().where(gazetteer.c.query == query))
+        if locations:
+            connection.execute(gazetteer.insert(),
+                               [{"query": query, "position": position,
+                                 "caption": caption, "destination_id": destination_id}
+                                for position, (caption, destination_id) in enumerate(locations.items())])
+
+
+def load_locations() -> List[Tuple[str, str, str]]:
+    """
+    Reads all saved locations.
+
+    :return: list of (query, caption, destination_id) ordered by query and position in response.
+    :rtype: List[Tuple[str, str, str]]
+    """
+
+    from sqlalchemy import select
+
+    engine = get_engine()
+    query = select(gazetteer.c.query, gazetteer.c.caption, gazetteer.c.destination_id) \
+        .order_by(gazetteer.c.query, gazetteer.c.position)
+    with engine.connect() as connection:
+        return [tuple(row) for row in connection.execute(query)]
@@ -1,29 +1,174 @@
 """
 Saves and shows searching results (SQLite). Implementation of /history command.
+DB is initialized on the first use (see init_db).
 """
 
-from sqlalchemy import create_engine, Table, MetaData, Column, Integer, DateTime, String
-from sqlalchemy.orm import sessionmaker, mapper
-from typing import List, Optional
+from typing import List, Optional, Callable
 from datetime import datetime
+from threading import Lock
+from random import uniform
+from time import sleep
 from src.bot_text import history_dict, hotels_link
+from src.tracing import start_span
 
-engine = create_engine("sqlite:///db/history.db",
-                       connect_args={"check_same_thread": False})
-Session = sessionmaker(bind=engine)
-session = Session()
+db_url = "sqlite:///db/history.db"
 
-metadata = MetaData(bind=engine)
+engine = None
+metadata = None
+session = None
+db_lock = Lock()
+create_attempts = 5
+create_retry_delay = 0.1
+tables_factories: List[Callable] = []
 
-history = Table("history", metadata,
-                Column(name="id", type_=Integer,
-                       primary_key=True, unique=True,
-                       autoincrement=True, nullable=False),
-                Column(name="telegram_id", type_=Integer, nullable=False),
-                Column(name="date", type_=DateTime, nullable=False),
-                Column(name="command", type_=String, nullable=False),
-                Column(name="hotel", type_=String, nullable=False),
-                Column(name="location", type_=String, nullable=False))
+
+def start_query_span(conn, cursor, statement, parameters, context, executemany) -> None:
+    """
+    Opens span of SQL query if the query is made while tracing an update (see src.tracing).
+    """
+
+    conn.info["query_span"] = start_span("history_db.query", statement=statement[:200])
+
+
+def finish_query_span(conn, cursor, statement, parameters, context, executemany) -> None:
+    """
+    Finishes span of SQL query.
+    """
+
+    query_span = conn.info.pop("query_span", None)
+    if query_span:
+        query_span.attributes["rows"] = cursor.rowcount
+        query_span.finish()
+
+
+def finish_failed_query_span(exception_context) -> None:
+    """
+    Finishes span of failed SQL query with error.
+    """
+
+    query_span = exception_context.connection.info.pop("query_span", None) \
+        if exception_context.connection is not None else None
+    if query_span:
+        query_span.finish(error=exception_context.original_exception)
+
+
+def create_history_table(db_metadata) -> None:
+    """
+    Describes 'history' table and maps History class to it
+    (History is mapped once, if DB is initialized again after failure the mapping is kept).
+
+    :param db_metadata: metadata of DB.
+    :return: None
+    """
+
+    from sqlalchemy import Table, Column, Integer, DateTime, String, inspect
+    from sqlalchemy.orm import mapper
+
+    history = Table("history", db_metadata,
+                    Column(name="id", type_=Integer,
+                           primary_key=True, unique=True,
+                           autoincrement=True, nullable=False),
+                    Column(name="telegram_id", type_=Integer, nullable=False),
+                    Column(name="date", type_=DateTime, nullable=False),
+                    Column(name="command", type_=String, nullable=False),
+                    Column(name="hotel", type_=String, nullable=False),
+                    Column(name="location", type_=String, nullable=False))
+    if inspect(History, raiseerr=False) is None:
+        mapper(History, history)
+
+
+def register_tables(factory: Callable) -> Callable:
+    """
+    Decorator to register function which describes tables of the DB (called with metadata
+    when DB is initialized, see init_db, or immediately if it's already initialized).
+
+    :param factory: function describing tables.
+    :type factory: Callable
+    :return: the same function.
+    :rtype: Callable
+    """
+
+    with db_lock:
+        tables_factories.append(factory)
+        if metadata is not None:
+            factory(metadata)
+            metadata.create_all(bind=engine)
+    return factory
+
+
+def init_db() -> None:
+    """
+    Creates engine, tables and session on the first use of DB.
+    SQLAlchemy is imported here, so importing of bot modules doesn't wait for it.
+    Creation of tables is retried after a random delay if another process creates them
+    at the same time. If it still fails, DB is initialized again on the next use.
+
+    :return: None
+    """
+
+    global engine, metadata, session
+    with db_lock:
+        if session is not None:
+            return
+        from sqlalchemy import create_engine, event, MetaData
+        from sqlalchemy.exc import OperationalError
+        from sqlalchemy.orm import sessionmaker, scoped_session
+
+        engine = create_engine(db_url, connect_args={"check_same_thread": False})
+        event.listen(engine, "before_cursor_execute", start_query_span)
+        event.listen(engine, "after_cursor_execute", finish_query_span)
+        event.listen(engine, "handle_error", finish_failed_query_span)
+        metadata = MetaData(bind=engine)
+        for factory in [create_history_table] + tables_factories:
+            factory(metadata)
+        for attempt in range(create_attempts):
+            try:
+                metadata.create_all(bind=engine)
+                break
+            except OperationalError:
+                # another bot process has created some of the tables at the same time (see src.supervisor),
+                # existing tables are skipped on the next attempt
+                if attempt == create_attempts - 1:
+                    engine.dispose()
+                    engine, metadata = None, None
+                    raise
+                sleep(create_retry_delay * (attempt + 1) * uniform(0.5, 1.5))
+        session = scoped_session(sessionmaker(bind=engine))
+
+
+def get_session():
+    """
+    Returns thread-local session of DB (initializes DB on the first call).
+
+    :return: scoped session.
+    """
+
+    init_db()
+    return session
+
+
+def get_engine():
+    """
+    Returns engine of DB (initializes DB on the first call).
+
+    :return: SQLAlchemy engine.
+    """
+
+    init_db()
+    return engine
+
+
+def close_db() -> None:
+    """
+    Closes sessions and connections of DB on shutdown (if it was initialized).
+
+    :return: None
+    """
+
+    with db_lock:
+        if session is not None:
+            session.remove()
+            engine.dispose()
 
 
 class History:
@@ -83,10 +228,6 @@ class History:
         return f"{self.telegram_id}; {self.date}; {self.hotel}"
 
 
-mapper(History, history)
-metadata.create_all(bind=engine)
-
-
 def get_from_db(telegram_id: int) -> List[str]:
     """
     Makes a SELECT query to 'history' table. Get a list of History
@@ -101,7 +242,7 @@ def get_from_db(telegram_id: int) -> List[str]:
     """
 
     result = []
-    history_log: List[Optional[History]] = session.query(History).filter(
+    history_log: List[Optional[History]] = get_session().query(History).filter(
         History.telegram_id == telegram_id).all()
     if history_log:
         for history_item in history_log:
@@ -130,13 +271,14 @@ def push_to_db(telegram_id: int, date: datetime, hotel: List[str], command: str,
     :return: None
     """
 
+    db_session = get_session()
     new_history_item = History(telegram_id=telegram_id,
                                date=date,
                                hotel=hotel,
                                command=command,
                                location=location)
-    session.add(new_history_item)
-    session.commit()
+    db_session.add(new_history_item)
+    db_session.commit()
 
 
 def prepare_message_text(history_instance: History) -> str:
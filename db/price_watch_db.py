@@ -0,0 +1,235 @@
+"""
+Keeps saved searches watched for price drops (SQLite, the same DB as history, see src.price_watch).
+Identical searches of different users are kept as one query with one schedule and one snapshot
+of prices, users are subscribed to it by jobs.
+"""
+
+from typing import Dict, List, Optional, Tuple
+from db.history_db import register_tables, get_engine
+
+watch_queries = None
+watch_jobs = None
+
+
+@register_tables
+def create_price_watch_tables(db_metadata) -> None:
+    """
+    Describes 'watch_queries' and 'watch_jobs' tables
+    (called when DB is initialized, see db.history_db.init_db).
+
+    :param db_metadata: metadata of DB.
+    :return: None
+    """
+
+    from sqlalchemy import Table, Column, Integer, Float, String
+
+    global watch_queries, watch_jobs
+    watch_queries = Table("watch_queries", db_metadata,
+                          Column(name="query_key", type_=String, primary_key=True),
+                          Column(name="params", type_=String, nullable=False),
+                          Column(name="location", type_=String, nullable=False),
+                          Column(name="next_check", type_=Float, nullable=False, index=True),
+                          Column(name="snapshot", type_=String, nullable=True))
+    watch_jobs = Table("watch_jobs", db_metadata,
+                       Column(name="id", type_=Integer, primary_key=True, autoincrement=True),
+                       Column(name="telegram_id", type_=Integer, nullable=False, index=True),
+                       Column(name="query_key", type_=String, nullable=False, index=True),
+                       Column(name="created", type_=Float, nullable=False))
+
+
+def count_user_watches(telegram_id: int) -> int:
+    """
+    Counts searches watched by user.
+
+    :param telegram_id: telegram id of user.
+    :type telegram_id: int
+    :return: number of jobs of user.
+    :rtype: int
+    """
+
+    from sqlalchemy import select, func
+
+    engine = get_engine()
+    query = select(func.count()).select_from(watch_jobs).where(watch_jobs.c.telegram_id == telegram_id)
+    with engine.connect() as connection:
+        return connection.execute(query).scalar()
+
+
+def add_watch(telegram_id: int, query_key: str, params: str, location: str,
+              first_check: float, created: float) -> bool:
+    """
+    Subscribes user to the query. The query is created if nobody watches it yet.
+
+    :param telegram_id: telegram id of user.
+    :type telegram_id: int
+    :param query_key: key of the query (see src.price_watch.query_key).
+    :type query_key: str
+    :param params: params of the search (JSON).
+    :type params: str
+    :param location: location name to show it to user.
+    :type location: str
+    :param first_check: timestamp of the first check of new query.
+    :type first_check: float
+    :param created: timestamp of subscription.
+    :type created: float
+    :return: False if user already watches the query.
+    :rtype: bool
+    """
+
+    from sqlalchemy import select
+
+    engine = get_engine()
+    with engine.begin() as connection:
+        if connection.execute(select(watch_jobs.c.id).where(watch_jobs.c.telegram_id == telegram_id,
+                                                            watch_jobs.c.query_key == query_key)).first():
+            return False
+        if not connection.execute(select(watch_queries.c.query_key)
+                                  .where(watch_queries.c.query_key == query_key)).first():
+            connection.execute(watch_queries.insert().values(query_key=query_key, params=params, location=location,
+                                                             next_check=first_check, snapshot=None))
+        connection.execute(watch_jobs.insert().values(telegram_id=telegram_id, query_key=query_key,
+                                                      created=created))
+    return True
+
+
+def get_user_watches(telegram_id: int) -> List[Tuple[int, str, str]]:
+    """
+    Reads searches watched by user.
+
+    :param telegram_id: telegram id of user.
+    :type telegram_id: int
+    :return: list of (job id, location name, params JSON) in order of subscription.
+    :rtype: List[Tuple[int, str, str]]
+    """
+
+    from sqlalchemy import select
+
+    engine = get_engine()
+    query = select(watch_jobs.c.id, watch_queries.c.location, watch_queries.c.params) \
+        .select_from(watch_jobs.join(watch_queries, watch_jobs.c.query_key == watch_queries.c.query_key)) \
+        .where(watch_jobs.c.telegram_id == telegram_id) \
+        .order_by(watch_jobs.c.id)
+    with engine.connect() as connection:
+        return [tuple(row) for row in connection.execute(query)]
+
+
+def remove_watch(job_id: int, telegram_id: int) -> bool:
+    """
+    Unsubscribes user from the query. The query is removed if nobody watches it.
+
+    :param job_id: id of the job.
+    :type job_id: int
+    :param telegram_id: telegram id of user (owner of the job).
+    :type telegram_id: int
+    :return: False if there is no such job of user.
+    :rtype: bool
+    """
+
+    from sqlalchemy import select
+
+    engine = get_engine()
+    with engine.begin() as connection:
+        query_key = connection.execute(select(watch_jobs.c.query_key)
+                                       .where(watch_jobs.c.id == job_id,
+                                              watch_jobs.c.telegram_id == telegram_id)).scalar()
+        if query_key is None:
+            return False
+        connection.execute(watch_jobs.delete().where(watch_jobs.c.id == job_id))
+        if not connection.execute(select(watch_jobs.c.id).where(watch_jobs.c.query_key == query_key)).first():
+            connection.execute(watch_queries.delete().where(watch_queries.c.query_key == query_key))
+    return True
+
+
+def remove_user_watches(telegram_id: int) -> None:
+    """
+    Unsubscribes user from all queries (e.g. user blocked the bot).
+    Queries without other watchers are removed.
+
+    :param telegram_id: telegram id of user.
+    :type telegram_id: int
+    :return: None
+    """
+
+    from sqlalchemy import select
+
+    engine = get_engine()
+    with engine.begin() as connection:
+        connection.execute(watch_jobs.delete().where(watch_jobs.c.telegram_id == telegram_id))
+        connection.execute(watch_queries.delete().where(
+            watch_queries.c.query_key.not_in(select(watch_jobs.c.query_key))))
+
+
+def remove_queries(query_keys: List[str]) -> None:
+    """
+    Removes queries and all their jobs (e.g. dates of the search have passed).
+
+    :param query_keys: keys of queries.
+    :type query_keys: List[str]
+    :return: None
+    """
+
+    with get_engine().begin() as connection:
+        connection.execute(watch_jobs.delete().where(watch_jobs.c.query_key.in_(query_keys)))
+        connection.execute(watch_queries.delete().where(watch_queries.c.query_key.in_(query_keys)))
+
+
+def get_due_queries(timestamp: float, limit: int) -> List[Tuple[str, str, str, Optional[str]]]:
+    """
+    Reads queries which have to be checked, the most overdue first.
+
+    :param timestamp: current time.
+    :type timestamp: float
+    :param limit: max number of queries.
+    :type limit: int
+    :return: list of (query key, params JSON, location name, snapshot JSON or None before the first check).
+    :rtype: List[Tuple[str, str, str, Optional[str]]]
+    """
+
+    from sqlalchemy import select
+
+    engine = get_engine()
+    query = select(watch_queries.c.query_key, watch_queries.c.params,
+                   watch_queries.c.location, watch_queries.c.snapshot) \
+        .where(watch_queries.c.next_check <= timestamp) \
+        .order_by(watch_queries.c.next_check) \
+        .limit(limit)
+    with engine.connect() as connection:
+        return [tuple(row) for row in connection.execute(query)]
+
+
+def save_check(query_key: str, next_check: float, snapshot: Optional[str] = None) -> None:
+    """
+    Saves result of the query check.
+
+    :param query_key: key of the query.
+    :type query_key: str
+    :param next_check: timestamp of the next check.
+    :type next_check: float
+    :param snapshot: new snapshot of prices (JSON), None if the check failed and snapshot is kept.
+    :type snapshot: Optional[str]
+    :return: None
+    """
+
+    values: Dict[str, object] = {"next_check": next_check}
+    if snapshot is not None:
+        values["snapshot"] = snapshot
+    with get_engine().begin() as connection:
+        connection.execute(watch_queries.update().where(watch_queries.c.query_key == query_key).values(**values))
+
+
+def get_watchers(query_key: str) -> List[int]:
+    """
+    Reads users watching the query.
+
+    :param query_key: key of the query.
+    :type query_key: str
+    :return: telegram ids of users.
+    :rtype: List[int]
+    """
+
+    from sqlalchemy import select
+
+    engine = get_engine()
+    with engine.connect() as connection:
+        return [row[0] for row in connection.execute(select(watch_jobs.c.telegram_id)
+                                                     .where(watch_jobs.c.query_key == query_key))]
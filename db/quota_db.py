@@ -0,0 +1,55 @@
+"""
+Keeps usage of rapidapi plan by months (SQLite, the same DB as history, see src.quota).
+All processes of the bot add their requests to one counter, so the monthly budget
+isn't reset by restart and isn't multiplied by number of processes.
+"""
+
+from typing import Optional
+from db.history_db import register_tables, get_engine
+
+quota_usage = None
+
+
+@register_tables
+def create_quota_table(db_metadata) -> None:
+    """
+    Describes 'quota_usage' table (called when DB is initialized, see db.history_db.init_db).
+
+    :param db_metadata: metadata of DB.
+    :return: None
+    """
+
+    from sqlalchemy import Table, Column, Integer, String
+
+    global quota_usage
+    quota_usage = Table("quota_usage", db_metadata,
+                        Column(name="period", type_=String, primary_key=True),
+                        Column(name="spent", type_=Integer, nullable=False))
+
+
+def add_quota_usage(period: str, spent: int, observed: Optional[int] = None) -> int:
+    """
+    Adds requests made by the process to usage of the period and returns usage of all processes.
+
+    :param period: month of usage (YYYY-MM).
+    :type period: str
+    :param spent: number of requests made since the last call.
+    :type spent: int
+    :param observed: usage reported by rapidapi headers before these requests (replaces the counter).
+    :type observed: Optional[int]
+    :return: number of requests made in the period.
+    :rtype: int
+    """
+
+    from sqlalchemy import select
+    from sqlalchemy.dialects.sqlite import insert
+
+    engine = get_engine()
+    statement = insert(quota_usage).values(period=period, spent=(observed or 0) + spent)
+    statement = statement.on_conflict_do_update(
+        index_elements=[quota_usage.c.period],
+        set_={"spent": statement.excluded.spent if observed is not None
+              else quota_usage.c.spent + statement.excluded.spent})
+    with engine.begin() as connection:
+        connection.execute(statement)
+        return connection.execute(select(quota_usage.c.spent).where(quota_usage.c.period == period)).scalar()
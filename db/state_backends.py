@@ -0,0 +1,453 @@
+"""
+Storages for user states: Vedis file, SQLite in WAL mode and Redis-compatible server.
+Every stored value has a version to make compare-and-set writes
+from several bot processes.
+"""
+
+from abc import ABC, abstractmethod
+from threading import local
+from typing import Optional, Tuple, Dict, List, Any
+from urllib.parse import urlparse
+import socket
+import sqlite3
+import os
+
+
+class StateConflictError(Exception):
+    """
+    Raised when a state was changed by another process after it was loaded.
+    """
+
+    def __init__(self, key: str):
+        super().__init__(f"state {key} was changed by another process")
+        self.key = key
+
+
+class StateBackend(ABC):
+    """
+    Abstract storage of versioned values and string hashes.
+    Version of missing value is 0. Every write increases the version by 1.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Tuple[Optional[bytes], int]:
+        """
+        Returns value and its version.
+
+        :param key: key of value.
+        :type key: str
+        :return: value (None if it doesn't exist) and its version.
+        :rtype: Tuple[Optional[bytes], int]
+        """
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, version: Optional[int] = None) -> bool:
+        """
+        Writes the value if its current version equals passed version.
+        Writes the value unconditionally if version is None.
+
+        :param key: key of value.
+        :type key: str
+        :param value: value to write.
+        :type value: bytes
+        :param version: expected current version of value.
+        :type version: Optional[int]
+        :return: True if the value was written else False.
+        :rtype: bool
+        """
+
+    @abstractmethod
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        """
+        Deletes the value if its current version equals passed version.
+        Deletes the value unconditionally if version is None.
+
+        :param key: key of value.
+        :type key: str
+        :param version: expected current version of value.
+        :type version: Optional[int]
+        :return: True if the value was deleted (or didn't exist with version 0) else False.
+        :rtype: bool
+        """
+
+    @abstractmethod
+    def hset(self, name: str, field: str, value: str) -> None:
+        """
+        Sets field of hash.
+
+        :param name: name of hash.
+        :type name: str
+        :param field: field of hash.
+        :type field: str
+        :param value: value of field.
+        :type value: str
+        :return: None
+        """
+
+    @abstractmethod
+    def hdel(self, name: str, field: str) -> None:
+        """
+        Deletes field of hash.
+
+        :param name: name of hash.
+        :type name: str
+        :param field: field of hash.
+        :type field: str
+        :return: None
+        """
+
+    @abstractmethod
+    def hgetall(self, name: str) -> Dict[str, str]:
+        """
+        Returns all fields of hash.
+
+        :param name: name of hash.
+        :type name: str
+        :return: dict with fields and their values.
+        :rtype: Dict[str, str]
+        """
+
+    @abstractmethod
+    def hlen(self, name: str) -> int:
+        """
+        Counts fields of hash.
+
+        :param name: name of hash.
+        :type name: str
+        :return: number of fields.
+        :rtype: int
+        """
+
+    @abstractmethod
+    def size(self) -> int:
+        """
+        Returns size of storage in bytes.
+
+        :return: size of storage in bytes.
+        :rtype: int
+        """
+
+
+class VedisBackend(StateBackend):
+    """
+    Local Vedis file. Versions are kept in a separate hash.
+    Can be used by single bot process only.
+
+    Args:
+        :path (str):   path to Vedis file.
+    """
+
+    versions_hash = "__versions__"
+
+    def __init__(self, path: str):
+        from vedis import Vedis
+
+        self.path: str = path
+        self.vedis = Vedis
+
+    def get(self, key: str) -> Tuple[Optional[bytes], int]:
+        with self.vedis(self.path) as db:
+            try:
+                value = db[key]
+            except KeyError:
+                return None, 0
+            return value, int(db.hget(self.versions_hash, key) or 0)
+
+    def set(self, key: str, value: bytes, version: Optional[int] = None) -> bool:
+        with self.vedis(self.path) as db:
+            with db.transaction():
+                current = int(db.hget(self.versions_hash, key) or 0)
+                if version is not None and current != version:
+                    return False
+                db[key] = value
+                db.hset(self.versions_hash, key, str(current + 1))
+        return True
+
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        with self.vedis(self.path) as db:
+            with db.transaction():
+                if version is not None and int(db.hget(self.versions_hash, key) or 0) != version:
+                    return False
+                db.hdel(self.versions_hash, key)
+                try:
+                    del db[key]
+                except KeyError:
+                    pass
+        return True
+
+    def hset(self, name: str, field: str, value: str) -> None:
+        with self.vedis(self.path) as db:
+            db.hset(name, field, value)
+
+    def hdel(self, name: str, field: str) -> None:
+        with self.vedis(self.path) as db:
+            db.hdel(name, field)
+
+    def hgetall(self, name: str) -> Dict[str, str]:
+        with self.vedis(self.path) as db:
+            items = db.hgetall(name) or dict()
+        return {field.decode(): value.decode() for field, value in items.items()}
+
+    def hlen(self, name: str) -> int:
+        with self.vedis(self.path) as db:
+            return db.hlen(name)
+
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+
+class SQLiteBackend(StateBackend):
+    """
+    SQLite file in WAL mode. Several bot processes on one host can share it.
+    Every thread uses its own connection.
+
+    Args:
+        :path (str):   path to SQLite file.
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.connections = local()
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS states "
+                               "(key TEXT PRIMARY KEY, value BLOB NOT NULL, version INTEGER NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS hashes "
+                               "(name TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, "
+                               "PRIMARY KEY (name, field))")
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns connection of current thread. Creates it if it doesn't exist.
+
+        :return: connection to SQLite file.
+        :rtype: sqlite3.Connection
+        """
+
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.connections.connection = connection
+        return connection
+
+    def get(self, key: str) -> Tuple[Optional[bytes], int]:
+        row = self.connection().execute("SELECT value, version FROM states WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, 0
+        return bytes(row[0]), row[1]
+
+    def set(self, key: str, value: bytes, version: Optional[int] = None) -> bool:
+        with self.connection() as connection:
+            if version is None:
+                cursor = connection.execute("INSERT INTO states (key, value, version) VALUES (?, ?, 1) "
+                                            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, "
+                                            "version = version + 1", (key, value))
+            elif version == 0:
+                cursor = connection.execute("INSERT OR IGNORE INTO states (key, value, version) "
+                                            "VALUES (?, ?, 1)", (key, value))
+            else:
+                cursor = connection.execute("UPDATE states SET value = ?, version = version + 1 "
+                                            "WHERE key = ? AND version = ?", (value, key, version))
+        return cursor.rowcount == 1
+
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        with self.connection() as connection:
+            if version is None:
+                connection.execute("DELETE FROM states WHERE key = ?", (key,))
+                return True
+            if version == 0:
+                return connection.execute("SELECT 1 FROM states WHERE key = ?", (key,)).fetchone() is None
+            cursor = connection.execute("DELETE FROM states WHERE key = ? AND version = ?", (key, version))
+        return cursor.rowcount == 1
+
+    def hset(self, name: str, field: str, value: str) -> None:
+        with self.connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO hashes (name, field, value) VALUES (?, ?, ?)",
+                               (name, field, value))
+
+    def hdel(self, name: str, field: str) -> None:
+        with self.connection() as connection:
+            connection.execute("DELETE FROM hashes WHERE name = ? AND field = ?", (name, field))
+
+    def hgetall(self, name: str) -> Dict[str, str]:
+        rows = self.connection().execute("SELECT field, value FROM hashes WHERE name = ?", (name,))
+        return dict(rows.fetchall())
+
+    def hlen(self, name: str) -> int:
+        return self.connection().execute("SELECT COUNT(*) FROM hashes WHERE name = ?", (name,)).fetchone()[0]
+
+    def size(self) -> int:
+        return sum(os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.exists(path))
+
+
+class RedisBackend(StateBackend):
+    """
+    Redis-compatible server (RESP protocol). Any number of bot processes can share it.
+    Value and its version are kept in a Redis hash, compare-and-set is made with WATCH/MULTI/EXEC.
+    Every thread uses its own connection.
+
+    Args:
+        :host (str):   server host.
+        :port (int):   server port.
+        :db (int):   number of Redis database.
+        :prefix (str):   prefix of all keys.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, prefix: str = "hotels_bot:"):
+        self.host: str = host
+        self.port: int = port
+        self.db: int = db
+        self.prefix: str = prefix
+        self.connections = local()
+
+    def connection(self) -> Tuple[socket.socket, Any]:
+        """
+        Returns socket and its reader of current thread. Creates them if they don't exist.
+
+        :return: socket connected to server and file object to read responses.
+        :rtype: Tuple[socket.socket, Any]
+        """
+
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            sock = socket.create_connection((self.host, self.port), timeout=10)
+            connection = sock, sock.makefile("rb")
+            self.connections.connection = connection
+            if self.db:
+                self.command("SELECT", self.db)
+        return connection
+
+    def command(self, *args: Any) -> Any:
+        """
+        Sends a command to server and returns parsed reply.
+
+        :param args: command name and its arguments.
+        :return: parsed reply.
+        :raise ConnectionError: if server returned an error.
+        """
+
+        sock, reader = self.connection()
+        parts = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]
+        request = b"*%d\r\n" % len(parts) + b"".join(b"$%d\r\n%s\r\n" % (len(part), part) for part in parts)
+        try:
+            sock.sendall(request)
+            return self.read_reply(reader)
+        except (OSError, EOFError):
+            self.connections.connection = None
+            raise
+
+    @classmethod
+    def read_reply(cls, reader: Any) -> Any:
+        """
+        Reads one RESP reply.
+
+        :param reader: file object of socket.
+        :return: parsed reply.
+        :raise ConnectionError: if server returned an error.
+        """
+
+        line = reader.readline()
+        if not line:
+            raise EOFError("connection closed by server")
+        kind, data = line[:1], line[1:-2]
+        if kind == b"+":
+            return data.decode()
+        if kind == b"-":
+            raise ConnectionError(data.decode())
+        if kind == b":":
+            return int(data)
+        if kind == b"$":
+            if int(data) == -1:
+                return None
+            value = reader.read(int(data) + 2)
+            return value[:-2]
+        if kind == b"*":
+            if int(data) == -1:
+                return None
+            return [cls.read_reply(reader) for _ in range(int(data))]
+        raise ConnectionError(f"unknown reply {line!r}")
+
+    def get(self, key: str) -> Tuple[Optional[bytes], int]:
+        value, version = self.command("HMGET", self.prefix + key, "value", "version")
+        if value is None:
+            return None, 0
+        return value, int(version)
+
+    def set(self, key: str, value: bytes, version: Optional[int] = None) -> bool:
+        key = self.prefix + key
+        if version is None:
+            self.command("MULTI")
+            self.command("HSET", key, "value", value)
+            self.command("HINCRBY", key, "version", 1)
+            self.command("EXEC")
+            return True
+        self.command("WATCH", key)
+        current = self.command("HGET", key, "version")
+        if int(current or 0) != version:
+            self.command("UNWATCH")
+            return False
+        self.command("MULTI")
+        self.command("HSET", key, "value", value, "version", version + 1)
+        return self.command("EXEC") is not None
+
+    def delete(self, key: str, version: Optional[int] = None) -> bool:
+        key = self.prefix + key
+        if version is None:
+            self.command("DEL", key)
+            return True
+        self.command("WATCH", key)
+        current = self.command("HGET", key, "version")
+        if int(current or 0) != version:
+            self.command("UNWATCH")
+            return False
+        self.command("MULTI")
+        self.command("DEL", key)
+        return self.command("EXEC") is not None
+
+    def hset(self, name: str, field: str, value: str) -> None:
+        self.command("HSET", self.prefix + name, field, value)
+
+    def hdel(self, name: str, field: str) -> None:
+        self.command("HDEL", self.prefix + name, field)
+
+    def hgetall(self, name: str) -> Dict[str, str]:
+        items: List[bytes] = self.command("HGETALL", self.prefix + name)
+        return {items[i].decode(): items[i + 1].decode() for i in range(0, len(items), 2)}
+
+    def hlen(self, name: str) -> int:
+        return self.command("HLEN", self.prefix + name)
+
+    def size(self) -> int:
+        info: bytes = self.command("INFO", "memory")
+        for line in info.decode().splitlines():
+            if line.startswith("used_memory:"):
+                return int(line.split(":")[1])
+        return 0
+
+
+def create_backend(backend_url: str) -> StateBackend:
+    """
+    Creates storage of user states by its url:
+        vedis:path/to/file.dbv
+        sqlite:path/to/file.sqlite
+        redis://host:port/db
+
+    :param backend_url: url of storage.
+    :type backend_url: str
+    :return: storage of user states.
+    :rtype: StateBackend
+    :raise ValueError: if url scheme is unknown.
+    """
+
+    scheme, path = backend_url.split(":", 1)
+    if scheme == "vedis":
+        return VedisBackend(path=path)
+    if scheme == "sqlite":
+        return SQLiteBackend(path=path)
+    if scheme == "redis":
+        parsed = urlparse(backend_url)
+        return RedisBackend(host=parsed.hostname or "localhost",
+                            port=parsed.port or 6379,
+                            db=int(parsed.path.strip("/") or 0))
+    raise ValueError(f"unknown state backend {backend_url}")
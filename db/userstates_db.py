@@ -1,60 +1,363 @@
 """
-Creation and edition of user's state in DB (Vedis)
+Creation and edition of user's state in DB (Vedis, SQLite or Redis, see db.state_backends)
 """
 
-from typing import Optional
-from vedis import Vedis
+from typing import Optional, List, Dict, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import time, monotonic
+from src.metrics import increment, increment_for_stage, observe_for_stage
+from src.tracing import span
+from db.state_backends import create_backend, StateBackend, StateConflictError
+from bot_settings import STATE_BACKEND
+from threading import Lock, RLock
+import logging
 import pickle
 import codecs
 
-db_name = 'db/user_states.dbv'
+logger = logging.getLogger(__name__)
 
+backend: Optional[StateBackend] = None
+backend_lock = Lock()
+next_steps_hash = 'next_steps'
+touched_hash = 'touched'
+compacted_hash = 'compacted'
 
-def update_user_state(user: 'UserRequest') -> None:
+
+def get_backend() -> StateBackend:
+    """
+    Returns storage of user states. The storage is created on the first call
+    (so importing of bot modules doesn't open DB files or connections).
+
+    :return: storage of user states (see STATE_BACKEND in bot_settings).
+    :rtype: StateBackend
+    """
+
+    global backend
+    if backend is None:
+        with backend_lock:
+            if backend is None:
+                backend = create_backend(STATE_BACKEND)
+    return backend
+
+
+class UnitOfWork:
+    """
+    User states loaded, changed and removed while handling one update.
+    Every state is loaded from DB once and all changed states are written (removed states are deleted)
+    once when the unit of work is finished.
+
+    Args:
+        :users (Dict[int, UserRequest]):   loaded or created users by their id.
+        :dirty (Dict[int, bool]):   ids of users which have to be written to DB.
+            Value is True if user's state is compacted.
+        :versions (Dict[int, int]):   versions of loaded states. A state won't be written
+            if it was changed by another process after loading.
+        :removed (Dict[int, Optional[int]]):   ids of users whose states have to be deleted from DB
+            with versions of their states (None if the state wasn't loaded).
+        :loads (int):   number of states loaded from DB.
+        :stores (int):   number of states written to DB.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, 'UserRequest'] = dict()
+        self.dirty: Dict[int, bool] = dict()
+        self.versions: Dict[int, int] = dict()
+        self.removed: Dict[int, Optional[int]] = dict()
+        self.loads: int = 0
+        self.stores: int = 0
+
+    def flush(self) -> None:
+        """
+        Deletes removed states and writes all changed states to DB. A state created again
+        after removal is written after the old one is deleted.
+
+        :return: None
+        :raise StateConflictError: if any of states was changed by another process.
+            Other states are written anyway.
+        """
+
+        conflicts = []
+        for user_id, version in self.removed.items():
+            if not _delete_user_state(user_id=user_id, version=version):
+                conflicts.append(user_id)
+                self.dirty.pop(user_id, None)
+        self.removed = dict()
+        for user_id, compacted in self.dirty.items():
+            version = self.versions.get(user_id)
+            if _write_user_state(user=self.users[user_id], compacted=compacted, version=version):
+                self.stores += 1
+                if version is not None:
+                    self.versions[user_id] = version + 1
+            else:
+                conflicts.append(user_id)
+        self.dirty = dict()
+        if conflicts:
+            raise StateConflictError(key=", ".join(str(user_id) for user_id in conflicts))
+
+
+current_unit: ContextVar[Optional[UnitOfWork]] = ContextVar("current_unit", default=None)
+
+user_locks: Dict[int, List] = dict()
+user_locks_lock = Lock()
+
+
+@contextmanager
+def user_lock(user_id: int) -> Iterator[None]:
+    """
+    Context manager to handle updates of one user in this process one by one.
+    The next update of the user waits until the state changed by previous update is written,
+    so fast answers of the user don't conflict with each other (versions of states only protect
+    states from other processes). The lock is reentrant, so a handler may call another handler
+    of the same user in its thread.
+
+    :param user_id: id of user.
+    :type user_id: int
+    :return: None
+    """
+
+    with user_locks_lock:
+        entry = user_locks.setdefault(user_id, [RLock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with user_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del user_locks[user_id]
+
+
+@contextmanager
+def unit_of_work() -> Iterator[UnitOfWork]:
+    """
+    Context manager to handle one update in single unit of work.
+    Nested calls join the outer unit of work. Changed states are written only if the unit of work
+    is finished without error, so a failed handler doesn't leave partially changed state.
+
+    :return: current unit of work.
+    :rtype: Iterator[UnitOfWork]
+    """
+
+    unit = current_unit.get()
+    if unit:
+        yield unit
+        return
+
+    unit = UnitOfWork()
+    token = current_unit.set(unit)
+    try:
+        yield unit
+        unit.flush()
+    finally:
+        current_unit.reset(token)
+        increment("user_states.updates")
+        increment("user_states.loads", unit.loads)
+        increment("user_states.stores", unit.stores)
+        logger.debug("user states per update: %s loads, %s stores", unit.loads, unit.stores)
+
+
+def update_user_state(user: 'UserRequest', touch: bool = True, compacted: bool = False) -> None:
     """
     Writes user state to DB.
+    Inside unit of work the state will be written when the unit of work is finished.
 
     :param user: User which will be written to DB.
     :type user: UserRequest
+    :param touch: True if last touch time has to be updated.
+    :type touch: bool
+    :param compacted: True if compacted state is written.
+    :type compacted: bool
+    :return: None
+    """
+
+    if touch:
+        user.last_touched = time()
+    increment_for_stage("stage.state_updates")
+    unit = current_unit.get()
+    if unit:
+        unit.users[user.user_id] = user
+        unit.dirty[user.user_id] = compacted
+    else:
+        _write_user_state(user=user, compacted=compacted)
+
+
+def remember_user_state(user: 'UserRequest') -> None:
+    """
+    Adds just created user to current unit of work (if it exists) without writing it to DB.
+
+    :param user: just created user.
+    :type user: UserRequest
     :return: None
     """
 
+    unit = current_unit.get()
+    if unit:
+        unit.users[user.user_id] = user
+
+
+def _write_user_state(user: 'UserRequest', compacted: bool, version: Optional[int] = None) -> bool:
+    """
+    Writes user state to DB if its version in DB equals passed version
+    (unconditionally if version is None).
+    Keeps expiration time of user's next step in next_steps hash
+    to sweep expired steps without reading all states.
+    Keeps last touch time of active sessions in touched hash
+    and of compacted sessions in compacted hash to sweep idle sessions.
+
+    :param user: User which will be written to DB.
+    :type user: UserRequest
+    :param compacted: True if compacted state is written.
+    :type compacted: bool
+    :param version: expected version of state in DB.
+    :type version: Optional[int]
+    :return: True if the state was written.
+    :rtype: bool
+    """
+
     _id = str(user.user_id)
-    pickled_user = codecs.encode(pickle.dumps(user), "base64").decode()
-    with Vedis(db_name) as db:
-        db[_id] = pickled_user
+    store = get_backend()
+    start = monotonic()
+    with span("state.store", user_id=user.user_id, backend=type(store).__name__) as current:
+        pickled_user = codecs.encode(pickle.dumps(user), "base64")
+        if not store.set(_id, pickled_user, version):
+            if current:
+                current.attributes["conflict"] = True
+            return False
+        if compacted:
+            store.hset(compacted_hash, _id, str(user.last_touched))
+            store.hdel(touched_hash, _id)
+        else:
+            store.hset(touched_hash, _id, str(user.last_touched))
+            store.hdel(compacted_hash, _id)
+        if user.next_step:
+            store.hset(next_steps_hash, _id, str(user.next_step_expires))
+        else:
+            store.hdel(next_steps_hash, _id)
+    increment_for_stage("stage.state_stores")
+    observe_for_stage("stage.state_io_latency", monotonic() - start)
+    return True
 
 
 def get_user_state_from_db(user_id: int) -> Optional['UserRequest']:
     """
-    Tries to find UserRequest instance in Vedis DB by their id.
+    Tries to find UserRequest instance in DB by their id.
     Returns UserRequest instance if it was found.
+    Inside unit of work the state is loaded from DB only once.
 
     :param user_id: id of UserRequest instance.
     :type user_id: int
     :return: UserRequest instance if it was found.
     """
 
-    with Vedis(db_name) as db:
-        try:
-            user_instance = pickle.loads(codecs.decode(db[str(user_id)].decode().encode(), "base64"))
-            return user_instance
-        except KeyError:
-            return False
+    unit = current_unit.get()
+    if unit and user_id in unit.users:
+        return unit.users[user_id]
+    if unit and user_id in unit.removed:
+        return False
+
+    start = monotonic()
+    store = get_backend()
+    with span("state.load", user_id=user_id, backend=type(store).__name__):
+        pickled_user, version = store.get(str(user_id))
+    increment_for_stage("stage.state_loads")
+    if unit:
+        unit.loads += 1
+        unit.versions[user_id] = version
+    if pickled_user is None:
+        return False
+    user_instance = pickle.loads(codecs.decode(pickled_user, "base64"))
+    observe_for_stage("stage.state_io_latency", monotonic() - start)
+    if unit:
+        unit.users[user_id] = user_instance
+    return user_instance
 
 
 def remove_user_state_from_db(user_id: int) -> None:
     """
-    Tries to delete UserRequest instance from Vedis DB by their id.
+    Tries to delete UserRequest instance from DB by their id.
+    Inside unit of work the state will be deleted when the unit of work is finished
+    (if the state wasn't changed by another process after loading).
 
     :param user_id: id of UserRequest instance.
     :type user_id: int
     :return: None
     """
 
-    with Vedis(db_name) as db:
-        try:
-            del db[str(user_id)]
-        except KeyError:
-            return
+    unit = current_unit.get()
+    if unit:
+        unit.users.pop(user_id, None)
+        unit.dirty.pop(user_id, None)
+        if user_id not in unit.removed:
+            unit.removed[user_id] = unit.versions.get(user_id)
+        unit.versions[user_id] = 0
+    else:
+        _delete_user_state(user_id=user_id)
+
+
+def _delete_user_state(user_id: int, version: Optional[int] = None) -> bool:
+    """
+    Deletes user state from DB if its version in DB equals passed version
+    (unconditionally if version is None) and removes the user from sweeping hashes.
+
+    :param user_id: id of UserRequest instance.
+    :type user_id: int
+    :param version: expected version of state in DB.
+    :type version: Optional[int]
+    :return: True if the state was deleted.
+    :rtype: bool
+    """
+
+    store = get_backend()
+    if not store.delete(str(user_id), version):
+        return False
+    for hash_name in (next_steps_hash, touched_hash, compacted_hash):
+        store.hdel(hash_name, str(user_id))
+    return True
+
+
+def get_expired_next_steps(timestamp: float) -> List[int]:
+    """
+    Finds ids of users whose next step expired before passed timestamp.
+
+    :param timestamp: time to compare with next steps expiration time.
+    :type timestamp: float
+    :return: list with ids of users with expired next step.
+    :rtype: List[int]
+    """
+
+    next_steps = get_backend().hgetall(next_steps_hash)
+    return [int(user_id) for user_id, expires in next_steps.items() if float(expires) < timestamp]
+
+
+def get_idle_users(timestamp: float, compacted: bool = False) -> List[int]:
+    """
+    Finds ids of users whose sessions weren't touched since passed timestamp.
+
+    :param timestamp: time to compare with last touch time of sessions.
+    :type timestamp: float
+    :param compacted: True to search among compacted sessions, False - among active ones.
+    :type compacted: bool
+    :return: list with ids of users with idle sessions.
+    :rtype: List[int]
+    """
+
+    sessions = get_backend().hgetall(compacted_hash if compacted else touched_hash)
+    return [int(user_id) for user_id, touched in sessions.items() if float(touched) < timestamp]
+
+
+def get_store_size() -> Dict[str, int]:
+    """
+    Counts sessions in DB and measures size of DB.
+
+    :return: dict with numbers of active and compacted sessions and size of DB in bytes.
+    :rtype: Dict[str, int]
+    """
 
+    store = get_backend()
+    return {
+        "sessions": store.hlen(touched_hash),
+        "compacted_sessions": store.hlen(compacted_hash),
+        "size": store.size()
+    }
@@ -0,0 +1,378 @@
+"""
+Local stand-in for hotels4 rapidapi to run the bot and load tests without rapidapi key.
+Implements endpoints used by src.hotels_api: locations/v2/search, properties/list and
+properties/get-hotel-photos. Responses are taken from fixtures (recorded responses)
+or generated (synthetic responses are the same for the same request).
+
+Fixtures are kept in directory with a subdirectory for every endpoint
+('locations_v2_search', 'properties_list', 'properties_get-hotel-photos'):
+    <endpoint>/<request hash>.json - response to the request with the same params;
+    <endpoint>.json - response to any request to the endpoint.
+With --record requests which have no fixture are sent to rapidapi (with rapidapi
+headers of the bot) and responses are saved as fixtures.
+
+Usage:
+    python -m loadtest.fake_hotels_api --port 8081 --latency 0.3 --jitter 0.2 --error-rate 0.05
+    python -m loadtest.fake_hotels_api --fixtures loadtest/fixtures --record https://hotels4.p.rapidapi.com/
+
+Set HOTELS_API_URL = "http://localhost:8081/" in bot_settings.py to use the server.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from hashlib import sha1
+from math import ceil
+from threading import Lock, Thread
+from time import sleep
+from typing import Dict, Any, Optional, Tuple
+import argparse
+import json
+import os
+import random
+import requests
+
+
+endpoints = ("locations/v2/search", "properties/list", "properties/get-hotel-photos")
+
+streets = ("Тверская", "Арбат", "Невский проспект", "Main Street", "Rue de Rivoli", "Via del Corso")
+photo_url = "https://images.example.com/hotels/{0}/{1}_{{size}}.jpg"
+
+
+class FakeHotelsHandler(BaseHTTPRequestHandler):
+    """
+    Handles one request to fake rapidapi.
+    """
+
+    server: 'FakeHotelsServer'
+
+    def do_GET(self) -> None:
+        parts = urlsplit(self.path)
+        endpoint = parts.path.strip("/")
+        querystring = dict(parse_qsl(parts.query))
+        status, body = self.server.respond(endpoint=endpoint,
+                                           querystring=querystring,
+                                           request_headers=dict(self.headers))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Requests-Limit", str(self.server.monthly))
+        self.send_header("X-RateLimit-Requests-Remaining", str(self.server.monthly))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakeHotelsServer(ThreadingHTTPServer):
+    """
+    Fake hotels4 rapidapi server. Port 0 means any free port (see server_address after creation).
+
+    Args:
+        :latency (float):   min delay of response in seconds.
+        :jitter (float):   max random addition to delay in seconds.
+        :error_rate (float):   share of requests answered with error_status.
+        :error_status (int):   status code of failed requests.
+        :hotels (int):   max number of hotels in synthetic hotels list.
+        :padding (int):   size in bytes of extra field in every synthetic hotel (to make payload bigger).
+        :fixtures (Optional[str]):   directory with fixtures.
+        :record (Optional[str]):   rapidapi url to get and save responses which have no fixtures.
+        :monthly (int):   value of rate limit headers (big enough not to stop the bot's quota manager).
+        :stats (Dict[str, int]):   number of requests by endpoint and number of errors.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "localhost", port: int = 0, latency: float = 0, jitter: float = 0,
+                 error_rate: float = 0, error_status: int = 500, hotels: int = 25, padding: int = 0,
+                 fixtures: Optional[str] = None, record: Optional[str] = None,
+                 monthly: int = 10 ** 9, seed: int = 0, verbose: bool = False):
+        super().__init__((host, port), FakeHotelsHandler)
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.error_rate: float = error_rate
+        self.error_status: int = error_status
+        self.hotels: int = hotels
+        self.padding: int = padding
+        self.fixtures: Optional[str] = fixtures
+        self.record: Optional[str] = record
+        self.monthly: int = monthly
+        self.seed: int = seed
+        self.verbose: bool = verbose
+        self.random = random.Random(seed)
+        self.stats: Dict[str, int] = dict()
+        self.lock = Lock()
+
+    @property
+    def url(self) -> str:
+        """
+        Base url of the server (value for HOTELS_API_URL).
+        """
+
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> 'FakeHotelsServer':
+        """
+        Starts serving in daemon thread.
+
+        :return: the server.
+        :rtype: FakeHotelsServer
+        """
+
+        Thread(target=self.serve_forever, name="fake_hotels_api", daemon=True).start()
+        return self
+
+    def count(self, name: str) -> None:
+        """
+        Increases stats counter.
+
+        :param name: name of counter.
+        :type name: str
+        :return: None
+        """
+
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def respond(self, endpoint: str, querystring: Dict[str, str],
+                request_headers: Dict[str, str]) -> Tuple[int, bytes]:
+        """
+        Creates response to request: waits for latency, fails with error rate,
+        takes response from fixtures or generates it.
+
+        :param endpoint: requested endpoint.
+        :type endpoint: str
+        :param querystring: request params.
+        :type querystring: Dict[str, str]
+        :param request_headers: request headers (rapidapi headers are used in record mode).
+        :type request_headers: Dict[str, str]
+        :return: status code and body of response.
+        :rtype: Tuple[int, bytes]
+        """
+
+        if endpoint not in endpoints:
+            self.count("not_found")
+            return 404, b'{"message": "Endpoint does not exist"}'
+        self.count(endpoint)
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+        sleep(delay)
+        if failed:
+            self.count("errors")
+            return self.error_status, b'{"message": "Fake error"}'
+
+        body = self.read_fixture(endpoint=endpoint, querystring=querystring)
+        if body is None and self.record:
+            body = self.record_fixture(endpoint=endpoint, querystring=querystring,
+                                       request_headers=request_headers)
+        if body is None:
+            body = json.dumps(generators[endpoint](self, querystring), ensure_ascii=False).encode()
+        return 200, body
+
+    def fixture_path(self, endpoint: str, querystring: Optional[Dict[str, str]] = None) -> str:
+        """
+        Returns path of fixture for request (or for endpoint if querystring isn't passed).
+
+        :param endpoint: requested endpoint.
+        :type endpoint: str
+        :param querystring: request params.
+        :type querystring: Optional[Dict[str, str]]
+        :return: path of fixture.
+        :rtype: str
+        """
+
+        name = endpoint.replace("/", "_")
+        if querystring is None:
+            return os.path.join(self.fixtures, f"{name}.json")
+        request_hash = sha1(urlencode(sorted(querystring.items())).encode()).hexdigest()[:16]
+        return os.path.join(self.fixtures, name, f"{request_hash}.json")
+
+    def read_fixture(self, endpoint: str, querystring: Dict[str, str]) -> Optional[bytes]:
+        """
+        Finds fixture for request.
+
+        :param endpoint: requested endpoint.
+        :type endpoint: str
+        :param querystring: request params.
+        :type querystring: Dict[str, str]
+        :return: body of response or None if there is no fixture.
+        :rtype: Optional[bytes]
+        """
+
+        if not self.fixtures:
+            return None
+        for path in (self.fixture_path(endpoint, querystring), self.fixture_path(endpoint)):
+            if os.path.exists(path):
+                self.count("fixtures")
+                with open(path, "rb") as file:
+                    return file.read()
+
+    def record_fixture(self, endpoint: str, querystring: Dict[str, str],
+                       request_headers: Dict[str, str]) -> Optional[bytes]:
+        """
+        Gets response from rapidapi and saves it as fixture of request.
+
+        :param endpoint: requested endpoint.
+        :type endpoint: str
+        :param querystring: request params.
+        :type querystring: Dict[str, str]
+        :param request_headers: request headers with rapidapi key.
+        :type request_headers: Dict[str, str]
+        :return: body of response or None if rapidapi didn't answer successfully.
+        :rtype: Optional[bytes]
+        """
+
+        rapidapi_headers = {key: value for key, value in request_headers.items()
+                            if key.lower().startswith("x-rapidapi")}
+        try:
+            response = requests.get(self.record + endpoint, params=querystring,
+                                    headers=rapidapi_headers, timeout=30)
+        except requests.exceptions.RequestException:
+            return None
+        if response.status_code != requests.codes.ok:
+            return None
+        path = self.fixture_path(endpoint, querystring)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(response.content)
+        self.count("recorded")
+        return response.content
+
+    def request_random(self, *values: Any) -> random.Random:
+        """
+        Returns random generator which gives the same values for the same request.
+
+        :return: random generator.
+        :rtype: random.Random
+        """
+
+        return random.Random(sha1(repr((self.seed, ) + values).encode()).hexdigest())
+
+    def generate_locations(self, querystring: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Generates response of locations/v2/search.
+
+        :param querystring: request params.
+        :type querystring: Dict[str, str]
+        :return: response.
+        :rtype: Dict[str, Any]
+        """
+
+        query = querystring.get("query", "")
+        rnd = self.request_random("locations", query.lower())
+        entities = []
+        for i, region in enumerate(("", "Центр", "Аэропорт")[:rnd.randint(1, 3)]):
+            name = f"{query.title()} {region}".strip()
+            entities.append({
+                "geoId": str(rnd.randint(10 ** 5, 10 ** 6)),
+                "destinationId": str(rnd.randint(10 ** 5, 10 ** 7)),
+                "caption": f"<span class='highlighted'>{query.title()}</span> {region}".strip(),
+                "name": name,
+                "type": "CITY" if i == 0 else "NEIGHBORHOOD"
+            })
+        return {"term": query, "suggestions": [{"group": "CITY_GROUP", "entities": entities}]}
+
+    def generate_hotels(self, querystring: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Generates response of properties/list. Price filter and sort order of request are applied.
+
+        :param querystring: request params.
+        :type querystring: Dict[str, str]
+        :return: response.
+        :rtype: Dict[str, Any]
+        """
+
+        destination_id = querystring.get("destinationId", "")
+        rnd = self.request_random("hotels", destination_id, querystring.get("checkIn"))
+        hotels = []
+        for i in range(self.hotels):
+            hotel_id = int(destination_id) * 100 + i if destination_id.isdigit() else rnd.randint(10 ** 5, 10 ** 7)
+            hotel = {
+                "id": hotel_id,
+                "name": f"Hotel {destination_id}-{i + 1}",
+                "starRating": rnd.choice((1, 2, 3, 3.5, 4, 4.5, 5)),
+                "address": {
+                    "locality": f"City {destination_id}",
+                    "streetAddress": f"{rnd.choice(streets)}, {rnd.randint(1, 200)}"
+                },
+                "landmarks": [{
+                    "label": "Центр города",
+                    "distance": f"{rnd.uniform(0.1, 15):.1f} км".replace(".", ",")
+                }],
+                "ratePlan": {"price": {"exactCurrent": round(rnd.uniform(20, 500), 2)}}
+            }
+            hotel["ratePlan"]["price"]["current"] = f"${ceil(hotel['ratePlan']['price']['exactCurrent'])}"
+            if self.padding:
+                hotel["padding"] = "x" * self.padding
+            hotels.append(hotel)
+
+        if "priceMin" in querystring or "priceMax" in querystring:
+            price_min = float(querystring.get("priceMin", 0))
+            price_max = float(querystring.get("priceMax", float("inf")))
+            hotels = [hotel for hotel in hotels
+                      if price_min <= hotel["ratePlan"]["price"]["exactCurrent"] <= price_max]
+        hotels.sort(key=lambda hotel: hotel["ratePlan"]["price"]["exactCurrent"],
+                    reverse=querystring.get("sortOrder") == "PRICE_HIGHEST_FIRST")
+        hotels = hotels[:int(querystring.get("pageSize", 25))]
+        return {
+            "result": "OK",
+            "data": {"body": {"searchResults": {"totalCount": len(hotels), "results": hotels}}}
+        }
+
+    def generate_photos(self, querystring: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Generates response of properties/get-hotel-photos.
+
+        :param querystring: request params.
+        :type querystring: Dict[str, str]
+        :return: response.
+        :rtype: Dict[str, Any]
+        """
+
+        hotel_id = querystring.get("id", "")
+        rnd = self.request_random("photos", hotel_id)
+        return {
+            "hotelId": hotel_id,
+            "hotelImages": [{"imageId": i, "baseUrl": photo_url.format(hotel_id, i)}
+                            for i in range(rnd.randint(3, 10))],
+            "roomImages": [{"roomId": 1, "images": [{"imageId": 100 + i, "baseUrl": photo_url.format(hotel_id, 100 + i)}
+                                                    for i in range(rnd.randint(0, 5))]}]
+        }
+
+
+generators = {
+    "locations/v2/search": FakeHotelsServer.generate_locations,
+    "properties/list": FakeHotelsServer.generate_hotels,
+    "properties/get-hotel-photos": FakeHotelsServer.generate_photos
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake hotels4 rapidapi server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="min delay of response in seconds")
+    parser.add_argument("--jitter", type=float, default=0, help="max random addition to delay in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of failed requests")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--hotels", type=int, default=25, help="number of hotels in synthetic list")
+    parser.add_argument("--padding", type=int, default=0, help="extra bytes in every synthetic hotel")
+    parser.add_argument("--fixtures", help="directory with recorded responses")
+    parser.add_argument("--record", help="rapidapi url to record responses which have no fixtures")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    options = parser.parse_args()
+    if options.record and not options.fixtures:
+        parser.error("--record requires --fixtures")
+    with FakeHotelsServer(host=options.host, port=options.port, latency=options.latency,
+                          jitter=options.jitter, error_rate=options.error_rate,
+                          error_status=options.error_status, hotels=options.hotels,
+                          padding=options.padding, fixtures=options.fixtures,
+                          record=options.record, seed=options.seed,
+                          verbose=options.verbose) as server:
+        print(f"Fake hotels api is serving at {server.url}")
+        server.serve_forever()
@@ -0,0 +1,220 @@
+"""
+Local Redis-compatible server (RESP protocol) to check RedisBackend without real Redis.
+Supports commands used by db.state_backends.RedisBackend.
+
+Usage:
+    python -m loadtest.fake_redis --port 6380
+"""
+
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from threading import Lock, Thread
+from typing import Dict, List, Any, Optional
+import argparse
+
+
+class FakeRedisStore:
+    """
+    In-memory data of fake server.
+
+    Args:
+        :hashes (Dict[bytes, Dict[bytes, bytes]]):   Redis hashes by their keys.
+        :modifications (Dict[bytes, int]):   number of modifications of every key (to implement WATCH).
+    """
+
+    def __init__(self):
+        self.hashes: Dict[bytes, Dict[bytes, bytes]] = dict()
+        self.modifications: Dict[bytes, int] = dict()
+        self.lock = Lock()
+
+    def touch(self, key: bytes) -> None:
+        """
+        Registers modification of key.
+
+        :param key: modified key.
+        :type key: bytes
+        :return: None
+        """
+
+        self.modifications[key] = self.modifications.get(key, 0) + 1
+
+    def execute(self, command: bytes, args: List[bytes]) -> Any:
+        """
+        Executes one command. Must be called under lock.
+
+        :param command: command name in upper case.
+        :type command: bytes
+        :param args: command arguments.
+        :type args: List[bytes]
+        :return: reply of command.
+        :raise ValueError: if command is unknown.
+        """
+
+        if command == b"PING":
+            return "PONG"
+        if command == b"SELECT":
+            return "OK"
+        if command == b"HSET":
+            data = self.hashes.setdefault(args[0], dict())
+            new_fields = 0
+            for i in range(1, len(args), 2):
+                new_fields += args[i] not in data
+                data[args[i]] = args[i + 1]
+            self.touch(args[0])
+            return new_fields
+        if command == b"HINCRBY":
+            data = self.hashes.setdefault(args[0], dict())
+            value = int(data.get(args[1], 0)) + int(args[2])
+            data[args[1]] = str(value).encode()
+            self.touch(args[0])
+            return value
+        if command == b"HGET":
+            return self.hashes.get(args[0], dict()).get(args[1])
+        if command == b"HMGET":
+            data = self.hashes.get(args[0], dict())
+            return [data.get(field) for field in args[1:]]
+        if command == b"HDEL":
+            data = self.hashes.get(args[0], dict())
+            deleted = sum(data.pop(field, None) is not None for field in args[1:])
+            if deleted:
+                self.touch(args[0])
+            return deleted
+        if command == b"HGETALL":
+            return [item for pair in self.hashes.get(args[0], dict()).items() for item in pair]
+        if command == b"HLEN":
+            return len(self.hashes.get(args[0], dict()))
+        if command == b"DEL":
+            deleted = 0
+            for key in args:
+                if self.hashes.pop(key, None) is not None:
+                    deleted += 1
+                    self.touch(key)
+            return deleted
+        if command == b"FLUSHALL":
+            for key in list(self.hashes):
+                self.touch(key)
+            self.hashes = dict()
+            return "OK"
+        if command == b"INFO":
+            used_memory = sum(len(key) + sum(len(f) + len(v) for f, v in data.items())
+                              for key, data in self.hashes.items())
+            return f"# Memory\r\nused_memory:{used_memory}\r\n".encode()
+        raise ValueError(f"unknown command '{command.decode()}'")
+
+
+class FakeRedisHandler(StreamRequestHandler):
+    """
+    Handles one client connection. Keeps WATCH and MULTI state of the connection.
+    """
+
+    def handle(self) -> None:
+        store: FakeRedisStore = self.server.store
+        watched: Dict[bytes, int] = dict()
+        queued: Optional[List[List[bytes]]] = None
+        while True:
+            request = self.read_request()
+            if request is None:
+                return
+            command, args = request[0].upper(), request[1:]
+            try:
+                if command == b"WATCH":
+                    with store.lock:
+                        for key in args:
+                            watched[key] = store.modifications.get(key, 0)
+                    reply = "OK"
+                elif command == b"UNWATCH":
+                    watched = dict()
+                    reply = "OK"
+                elif command == b"MULTI":
+                    queued = []
+                    reply = "OK"
+                elif command == b"DISCARD":
+                    queued, watched = None, dict()
+                    reply = "OK"
+                elif command == b"EXEC":
+                    with store.lock:
+                        if any(store.modifications.get(key, 0) != count for key, count in watched.items()):
+                            reply = None
+                        else:
+                            reply = [store.execute(cmd[0].upper(), cmd[1:]) for cmd in queued or []]
+                    queued, watched = None, dict()
+                elif queued is not None:
+                    queued.append(request)
+                    reply = "QUEUED"
+                else:
+                    with store.lock:
+                        reply = store.execute(command, args)
+            except (ValueError, IndexError) as error:
+                reply = error
+            self.wfile.write(self.encode(reply))
+
+    def read_request(self) -> Optional[List[bytes]]:
+        """
+        Reads one command in RESP array format.
+
+        :return: command name and arguments or None if connection was closed.
+        :rtype: Optional[List[bytes]]
+        """
+
+        line = self.rfile.readline()
+        if not line:
+            return None
+        parts = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            parts.append(self.rfile.read(length + 2)[:-2])
+        return parts
+
+    @classmethod
+    def encode(cls, reply: Any) -> bytes:
+        """
+        Encodes reply in RESP format.
+
+        :param reply: reply of command.
+        :return: encoded reply.
+        :rtype: bytes
+        """
+
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, Exception):
+            return f"-ERR {reply}\r\n".encode()
+        if isinstance(reply, str):
+            return f"+{reply}\r\n".encode()
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(cls.encode(item) for item in reply)
+
+
+class FakeRedisServer(ThreadingTCPServer):
+    """
+    Fake Redis server. Port 0 means any free port (see server_address after creation).
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "localhost", port: int = 0):
+        super().__init__((host, port), FakeRedisHandler)
+        self.store = FakeRedisStore()
+
+    def start(self) -> 'FakeRedisServer':
+        """
+        Starts serving in daemon thread.
+
+        :return: the server.
+        :rtype: FakeRedisServer
+        """
+
+        Thread(target=self.serve_forever, name="fake_redis", daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake Redis server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6380)
+    options = parser.parse_args()
+    with FakeRedisServer(host=options.host, port=options.port) as server:
+        server.serve_forever()
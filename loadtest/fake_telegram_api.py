@@ -0,0 +1,517 @@
+"""
+Local stand-in for Telegram Bot API to run the bot end-to-end without Telegram.
+Implements methods used by the bot: getMe, getUpdates, setWebhook, deleteWebhook, sendMessage,
+editMessageText, editMessageReplyMarkup, deleteMessage, sendMediaGroup, answerCallbackQuery
+and answerInlineQuery.
+Keeps all chats in memory, so virtual users (see loadtest.virtual_users) can read messages
+and press buttons.
+The bot is pointed at the server with telebot.apihelper.API_URL (see FakeTelegramServer.api_url).
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Thread
+from time import time, monotonic
+from typing import Dict, Any, Optional, List, Tuple, Callable
+import json
+import requests
+
+
+bot_user = {"id": 1, "is_bot": True, "first_name": "Hotels bot", "username": "fake_hotels_bot"}
+
+
+class ApiError(Exception):
+    """
+    Error which is returned to the bot as unsuccessful Bot API response.
+    """
+
+    def __init__(self, description: str, code: int = 400):
+        super().__init__(description)
+        self.code: int = code
+
+
+class Chat:
+    """
+    Private chat of a user with the bot.
+
+    Args:
+        :chat_id (int):   id of chat (same as user id).
+        :messages (Dict[int, Dict[str, Any]]):   current messages by id.
+        :answers (List[str]):   texts of callback query answers.
+        :inline_answers (List[List[Dict[str, Any]]]):   results of inline query answers.
+        :version (int):   number of changes made by the bot.
+        :bot_calls (int):   number of Bot API calls related to the chat.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id: int = chat_id
+        self.messages: Dict[int, Dict[str, Any]] = dict()
+        self.answers: List[str] = []
+        self.inline_answers: List[List[Dict[str, Any]]] = []
+        self.version: int = 0
+        self.bot_calls: int = 0
+
+    def buttons(self, prefix: str) -> List[Tuple[int, str]]:
+        """
+        Finds buttons of current messages which callback data starts with prefix.
+
+        :param prefix: prefix of callback data.
+        :type prefix: str
+        :return: list of pairs (message id, callback data), the latest messages first.
+        :rtype: List[Tuple[int, str]]
+        """
+
+        found = []
+        for message_id in sorted(self.messages, reverse=True):
+            markup = self.messages[message_id].get("reply_markup") or dict()
+            for row in markup.get("inline_keyboard", []):
+                for button in row:
+                    if button.get("callback_data", "").startswith(prefix):
+                        found.append((message_id, button["callback_data"]))
+        return found
+
+    def texts(self) -> List[str]:
+        """
+        Returns texts and captions of current messages (the oldest first).
+
+        :return: list of texts.
+        :rtype: List[str]
+        """
+
+        return [self.messages[message_id].get("text") or self.messages[message_id].get("caption") or ""
+                for message_id in sorted(self.messages)]
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """
+    Handles one Bot API request: /bot<token>/<method>.
+    Params are taken from query string and from urlencoded or json body.
+    """
+
+    server: 'FakeTelegramServer'
+
+    def do_GET(self) -> None:
+        self.handle_method()
+
+    def do_POST(self) -> None:
+        self.handle_method()
+
+    def handle_method(self) -> None:
+        parts = urlsplit(self.path)
+        method = parts.path.rsplit("/", 1)[-1]
+        params = dict(parse_qsl(parts.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+        try:
+            reply = {"ok": True, "result": self.server.call(method, params)}
+            status = 200
+        except ApiError as error:
+            reply = {"ok": False, "error_code": error.code, "description": str(error)}
+            status = error.code
+        except KeyError as error:
+            reply = {"ok": False, "error_code": 400, "description": f"Bad Request: {error.args[0]} is empty"}
+            status = 400
+        body = json.dumps(reply, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    Fake Telegram Bot API server. Port 0 means any free port (see server_address after creation).
+    Updates are pushed by push_message and push_callback and are got by the bot
+    with getUpdates or are posted to webhook url.
+
+    Args:
+        :chats (Dict[int, Chat]):   chats by id.
+        :updates (List[Dict[str, Any]]):   updates which weren't confirmed by the bot.
+        :stats (Dict[str, int]):   number of calls of every method.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "localhost", port: int = 0, verbose: bool = False):
+        super().__init__((host, port), FakeTelegramHandler)
+        self.verbose: bool = verbose
+        self.chats: Dict[int, Chat] = dict()
+        self.updates: List[Dict[str, Any]] = []
+        self.last_update_id: int = 0
+        self.last_message_id: int = 0
+        self.webhook: Optional[str] = None
+        self.webhook_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fake_webhook")
+        self.stats: Dict[str, int] = dict()
+        self.changed = Condition(Lock())
+        self.methods: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            "getMe": lambda params: bot_user,
+            "getUpdates": self.get_updates,
+            "setWebhook": self.set_webhook,
+            "deleteWebhook": self.delete_webhook,
+            "sendMessage": self.send_message,
+            "editMessageText": self.edit_message_text,
+            "editMessageReplyMarkup": self.edit_message_reply_markup,
+            "deleteMessage": self.delete_message,
+            "sendMediaGroup": self.send_media_group,
+            "answerCallbackQuery": self.answer_callback_query,
+            "answerInlineQuery": self.answer_inline_query
+        }
+
+    @property
+    def api_url(self) -> str:
+        """
+        Url template of the server (value for telebot.apihelper.API_URL).
+        """
+
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self) -> 'FakeTelegramServer':
+        """
+        Starts serving in daemon thread.
+
+        :return: the server.
+        :rtype: FakeTelegramServer
+        """
+
+        Thread(target=self.serve_forever, name="fake_telegram_api", daemon=True).start()
+        return self
+
+    def call(self, method: str, params: Dict[str, Any]) -> Any:
+        """
+        Executes Bot API method.
+
+        :param method: name of method.
+        :type method: str
+        :param params: params of method.
+        :type params: Dict[str, Any]
+        :return: result of method.
+        :raise ApiError: if method is unknown or params are wrong.
+        """
+
+        if method not in self.methods:
+            raise ApiError(f"Not Found: method {method} not found", code=404)
+        with self.changed:
+            self.stats[method] = self.stats.get(method, 0) + 1
+        if method in ("getMe", "getUpdates"):
+            return self.methods[method](params)
+        with self.changed:
+            result = self.methods[method](params)
+            self.changed.notify_all()
+        return result
+
+    def chat(self, chat_id: Any) -> Chat:
+        """
+        Returns chat by id (creates it if it doesn't exist). Must be called under lock.
+
+        :param chat_id: id of chat.
+        :return: the chat.
+        :rtype: Chat
+        """
+
+        chat_id = int(chat_id)
+        if chat_id not in self.chats:
+            self.chats[chat_id] = Chat(chat_id)
+        return self.chats[chat_id]
+
+    def find_message(self, params: Dict[str, Any]) -> Tuple[Chat, Dict[str, Any]]:
+        """
+        Finds message which is changed by the bot. Must be called under lock.
+
+        :param params: params of method with chat_id and message_id.
+        :type params: Dict[str, Any]
+        :return: chat and message.
+        :rtype: Tuple[Chat, Dict[str, Any]]
+        :raise ApiError: if message doesn't exist.
+        """
+
+        chat = self.chat(params["chat_id"])
+        message = chat.messages.get(int(params["message_id"]))
+        if message is None:
+            raise ApiError("Bad Request: message to edit not found")
+        chat.version += 1
+        chat.bot_calls += 1
+        return chat, message
+
+    def new_message(self, chat: Chat, sender: Dict[str, Any], **fields: Any) -> Dict[str, Any]:
+        """
+        Creates message in chat. Must be called under lock.
+
+        :param chat: the chat.
+        :type chat: Chat
+        :param sender: user which sent the message.
+        :type sender: Dict[str, Any]
+        :return: the message.
+        :rtype: Dict[str, Any]
+        """
+
+        self.last_message_id += 1
+        message = {
+            "message_id": self.last_message_id,
+            "from": sender,
+            "chat": {"id": chat.chat_id, "type": "private", "first_name": f"User {chat.chat_id}"},
+            "date": int(time())
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        chat.messages[message["message_id"]] = message
+        return message
+
+    @classmethod
+    def parse_markup(cls, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Gets reply_markup param.
+
+        :param params: params of method.
+        :type params: Dict[str, Any]
+        :return: reply markup or None.
+        :rtype: Optional[Dict[str, Any]]
+        """
+
+        markup = params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup) if markup else None
+        return markup or None
+
+    def send_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat = self.chat(params["chat_id"])
+        chat.version += 1
+        chat.bot_calls += 1
+        return self.new_message(chat, bot_user, text=params["text"], reply_markup=self.parse_markup(params))
+
+    def send_media_group(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        chat = self.chat(params["chat_id"])
+        chat.version += 1
+        chat.bot_calls += 1
+        media = params["media"]
+        if isinstance(media, str):
+            media = json.loads(media)
+        if not 2 <= len(media) <= 10:
+            raise ApiError("Bad Request: wrong number of messages to send")
+        messages = []
+        for item in media:
+            photo = [{"file_id": item["media"], "file_unique_id": str(abs(hash(item["media"]))),
+                      "width": 1280, "height": 960}]
+            messages.append(self.new_message(chat, bot_user, photo=photo, caption=item.get("caption")))
+        return messages
+
+    def edit_message_text(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat, message = self.find_message(params)
+        markup = self.parse_markup(params)
+        if message.get("text") == params["text"] and message.get("reply_markup") == markup:
+            raise ApiError("Bad Request: message is not modified: specified new message content "
+                           "and reply markup are exactly the same as a current content and reply "
+                           "markup of the message")
+        message["text"] = params["text"]
+        message.pop("reply_markup", None)
+        if markup:
+            message["reply_markup"] = markup
+        message["edit_date"] = int(time())
+        return message
+
+    def edit_message_reply_markup(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat, message = self.find_message(params)
+        markup = self.parse_markup(params)
+        if message.get("reply_markup") == markup:
+            raise ApiError("Bad Request: message is not modified: specified new message content "
+                           "and reply markup are exactly the same as a current content and reply "
+                           "markup of the message")
+        message.pop("reply_markup", None)
+        if markup:
+            message["reply_markup"] = markup
+        message["edit_date"] = int(time())
+        return message
+
+    def delete_message(self, params: Dict[str, Any]) -> bool:
+        chat = self.chat(params["chat_id"])
+        chat.version += 1
+        chat.bot_calls += 1
+        if chat.messages.pop(int(params["message_id"]), None) is None:
+            raise ApiError("Bad Request: message to delete not found")
+        return True
+
+    def answer_callback_query(self, params: Dict[str, Any]) -> bool:
+        for chat in self.chats.values():
+            if params["callback_query_id"].startswith(f"{chat.chat_id}:"):
+                chat.answers.append(params.get("text", ""))
+                chat.version += 1
+                chat.bot_calls += 1
+        return True
+
+    def answer_inline_query(self, params: Dict[str, Any]) -> bool:
+        results = params.get("results") or []
+        if isinstance(results, str):
+            results = json.loads(results)
+        for chat in self.chats.values():
+            if params["inline_query_id"].startswith(f"{chat.chat_id}:"):
+                chat.inline_answers.append(results)
+                chat.version += 1
+                chat.bot_calls += 1
+        return True
+
+    def set_webhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook = params.get("url") or None
+        return True
+
+    def delete_webhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook = None
+        return True
+
+    def get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Returns updates with id >= offset. Waits for updates up to timeout seconds (long polling).
+        Updates with id < offset are confirmed and removed.
+
+        :param params: params of method (offset, limit, timeout).
+        :type params: Dict[str, Any]
+        :return: list of updates.
+        :rtype: List[Dict[str, Any]]
+        """
+
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        deadline = monotonic() + float(params.get("timeout", 0))
+        with self.changed:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates and monotonic() < deadline:
+                self.changed.wait(timeout=deadline - monotonic())
+            return self.updates[:limit]
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        """
+        Delivers update to the bot: adds it to updates queue or posts it to webhook.
+        Must be called under lock.
+
+        :param update: update without id.
+        :type update: Dict[str, Any]
+        :return: None
+        """
+
+        self.last_update_id += 1
+        update["update_id"] = self.last_update_id
+        if self.webhook:
+            self.webhook_executor.submit(requests.post, self.webhook, json=update, timeout=30)
+        else:
+            self.updates.append(update)
+        self.changed.notify_all()
+
+    def push_message(self, user_id: int, text: str) -> Dict[str, Any]:
+        """
+        Sends text message from user to the bot.
+
+        :param user_id: id of user.
+        :type user_id: int
+        :param text: text of message.
+        :type text: str
+        :return: the message.
+        :rtype: Dict[str, Any]
+        """
+
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "language_code": "ru"}
+        with self.changed:
+            message = self.new_message(self.chat(user_id), user, text=text)
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            self.push_update({"message": dict(message)})
+        return message
+
+    def push_callback(self, user_id: int, message_id: int, data: str) -> None:
+        """
+        Presses inline button of the bot's message.
+
+        :param user_id: id of user.
+        :type user_id: int
+        :param message_id: id of message with the button.
+        :type message_id: int
+        :param data: callback data of the button.
+        :type data: str
+        :return: None
+        :raise KeyError: if message doesn't exist.
+        """
+
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "language_code": "ru"}
+        with self.changed:
+            chat = self.chat(user_id)
+            self.push_update({"callback_query": {
+                "id": f"{user_id}:{self.last_update_id + 1}",
+                "from": user,
+                "message": json.loads(json.dumps(chat.messages[message_id])),
+                "chat_instance": str(user_id),
+                "data": data
+            }})
+
+    def push_inline_query(self, user_id: int, query: str) -> None:
+        """
+        Types inline query to the bot in the chat with it.
+
+        :param user_id: id of user.
+        :type user_id: int
+        :param query: text of query.
+        :type query: str
+        :return: None
+        """
+
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "language_code": "ru"}
+        with self.changed:
+            self.push_update({"inline_query": {
+                "id": f"{user_id}:{self.last_update_id + 1}",
+                "from": user,
+                "query": query,
+                "offset": "",
+                "chat_type": "private"
+            }})
+
+    def push_inline_result(self, user_id: int, result: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Chooses result of inline query: its message is sent to the chat on behalf of the user via the bot.
+
+        :param user_id: id of user.
+        :type user_id: int
+        :param result: result from answerInlineQuery.
+        :type result: Dict[str, Any]
+        :return: the message.
+        :rtype: Dict[str, Any]
+        """
+
+        user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "language_code": "ru"}
+        with self.changed:
+            message = self.new_message(self.chat(user_id), user, via_bot=bot_user,
+                                       text=result["input_message_content"]["message_text"])
+            self.push_update({"message": dict(message)})
+        return message
+
+    def wait_for(self, user_id: int, predicate: Callable[[Chat], Any], timeout: float) -> Any:
+        """
+        Waits until the bot changes the chat so that predicate returns true value.
+
+        :param user_id: id of user (chat).
+        :type user_id: int
+        :param predicate: function which checks the chat.
+        :type predicate: Callable[[Chat], Any]
+        :param timeout: max time to wait in seconds.
+        :type timeout: float
+        :return: value returned by predicate.
+        :raise TimeoutError: if the chat wasn't changed within timeout.
+        """
+
+        deadline = monotonic() + timeout
+        with self.changed:
+            while True:
+                result = predicate(self.chat(user_id))
+                if result:
+                    return result
+                if monotonic() >= deadline:
+                    raise TimeoutError
+                self.changed.wait(timeout=deadline - monotonic())
+
@@ -0,0 +1,566 @@
+"""
+End-to-end load test: virtual users play /lowprice, /highprice and /bestdeal scenarios
+(location, number of hotels, calendars, rooms with adults and children, price, distance, photos)
+with the bot which works with fake Telegram Bot API (loadtest.fake_telegram_api) and fake
+hotels api (loadtest.fake_hotels_api). The bot runs in this process with temporary DBs
+(or in worker processes of supervisor with --workers, see src.supervisor).
+Reports updates per second and latency of every scenario stage (from the user's update
+to the bot's answer which is expected by the scenario).
+
+Usage:
+    python -m loadtest.virtual_users --users 20 --scenarios 5 --hotels-latency 0.3
+    python -m loadtest.virtual_users --users 40 --scenarios 3 --workers 4
+"""
+
+from functools import partial
+from threading import Thread, Lock
+from time import monotonic, sleep
+from tempfile import mkdtemp
+from typing import Dict, Any, List, Tuple, Callable, Optional
+from loadtest.fake_telegram_api import FakeTelegramServer, Chat
+from loadtest.fake_hotels_api import FakeHotelsServer
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+
+
+commands = ("/lowprice", "/highprice", "/bestdeal")
+cities = ("Москва", "Санкт-Петербург", "Казань", "Сочи", "Paris", "Rome", "London", "Berlin")
+
+
+class ScenarioError(Exception):
+    """
+    The bot didn't answer as the scenario expects.
+    """
+
+    def __init__(self, stage: str, reason: str):
+        super().__init__(f"{stage}: {reason}")
+        self.stage: str = stage
+
+
+class LoadStats:
+    """
+    Results of load test.
+
+    Args:
+        :latencies (Dict[str, List[float]]):   latencies of answers by scenario stage.
+        :updates (int):   number of updates sent to the bot.
+        :completed (int):   number of completed scenarios.
+        :failed (Dict[str, int]):   number of failed scenarios by stage.
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = dict()
+        self.updates: int = 0
+        self.completed: int = 0
+        self.failed: Dict[str, int] = dict()
+        self.lock = Lock()
+
+    def record(self, stage: str, latency: float, update: bool = True) -> None:
+        with self.lock:
+            self.latencies.setdefault(stage, []).append(latency)
+            self.updates += update
+
+    def finish(self, error: Optional[ScenarioError] = None) -> None:
+        with self.lock:
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed[error.stage] = self.failed.get(error.stage, 0) + 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        """
+        Creates summary of load test.
+
+        :param elapsed: duration of load test in seconds.
+        :type elapsed: float
+        :return: dict with updates per second, scenarios and latency percentiles (ms) by stage.
+        :rtype: Dict[str, Any]
+        """
+
+        stages = dict()
+        with self.lock:
+            for stage, latencies in self.latencies.items():
+                latencies = sorted(latencies)
+                stages[stage] = {
+                    "count": len(latencies),
+                    **{f"p{p}": round(latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000, 1)
+                       for p in (50, 90, 99)},
+                    "max": round(latencies[-1] * 1000, 1)
+                }
+            return {
+                "elapsed": round(elapsed, 2),
+                "updates": self.updates,
+                "updates_per_sec": round(self.updates / elapsed, 1) if elapsed else 0,
+                "completed": self.completed,
+                "failed": dict(self.failed),
+                "stages": stages
+            }
+
+
+def fingerprint(message: Dict[str, Any]) -> str:
+    """
+    Returns string which changes when the bot edits the message.
+
+    :param message: message of fake Telegram.
+    :type message: Dict[str, Any]
+    :return: fingerprint of message.
+    :rtype: str
+    """
+
+    return json.dumps([message.get("text"), message.get("caption"), message.get("reply_markup")])
+
+
+class VirtualUser:
+    """
+    Plays search scenarios in one chat with the bot.
+
+    Args:
+        :telegram (FakeTelegramServer):   fake Telegram server.
+        :user_id (int):   id of user.
+        :stats (LoadStats):   common results of load test.
+        :timeout (float):   max time to wait for the bot's answer in seconds.
+        :think_time (float):   pause before every user's action in seconds.
+        :inline_share (float):   share of scenarios where location is chosen in inline mode.
+    """
+
+    def __init__(self, telegram: FakeTelegramServer, user_id: int, stats: LoadStats,
+                 timeout: float = 30, think_time: float = 0, seed: int = 0, inline_share: float = 0):
+        self.telegram: FakeTelegramServer = telegram
+        self.user_id: int = user_id
+        self.stats: LoadStats = stats
+        self.timeout: float = timeout
+        self.think_time: float = think_time
+        self.inline_share: float = inline_share
+        self.random = random.Random(seed * 100003 + user_id)
+        self.before: Dict[int, str] = dict()
+        self.answers: int = 0
+        self.inline_answers: int = 0
+
+    def snapshot(self, chat: Chat) -> bool:
+        """
+        Remembers current messages of chat. Predicates look for messages
+        which were sent or edited after the snapshot.
+
+        :param chat: the chat.
+        :type chat: Chat
+        :return: True
+        """
+
+        self.before = {message_id: fingerprint(message) for message_id, message in chat.messages.items()}
+        self.answers = len(chat.answers)
+        self.inline_answers = len(chat.inline_answers)
+        return True
+
+    def changed(self, chat: Chat, message_id: int) -> bool:
+        return self.before.get(message_id) != fingerprint(chat.messages[message_id])
+
+    def buttons(self, prefix: str) -> Callable[[Chat], List[Tuple[int, str]]]:
+        """
+        Predicate: new or edited message has buttons with callback data prefix.
+        """
+
+        return lambda chat: [(message_id, data) for message_id, data in chat.buttons(prefix)
+                             if self.changed(chat, message_id)]
+
+    def text(self, beginning: str) -> Callable[[Chat], List[int]]:
+        """
+        Predicate: new or edited message starts with text.
+        """
+
+        return lambda chat: [message_id for message_id, message in chat.messages.items()
+                             if (message.get("text") or "").startswith(beginning) and self.changed(chat, message_id)]
+
+    def inline_results(self) -> Callable[[Chat], Tuple[List[Dict[str, Any]]]]:
+        """
+        Predicate: the bot answered inline query (results may be empty).
+        """
+
+        return lambda chat: (chat.inline_answers[-1],) if len(chat.inline_answers) > self.inline_answers else None
+
+    def act(self, stage: str, action: Callable[[], Any], predicate: Callable[[Chat], Any]) -> Any:
+        """
+        Makes user's action and waits for the bot's answer expected by predicate.
+        Records latency of the answer.
+
+        :param stage: name of scenario stage.
+        :type stage: str
+        :param action: function which sends update to the bot.
+        :type action: Callable[[], Any]
+        :param predicate: function which checks the chat.
+        :type predicate: Callable[[Chat], Any]
+        :return: value returned by predicate.
+        :raise ScenarioError: if the bot didn't answer or answered with a warning.
+        """
+
+        def expected(chat: Chat) -> Any:
+            if len(chat.answers) > self.answers and chat.answers[-1]:
+                raise ScenarioError(stage, f"warning '{chat.answers[-1]}'")
+            return predicate(chat)
+
+        if self.think_time:
+            sleep(self.think_time)
+        self.telegram.wait_for(self.user_id, self.snapshot, timeout=0)
+        start = monotonic()
+        action()
+        try:
+            result = self.telegram.wait_for(self.user_id, expected, timeout=self.timeout)
+        except TimeoutError:
+            raise ScenarioError(stage, "timeout")
+        self.stats.record(stage, monotonic() - start)
+        return result
+
+    def say(self, text: str) -> Callable[[], Any]:
+        return lambda: self.telegram.push_message(self.user_id, text)
+
+    def press(self, button: Tuple[int, str]) -> Callable[[], Any]:
+        return lambda: self.telegram.push_callback(self.user_id, *button)
+
+    def type_inline(self, query: str) -> Callable[[], Any]:
+        return lambda: self.telegram.push_inline_query(self.user_id, query)
+
+    def choose(self, result: Dict[str, Any]) -> Callable[[], Any]:
+        return lambda: self.telegram.push_inline_result(self.user_id, result)
+
+    def set_location(self) -> List[Tuple[int, str]]:
+        """
+        Chooses location by sending city name or in inline mode (inline_share of scenarios).
+        Falls back to sending city name if inline query has no results.
+
+        :return: buttons with number of hotels.
+        :rtype: List[Tuple[int, str]]
+        """
+
+        city = self.random.choice(cities)
+        if self.random.random() < self.inline_share:
+            results, = self.act("inline_query", self.type_inline(city), self.inline_results())
+            if results:
+                return self.act("inline_destination", self.choose(results[0]), self.buttons("h="))
+        locations = self.act("location", self.say(city), self.buttons("id="))
+        return self.act("destination", self.press(locations[0]), self.buttons("h="))
+
+    def play(self, command: str) -> None:
+        """
+        Plays one search scenario.
+
+        :param command: search command.
+        :type command: str
+        :return: None
+        :raise ScenarioError: if the bot didn't answer as expected.
+        """
+
+        from src.bot_text import bot_answers
+
+        start = monotonic()
+        self.act("command", self.say(command), self.text(bot_answers["location"]["start"]))
+        hotels = self.set_location()
+        hotel_count = self.random.randint(1, 5)
+        self.act("hotel_count", self.press((hotels[0][0], f"h={hotel_count}")), self.buttons("cbcal_1"))
+        self.pick_date(calendar_id=1, index=self.random.randint(0, 20), next_prefix="cbcal_2")
+        self.pick_date(calendar_id=2, index=self.random.randint(0, 6), next_prefix="my_a")
+        self.set_rooms()
+
+        if command == "/bestdeal":
+            finish = self.telegram.wait_for(self.user_id, lambda chat: chat.buttons("finish"), timeout=0)
+            self.act("finish", self.press(finish[0]), self.text(bot_answers["set_price"]["question"]))
+            self.act("price", self.say("50 300"), self.text(bot_answers["set_distance"]["question"]))
+            photo = self.act("distance", self.say(str(self.random.randint(3, 15))), self.buttons("photo"))
+        else:
+            finish = self.telegram.wait_for(self.user_id, lambda chat: chat.buttons("finish"), timeout=0)
+            photo = self.act("finish", self.press(finish[0]), self.buttons("photo"))
+
+        if self.random.random() < 0.5:
+            self.act("search", self.press((photo[0][0], "photo-")), self.results(hotel_count))
+        else:
+            photo = self.act("photo", self.press((photo[0][0], "photo+")), self.buttons("photo1"))
+            self.act("search", self.press((photo[0][0], f"photo{self.random.randint(2, 5)}")),
+                     self.results(hotel_count))
+        self.stats.record("scenario", monotonic() - start, update=False)
+
+    def pick_date(self, calendar_id: int, index: int, next_prefix: str) -> None:
+        """
+        Selects year, month and day in calendar until the next stage keyboard is sent.
+
+        :param calendar_id: 1 for check-in calendar, 2 for check-out calendar.
+        :type calendar_id: int
+        :param index: index of day among available days of month.
+        :type index: int
+        :param next_prefix: callback data prefix of the next stage keyboard.
+        :type next_prefix: str
+        :return: None
+        """
+
+        select = f"cbcal_{calendar_id}_s_"
+        stage = "check_in" if calendar_id == 1 else "check_out"
+        buttons = self.telegram.wait_for(self.user_id, lambda chat: chat.buttons(select), timeout=0)
+        for _ in range(5):
+            days = [button for button in buttons if button[1].startswith(select + "d_")]
+            button = days[min(index, len(days) - 1)] if days else buttons[0]
+            result = self.act(stage, self.press(button),
+                              lambda chat: ("next", self.buttons(next_prefix)(chat)) if self.buttons(next_prefix)(chat)
+                              else self.buttons(select)(chat))
+            if result[0] == "next":
+                return
+            buttons = result
+        raise ScenarioError(stage, "calendar didn't finish")
+
+    def set_rooms(self) -> None:
+        """
+        Creates 1-2 rooms with adults and sometimes children.
+
+        :return: None
+        """
+
+        adults_buttons = self.telegram.wait_for(self.user_id, lambda chat: chat.buttons("my_a"), timeout=0)
+        rooms = 1 if self.random.random() < 0.7 else 2
+        for room in range(rooms):
+            if room:
+                new_room = self.telegram.wait_for(self.user_id, lambda chat: chat.buttons("change_new_room"),
+                                                  timeout=0)
+                adults_buttons = self.act("add_room", self.press(new_room[0]), self.buttons(f"my_a1,{room}"))
+            adults = f"my_a{self.random.randint(1, 3)},{room}"
+            children = self.act("adults", self.press((adults_buttons[0][0], adults)), self.buttons(f"+,{room}"))
+            if self.random.random() < 0.3:
+                ages = self.act("children", self.press(children[0]), self.buttons("ch_age="))
+                for _ in range(self.random.randint(1, 2)):
+                    ages = self.act("child_age", self.press((ages[0][0], f"ch_age={self.random.randint(0, 17)},{room}")),
+                                    self.buttons("ch_age="))
+                self.act("children_done", self.press((ages[0][0], f"-,{room}")), self.buttons("finish"))
+            else:
+                self.act("children", self.press((children[0][0], f"-,{room}")), self.buttons("finish"))
+
+    def results(self, hotel_count: int) -> Callable[[Chat], bool]:
+        """
+        Predicate: all hotels are sent or the bot said that fewer hotels were found.
+        """
+
+        from src.bot_text import bot_answers, hotels_link
+
+        answers = bot_answers["search_and_res"]["show_hotels_info"]
+        endings = (answers["not_found"], answers["less_than_required"].split("{")[0])
+        link = re.compile(re.escape(hotels_link["link"]) + r"(\d+)/")
+
+        def predicate(chat: Chat) -> bool:
+            hotels = set()
+            for message_id, message in chat.messages.items():
+                if not self.changed(chat, message_id):
+                    continue
+                text = message.get("text") or message.get("caption") or ""
+                if text.startswith(endings):
+                    return True
+                hotels.update(link.findall(text))
+            return len(hotels) >= hotel_count
+
+        return predicate
+
+    def run(self, scenarios: int) -> None:
+        """
+        Plays scenarios with random commands.
+
+        :param scenarios: number of scenarios.
+        :type scenarios: int
+        :return: None
+        """
+
+        for _ in range(scenarios):
+            try:
+                self.play(self.random.choice(commands))
+            except ScenarioError as error:
+                self.stats.finish(error)
+            else:
+                self.stats.finish()
+
+
+def configure_bot(api_url: str, hotels_url: str, data_dir: str, bot_threads: int) -> None:
+    """
+    Configures the bot to use fake servers and temporary DBs.
+    Must be called before any import of bot modules (except bot_settings).
+
+    :param api_url: url of fake Telegram Bot API.
+    :type api_url: str
+    :param hotels_url: url of hotels api.
+    :type hotels_url: str
+    :param data_dir: directory for DBs.
+    :type data_dir: str
+    :param bot_threads: number of the bot's worker threads.
+    :type bot_threads: int
+    :return: None
+    """
+
+    from telebot import apihelper, util
+    import bot_settings
+
+    bot_settings.HOTELS_API_URL = hotels_url
+    bot_settings.RAPIDAPI_LIMITS = {"per_second": 10 ** 6, "monthly": 10 ** 9}
+    bot_settings.STATE_BACKEND = f"sqlite:{os.path.join(data_dir, 'user_states.sqlite')}"
+    bot_settings.METRICS_SINKS = ""
+    bot_settings.bot.token = "1:fake"
+    bot_settings.bot.worker_pool = util.ThreadPool(bot_settings.bot, num_threads=bot_threads)
+    apihelper.API_URL = api_url
+    os.makedirs(os.path.join(data_dir, "db"), exist_ok=True)
+    os.chdir(data_dir)
+
+
+def start_bot(telegram: FakeTelegramServer, hotels_url: str, data_dir: str, bot_threads: int) -> Thread:
+    """
+    Configures the bot to use fake servers and temporary DBs and starts polling in daemon thread.
+    Must be called before any import of bot modules.
+
+    :param telegram: fake Telegram server.
+    :type telegram: FakeTelegramServer
+    :param hotels_url: url of hotels api.
+    :type hotels_url: str
+    :param data_dir: directory for DBs.
+    :type data_dir: str
+    :param bot_threads: number of the bot's worker threads.
+    :type bot_threads: int
+    :return: polling thread.
+    :rtype: Thread
+    """
+
+    configure_bot(api_url=telegram.api_url, hotels_url=hotels_url, data_dir=data_dir, bot_threads=bot_threads)
+    import main
+    polling = Thread(target=main.bot.infinity_polling, kwargs={"timeout": 10, "long_polling_timeout": 1},
+                     name="bot_polling", daemon=True)
+    polling.start()
+    return polling
+
+
+def start_supervisor(telegram: FakeTelegramServer, hotels_url: str, data_dir: str, bot_threads: int,
+                     workers: int) -> Tuple[Thread, Any]:
+    """
+    Starts the bot in supervisor mode (see src.supervisor) with workers configured like start_bot.
+    Must be called before any import of bot modules.
+
+    :param telegram: fake Telegram server.
+    :type telegram: FakeTelegramServer
+    :param hotels_url: url of hotels api.
+    :type hotels_url: str
+    :param data_dir: directory for DBs.
+    :type data_dir: str
+    :param bot_threads: number of worker threads in every worker process.
+    :type bot_threads: int
+    :param workers: number of worker processes.
+    :type workers: int
+    :return: polling thread of supervisor and the supervisor.
+    :rtype: Tuple[Thread, Supervisor]
+    """
+
+    initializer = partial(configure_bot, api_url=telegram.api_url, hotels_url=hotels_url,
+                          data_dir=data_dir, bot_threads=bot_threads)
+    initializer()
+    from src import supervisor
+    supervisor.poll_timeout = 1
+    bot_supervisor = supervisor.Supervisor(workers=workers, health_interval=1, initializer=initializer)
+    polling = Thread(target=bot_supervisor.run, kwargs={"metrics_sinks": "", "signals": False},
+                     name="bot_supervisor", daemon=True)
+    polling.start()
+    return polling, bot_supervisor
+
+
+def run(users: int, scenarios: int, hotels_url: Optional[str] = None, hotels_latency: float = 0.2,
+        hotels_jitter: float = 0.2, hotels_error_rate: float = 0, timeout: float = 30,
+        think_time: float = 0, bot_threads: int = 2, seed: int = 0, workers: int = 1,
+        inline_share: float = 0) -> Dict[str, Any]:
+    """
+    Runs load test.
+
+    :param users: number of concurrent virtual users.
+    :type users: int
+    :param scenarios: number of scenarios played by every user.
+    :type scenarios: int
+    :param hotels_url: url of hotels api. Fake hotels api is started if it isn't passed.
+    :type hotels_url: Optional[str]
+    :param workers: number of the bot's processes (more than 1 runs the bot in supervisor mode).
+    :type workers: int
+    :param inline_share: share of scenarios where location is chosen in inline mode.
+    :type inline_share: float
+    :return: report (see LoadStats.report) with Bot API calls, hotels api calls and the bot's metrics.
+    :rtype: Dict[str, Any]
+    """
+
+    cwd = os.getcwd()
+    data_dir = mkdtemp(prefix="hotels_bot_load_")
+    telegram = FakeTelegramServer().start()
+    hotels = None
+    if hotels_url is None:
+        hotels = FakeHotelsServer(latency=hotels_latency, jitter=hotels_jitter,
+                                  error_rate=hotels_error_rate, seed=seed).start()
+        hotels_url = hotels.url
+    bot_supervisor = None
+    if workers > 1:
+        polling, bot_supervisor = start_supervisor(telegram=telegram, hotels_url=hotels_url, data_dir=data_dir,
+                                                   bot_threads=bot_threads, workers=workers)
+    else:
+        polling = start_bot(telegram=telegram, hotels_url=hotels_url, data_dir=data_dir, bot_threads=bot_threads)
+
+    stats = LoadStats()
+    threads = [Thread(target=VirtualUser(telegram=telegram, user_id=1000 + i, stats=stats, timeout=timeout,
+                                         think_time=think_time, seed=seed, inline_share=inline_share).run,
+                      args=(scenarios,), name=f"virtual_user_{i}")
+               for i in range(users)]
+    start = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = stats.report(elapsed=monotonic() - start)
+
+    from src.metrics import get_metrics
+    from bot_settings import bot
+    report["bot_api_calls"] = dict(telegram.stats)
+    report["hotels_api_calls"] = dict(hotels.stats) if hotels else None
+    report["bot_metrics"] = get_metrics()
+
+    if bot_supervisor:
+        bot_supervisor.stop_event.set()
+        polling.join(timeout=30)
+    else:
+        bot.stop_polling()
+        polling.join(timeout=5)
+    os.chdir(cwd)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(f"Updates: {report['updates']} in {report['elapsed']} s ({report['updates_per_sec']} updates/s)")
+    print(f"Scenarios: {report['completed']} completed, failed by stage: {report['failed'] or 0}")
+    print(f"{'stage':16}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, result in report["stages"].items():
+        print(f"{stage:16}{result['count']:>8}{result['p50']:>10}{result['p90']:>10}"
+              f"{result['p99']:>10}{result['max']:>10}")
+    print(f"Bot API calls: {report['bot_api_calls']}")
+    if report["hotels_api_calls"]:
+        print(f"Hotels api calls: {report['hotels_api_calls']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end load test with virtual users")
+    parser.add_argument("--users", type=int, default=10, help="number of concurrent users")
+    parser.add_argument("--scenarios", type=int, default=3, help="scenarios played by every user")
+    parser.add_argument("--hotels-url", help="url of hotels api (fake server is started if it isn't passed)")
+    parser.add_argument("--hotels-latency", type=float, default=0.2)
+    parser.add_argument("--hotels-jitter", type=float, default=0.2)
+    parser.add_argument("--hotels-error-rate", type=float, default=0)
+    parser.add_argument("--timeout", type=float, default=30, help="max time to wait for the bot's answer")
+    parser.add_argument("--think-time", type=float, default=0, help="pause before every user's action")
+    parser.add_argument("--bot-threads", type=int, default=2, help="number of the bot's worker threads")
+    parser.add_argument("--workers", type=int, default=1, help="number of the bot's processes (supervisor mode)")
+    parser.add_argument("--inline-share", type=float, default=0,
+                        help="share of scenarios where location is chosen in inline mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print report as json")
+    options = parser.parse_args()
+    load_report = run(users=options.users, scenarios=options.scenarios, hotels_url=options.hotels_url,
+                      hotels_latency=options.hotels_latency, hotels_jitter=options.hotels_jitter,
+                      hotels_error_rate=options.hotels_error_rate, timeout=options.timeout,
+                      think_time=options.think_time, bot_threads=options.bot_threads, seed=options.seed,
+                      workers=options.workers, inline_share=options.inline_share)
+    if options.json:
+        print(json.dumps(load_report, ensure_ascii=False, indent=2))
+    else:
+        print_report(load_report)
@@ -4,6 +4,19 @@ Main scenario functions
 
 from src.scenario_models import *
 from src.hotels_api import get_locale
+from src.gazetteer import LocalLocations, get_gazetteer
+from src.inline_mode import suggest_locations, enabled as inline_mode_enabled
+from src.prefetch import start_prefetch, cancel_prefetch
+from src.price_watch import save_watch
+from db.price_watch_db import remove_watch
+from src.funnel import funnel_report
+from src.bootstrap import bootstrap
+from src.lifecycle import shutdown
+from src.supervisor import log_format
+from src.bot_text import funnel_dict
+from telebot.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+from bot_settings import ADMIN_IDS, INLINE_MODE, COMPARISON, DATE_FLEX, PRICE_WATCH
+import logging
 
 
 @set_stage
@@ -19,18 +32,19 @@ def set_price(msg: Message) -> None:
     user = UserRequest.get_user(msg.from_user.id)
     min_price, max_price = get_price_values(msg.text)
     if not min_price:
+        user.expect_step(set_price.__name__)
         user.cur_step = bot.send_message(text=bot_answers["wrong_format"],
                                          chat_id=user.user_id)
-        bot.register_next_step_handler(user.cur_step, set_price)
     else:
         user.min_price, user.max_price = min_price, max_price
         min_price = int(min_price) if min_price % 1 == 0 else min_price
         max_price = int(max_price) if max_price % 1 == 0 else max_price
         bot.send_message(text=bot_answers["set_price"]["answer"].format(min_price, max_price),
                          chat_id=user.user_id)
+        start_prefetch(user=user)
+        user.expect_step(set_distance.__name__)
         user.cur_step = bot.send_message(text=bot_answers["set_distance"]["question"],
                                          chat_id=user.user_id)
-        bot.register_next_step_handler(user.cur_step, set_distance)
 
 
 @set_stage
@@ -46,14 +60,15 @@ def set_distance(msg: Message) -> None:
     user = UserRequest.get_user(msg.from_user.id)
     distance = get_distance(msg.text)
     if not distance:
+        user.expect_step(set_distance.__name__)
         user.cur_step = bot.send_message(text=bot_answers["wrong_format"],
                                          chat_id=user.user_id)
-        bot.register_next_step_handler(user.cur_step, set_distance)
     else:
         user.distance = distance
         distance = int(distance) if distance % 1 == 0 else distance
         bot.send_message(text=bot_answers["set_distance"]["answer"].format(distance),
                          chat_id=user.user_id)
+        start_prefetch(user=user)
         user.cur_step = bot.send_message(text=bot_answers["photo"]["finish_main_messages_query_handler"],
                                          chat_id=user.user_id,
                                          reply_markup=DEF_KEYBOARDS["need_photo"])
@@ -147,23 +162,70 @@ def set_location(msg: Message) -> None:
         supposed_locations = get_locale(city=msg.text)
         if supposed_locations:
             text = bot_answers["location"]["set_location"]
-            keyboard = ScenarioKeyboards.generate_set_location_kb(locations=supposed_locations)
+            query = msg.text if isinstance(supposed_locations, LocalLocations) else None
+            keyboard = ScenarioKeyboards.generate_set_location_kb(locations=supposed_locations, query=query)
             user.start_search = bot.send_message(text=text,
                                                  chat_id=msg.from_user.id,
                                                  reply_markup=keyboard)
         else:
             text = bot_answers["location"]["backup"]
-            msg = bot.send_message(text=text,
-                                   chat_id=msg.from_user.id)
+            bot.send_message(text=text,
+                             chat_id=msg.from_user.id)
+            user.expect_step(set_location.__name__)
             user.start_search = False
-            bot.register_next_step_handler(message=msg,
-                                           callback=set_location)
     else:
         msg.content_type = "text"
-        start(msg)
+        start.__wrapped__(msg)
         return
 
 
+def set_compare_location(msg: Message) -> None:
+    """
+    Get a list of supposed locations to compare with the location of current search.
+    Creates and sends a message with inline keyboard to choose a location from list.
+    Send a message with notification if location wasn't found.
+    Call start function if any known command will be sent.
+
+    :param msg: user's message with city name.
+    :type msg: telebot.types.Message
+    :return: None
+    """
+
+    user = UserRequest.get_user(msg.from_user.id)
+
+    if msg.text in (*commands, *common_commands.keys()):
+        msg.content_type = "text"
+        start.__wrapped__(msg)
+        return
+    supposed_locations = get_locale(city=msg.text)
+    if supposed_locations:
+        keyboard = ScenarioKeyboards.generate_set_location_kb(locations=supposed_locations, prefix="cmp")
+        bot.send_message(text=bot_answers["compare"]["choose"],
+                         chat_id=user.user_id,
+                         reply_markup=keyboard)
+    else:
+        bot.send_message(text=bot_answers["location"]["backup"],
+                         chat_id=user.user_id)
+        user.expect_step(set_compare_location.__name__)
+        update_user_state(user=user)
+
+
+def refresh_main_message(user: UserRequest) -> None:
+    """
+    Updates text of user's main message after locations to compare were changed.
+
+    :param user: user which changed the search.
+    :type user: UserRequest
+    :return: None
+    """
+
+    if user.main_message:
+        bot.edit_message_text(text=generate_main_message_text(user_memory=user.memory),
+                              chat_id=user.user_id,
+                              message_id=user.main_message,
+                              reply_markup=DEF_KEYBOARDS["main_changes"])
+
+
 @set_stage
 def set_hotel_count(user: UserRequest) -> None:
     """
@@ -213,6 +275,7 @@ def set_check_out(user: UserRequest) -> None:
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("id="))
+@update_context
 @define_next_stage(set_hotel_count, "destination_id")
 def define_destination_id(call: CallbackQuery) -> str:
     """
@@ -242,7 +305,221 @@ def define_destination_id(call: CallbackQuery) -> str:
     return call.data[3:]
 
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("loc="))
+@update_context
+def search_more_locations(call: CallbackQuery) -> None:
+    """
+    Handler of the button under locations found in the local gazetteer:
+    searches the query in rapidapi and replaces the list of supposed locations.
+
+    :param call: The CallbackQuery from inline keyboard which was sent in set_location.
+    :type call: CallbackQuery
+    :return: None
+    """
+
+    user = UserRequest.get_user(user_id=call.from_user.id)
+    supposed_locations = get_locale(city=call.data[4:], local=False)
+    if supposed_locations:
+        keyboard = ScenarioKeyboards.generate_set_location_kb(locations=supposed_locations)
+        bot.edit_message_reply_markup(chat_id=call.message.chat.id,
+                                      message_id=call.message.message_id,
+                                      reply_markup=keyboard)
+    else:
+        bot.edit_message_text(text=bot_answers["location"]["backup"],
+                              chat_id=call.message.chat.id,
+                              message_id=call.message.message_id)
+        user.expect_step(set_location.__name__)
+        user.start_search = False
+
+
+@bot.callback_query_handler(func=lambda call: call.data == "compare")
+@update_context
+def ask_compare_location(call: CallbackQuery) -> None:
+    """
+    Handler of the main message button to compare hotels with another city:
+    asks a city name (up to COMPARISON["max_destinations"] locations in one search).
+    Comparison isn't available with flexible dates.
+
+    :param call: The CallbackQuery from inline keyboard of main_message.
+    :type call: CallbackQuery
+    :return: None
+    """
+
+    user = UserRequest.get_user(user_id=call.from_user.id)
+    if DATE_FLEX["enabled"] and user.date_flex:
+        bot.answer_callback_query(callback_query_id=call.id,
+                                  text=bot_answers["compare"]["date_flex"])
+        return
+    bot.edit_message_reply_markup(chat_id=user.user_id,
+                                  message_id=call.message.message_id,
+                                  reply_markup=DEF_KEYBOARDS["main_changes"])
+    left = COMPARISON["max_destinations"] - 1 - len(user.compare_destinations)
+    keyboard = DEF_KEYBOARDS["clear_comparison"] if user.compare_destinations else None
+    if left > 0:
+        bot.send_message(text=bot_answers["compare"]["set_compare"].format(left),
+                         chat_id=user.user_id,
+                         reply_markup=keyboard)
+        user.expect_step(set_compare_location.__name__)
+        update_user_state(user=user)
+    else:
+        bot.send_message(text=bot_answers["compare"]["limit"].format(COMPARISON["max_destinations"]),
+                         chat_id=user.user_id,
+                         reply_markup=keyboard)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("cmp="))
+@update_context
+def define_compare_destination(call: CallbackQuery) -> None:
+    """
+    Handler to add location to compare with the location of current search.
+    The location is shown in main message.
+
+    :param call: The CallbackQuery from inline keyboard which was sent in set_compare_location.
+    :type call: CallbackQuery
+    :return: None
+    """
+
+    user = UserRequest.get_user(user_id=call.from_user.id)
+    if not user.main_message:
+        remove_keyboard(chat_id=user.user_id, msg_id=call.message.message_id)
+        return
+    destinations = dict(user.compare_destinations)
+    if call.data[4:] != user.destination_id and len(destinations) < COMPARISON["max_destinations"] - 1:
+        destinations[call.data[4:]] = find_location_name(call_json=call.json, location_id=call.data)
+    user.set_compare_destinations(destinations)
+    bot.edit_message_text(text=bot_answers["compare"]["added"].format(", ".join(destinations.values())),
+                          chat_id=user.user_id,
+                          message_id=call.message.message_id)
+    refresh_main_message(user=user)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == "compare_clear")
+@update_context
+def clear_compare_destinations(call: CallbackQuery) -> None:
+    """
+    Handler to remove all locations to compare.
+
+    :param call: The CallbackQuery from inline keyboard which was sent in ask_compare_location.
+    :type call: CallbackQuery
+    :return: None
+    """
+
+    user = UserRequest.get_user(user_id=call.from_user.id)
+    if user.next_step == set_compare_location.__name__:
+        user.pop_expected_step()
+    compared = bool(user.compare_destinations)
+    user.set_compare_destinations(dict())
+    bot.edit_message_text(text=bot_answers["compare"]["cleared"],
+                          chat_id=user.user_id,
+                          message_id=call.message.message_id)
+    if compared:
+        refresh_main_message(user=user)
+
+
+@bot.callback_query_handler(func=lambda call: call.data == "flex")
+@update_context
+def switch_date_flex(call: CallbackQuery) -> None:
+    """
+    Handler of the main message button to search with flexible dates:
+    switches max shift of dates to the next value of DATE_FLEX["options"].
+    Flexible dates aren't available when hotels are compared with other cities.
+
+    :param call: The CallbackQuery from inline keyboard of main_message.
+    :type call: CallbackQuery
+    :return: None
+    """
+
+    user = UserRequest.get_user(user_id=call.from_user.id)
+    if call.message.message_id != user.main_message:
+        remove_keyboard(chat_id=user.user_id, msg_id=call.message.message_id)
+        return
+    if user.compare_destinations:
+        bot.answer_callback_query(callback_query_id=call.id,
+                                  text=bot_answers["date_flex"]["compare"])
+        return
+    options = DATE_FLEX["options"]
+    position = options.index(user.date_flex) if user.date_flex in options else -1
+    user.set_date_flex(options[(position + 1) % len(options)])
+    bot.edit_message_text(text=generate_main_message_text(user_memory=user.memory),
+                          chat_id=user.user_id,
+                          message_id=user.main_message,
+                          reply_markup=ScenarioKeyboards.generate_edit_prev_data_kb(user))
+
+
+@bot.inline_handler(func=lambda inline_query: inline_mode_enabled)
+@update_context
+def answer_location_query(inline_query: InlineQuery) -> None:
+    """
+    Handler of inline queries: answers with locations matching typed part of city name
+    (see src.inline_mode). Chosen location is sent to the chat on behalf of the user
+    and handled by define_inline_destination_id.
+
+    :param inline_query: The InlineQuery with part of city name.
+    :type inline_query: InlineQuery
+    :return: None
+    """
+
+    locations, complete = suggest_locations(query=inline_query.query, user_id=inline_query.from_user.id)
+    results = [InlineQueryResultArticle(id=str(position),
+                                        title=location,
+                                        input_message_content=InputTextMessageContent(location))
+               for position, location in enumerate(locations)]
+    bot.answer_inline_query(inline_query_id=inline_query.id,
+                            results=results,
+                            cache_time=INLINE_MODE["cache_time"] if complete else 0)
+
+
+@bot.message_handler(func=lambda message: message.via_bot is not None and message.via_bot.id == bot.user.id)
+@update_context
+@define_next_stage(set_hotel_count, "destination_id")
+def define_inline_destination_id(message: Message) -> Optional[str]:
+    """
+    Handler of location chosen in inline mode (see answer_location_query).
+    Defines location_name and destination_id without the message with list of supposed locations:
+    user's main message is edited or sent if it is not defined yet.
+    Calls set_hotel_count if count of hotels is not defined for current request.
+
+    :param message: The message sent via the bot with name of chosen location.
+    :type message: Message
+    :return: id of destination city or None if location can't be chosen now.
+    :rtype: Optional[str]
+    """
+
+    user = UserRequest.get_user(user_id=message.from_user.id)
+    if not user.command or not (user.stage == set_location.__name__ or user.main_message):
+        bot.send_message(text=bot_answers["location"]["inline_no_search"],
+                         chat_id=user.user_id)
+        return None
+    destination_id = get_gazetteer().destination(message.text)
+    if destination_id is None:
+        bot.send_message(text=bot_answers["location"]["backup"],
+                         chat_id=user.user_id)
+        return None
+
+    user.pop_expected_step()
+    if isinstance(user.start_search, Message):
+        remove_keyboard(chat_id=user.user_id, msg_id=user.start_search.message_id)
+    user.location_name = message.text
+    clear_start_search(user=user)
+    keyboard = ScenarioKeyboards.generate_set_location_kb(locations={message.text: destination_id})
+    text, edit_markup = save_current_stage_main_message_info(call_markup=keyboard,
+                                                             user=user,
+                                                             stage="location",
+                                                             format_arg=user.location_name)
+    if user.main_message:
+        bot.edit_message_text(text=text,
+                              chat_id=user.user_id,
+                              message_id=user.main_message,
+                              reply_markup=edit_markup)
+    else:
+        user.main_message = bot.send_message(text=text,
+                                             chat_id=user.user_id,
+                                             reply_markup=edit_markup).message_id
+    return destination_id
+
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("h="))
+@update_context
 @define_next_stage(set_check_in, "hotel_count")
 def define_hotel_count(call: CallbackQuery) -> str:
     """
@@ -273,7 +550,8 @@ def define_hotel_count(call: CallbackQuery) -> str:
     return call.data[2:]
 
 
-@bot.callback_query_handler(func=DetailedTelegramCalendar.func(calendar_id=1))
+@bot.callback_query_handler(func=is_calendar_callback(calendar_id=1))
+@update_context
 @define_next_stage(set_check_out, "check_in")
 def define_check_in(call: CallbackQuery) -> date:
     """
@@ -317,7 +595,8 @@ def define_check_in(call: CallbackQuery) -> date:
         return result
 
 
-@bot.callback_query_handler(func=DetailedTelegramCalendar.func(calendar_id=2))
+@bot.callback_query_handler(func=is_calendar_callback(calendar_id=2))
+@update_context
 @define_next_stage(set_room_adults, "check_out")
 def define_check_out(call: CallbackQuery) -> date:
     """
@@ -362,6 +641,7 @@ def define_check_out(call: CallbackQuery) -> date:
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("my_a"))
+@update_context
 def define_room_adults(call: CallbackQuery) -> None:
     """
     Handler to identify number of adults in rooms.
@@ -396,6 +676,7 @@ def define_room_adults(call: CallbackQuery) -> None:
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("+") or call.data.startswith("-"))
+@update_context
 def define_ask_about_children(call: CallbackQuery) -> None:
     """
     Handler to identify presence of children in the room.
@@ -440,6 +721,7 @@ def define_ask_about_children(call: CallbackQuery) -> None:
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("ch_age="))
+@update_context
 def define_room_children(call: CallbackQuery) -> None:
     """
     Handler to identify age of current child in room.
@@ -473,10 +755,11 @@ def define_room_children(call: CallbackQuery) -> None:
                           user=user)
     else:
         call.data = f"-,{room}"
-        define_ask_about_children(call)
+        define_ask_about_children.__wrapped__(call)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("change"))
+@update_context
 def edit_main_rooms_message(call: CallbackQuery) -> None:
     """
     Handler to manage all changes from main_rooms_message inline keyboards.
@@ -489,6 +772,7 @@ def edit_main_rooms_message(call: CallbackQuery) -> None:
     """
 
     user = UserRequest.get_user(user_id=call.message.chat.id)
+    cancel_prefetch(user_id=user.user_id)
 
     if call.data == "change_room":
         markup = ScenarioKeyboards.generate_edit_rooms_prev_data_kb(user)
@@ -543,6 +827,7 @@ def edit_main_rooms_message(call: CallbackQuery) -> None:
 
 @bot.callback_query_handler(func=lambda call: call.data in ("location", "hotel_count",
                                                             "check_in", "check_out", "main"))
+@update_context
 def edit_main_message(call: CallbackQuery) -> None:
     """
     Handler to modify all info in main message.
@@ -553,6 +838,7 @@ def edit_main_message(call: CallbackQuery) -> None:
     """
 
     user = UserRequest.get_user(user_id=call.message.chat.id)
+    cancel_prefetch(user_id=user.user_id)
     text, markup = get_main_message_text_and_markup(call_data=call.data,
                                                     msg_id=call.message.message_id,
                                                     user=user)
@@ -564,6 +850,7 @@ def edit_main_message(call: CallbackQuery) -> None:
 
 
 @bot.callback_query_handler(func=lambda call: call.data == "finish")
+@update_context
 def finish_main_messages_query_handler(call: CallbackQuery) -> None:
     """
     Handler to finish filling info in main message and main rooms message.
@@ -591,16 +878,19 @@ def finish_main_messages_query_handler(call: CallbackQuery) -> None:
 
         user.main_message, user.main_rooms_message = None, None
         if user.command != "/bestdeal":
+            start_prefetch(user=user)
             user.cur_step = bot.send_message(text=bot_answers["photo"]["finish_main_messages_query_handler"],
                                              chat_id=user.user_id,
                                              reply_markup=DEF_KEYBOARDS["need_photo"])
             return
-        msg = bot.send_message(text=bot_answers["set_price"]["question"],
-                               chat_id=user.user_id)
-        bot.register_next_step_handler(msg, set_price)
+        bot.send_message(text=bot_answers["set_price"]["question"],
+                         chat_id=user.user_id)
+        user.expect_step(set_price.__name__)
+        update_user_state(user=user)
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("photo"))
+@update_context
 def go_to_searching(call: CallbackQuery) -> None:
     """
     Handles callbacks related to presence of photo in response.
@@ -630,8 +920,72 @@ def go_to_searching(call: CallbackQuery) -> None:
         show_hotels_info(user=user)
 
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("watch="))
+@update_context
+def save_price_watch(call: CallbackQuery) -> None:
+    """
+    Handler of the button to watch prices of the finished search (see src.price_watch).
+
+    :param call: The CallbackQuery from inline keyboard which was sent in show_hotels_info.
+    :type call: CallbackQuery
+    :return: None
+    """
+
+    user = UserRequest.get_user(user_id=call.from_user.id)
+    result = save_watch(user=user, fingerprint=call.data[6:])
+    text = price_watch_dict[result]
+    if result == "limit":
+        text = text.format(PRICE_WATCH["max_per_user"])
+    bot.edit_message_text(text=text,
+                          chat_id=user.user_id,
+                          message_id=call.message.message_id)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("unwatch="))
+@update_context
+def remove_price_watch(call: CallbackQuery) -> None:
+    """
+    Handler of the button to stop watching prices of the search (sent by /watchlist).
+
+    :param call: The CallbackQuery from inline keyboard which was sent in send_watch_list.
+    :type call: CallbackQuery
+    :return: None
+    """
+
+    remove_watch(job_id=int(call.data[8:]), telegram_id=call.from_user.id)
+    bot.edit_message_text(text=price_watch_dict["removed"],
+                          chat_id=call.message.chat.id,
+                          message_id=call.message.message_id)
+
+
+@bot.message_handler(func=lambda message: message.text.split()[0] == "/funnel")
+@update_context
+def send_funnel(message: Message) -> None:
+    """
+    Handles admin command /funnel [days]. Sends funnel of search scenarios
+    for the last days (7 by default). For other users the command is unknown.
+
+    :param message: user's message with the command.
+    :type message: Message
+    :return: None
+    """
+
+    if message.from_user.id not in ADMIN_IDS:
+        bot.send_message(text=bot_answers["unknown"],
+                         chat_id=message.chat.id)
+        return
+    args = message.text.split()[1:]
+    if args and not (args[0].isdigit() and int(args[0]) > 0):
+        bot.send_message(text=funnel_dict["wrong_days"],
+                         chat_id=message.chat.id)
+        return
+    bot.send_message(text=funnel_report(days=int(args[0]) if args else 7),
+                     chat_id=message.chat.id)
+
+
 @bot.message_handler(func=lambda message: message.text in (*common_commands.keys(), *commands)
                      or match(r"\b[Пп]ривет.*\b", message.text))
+@update_context
 def start(message: Message) -> None:
     """
     Handles known commands and greetings messages.
@@ -654,20 +1008,33 @@ def start(message: Message) -> None:
     elif message.text in commands:
         if message.text == "/history":
             send_history(user)
+        elif message.text == "/watchlist":
+            send_watch_list(user)
         else:
+            cancel_prefetch(user_id=user.user_id)
             user = prepare_instance_to_new_search(user=user, new_command=message.text)
-            msg = bot.send_message(text=bot_answers["location"]["start"],
-                                   chat_id=user.user_id)
-            bot.register_next_step_handler(message=msg,
-                                           callback=set_location)
+            bot.send_message(text=bot_answers["location"]["start"],
+                             chat_id=user.user_id,
+                             reply_markup=DEF_KEYBOARDS["inline_location"] if inline_mode_enabled else None)
+            user.expect_step(set_location.__name__)
+            update_user_state(user=user)
+
+
+next_step_handlers = {
+    "set_location": set_location,
+    "set_compare_location": set_compare_location,
+    "set_price": set_price,
+    "set_distance": set_distance,
+}
 
 
 @bot.message_handler(content_types=["text"])
+@update_context
 @check_destination_cycle
 def route_to_correct_func(message: Message) -> None:
     """
     Handles all text messages except known commands and greetings.
-    Tries to route messages to right function.
+    Routes messages to the function expected by user's state (see UserRequest.next_step).
     In negative cases sends a message that it does not recognize the command.
 
     :param message: user's message
@@ -677,23 +1044,19 @@ def route_to_correct_func(message: Message) -> None:
 
     user = UserRequest.get_user(user_id=message.from_user.id)
 
-    if stages[user.stage] in (0, 1):
-        if user.command in commands:
-            if not user.start_search:
-                set_location(message)
-                return
-            return
-    if stages[user.stage] >= 6 and user.command == "/bestdeal":
-        if match(r"\b\d+ \d+\b", message.text):
-            set_price(message)
-            return
-    if stages[user.stage] > 7:
-        if convert_to_float_list(message.text) and len(convert_to_float_list(message.text)) == 1:
-            set_distance(message)
-            return
+    step = user.pop_expected_step()
+    if step:
+        update_user_state(user=user)
+        next_step_handlers[step](message)
+        return
+    if stages[user.stage] in (0, 1) and user.start_search:
+        return
     bot.send_message(text=bot_answers["unknown"],
                      chat_id=user.user_id)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=log_format)
+    bootstrap()
     bot.infinity_polling(timeout=125)
+    shutdown()
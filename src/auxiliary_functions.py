@@ -5,20 +5,73 @@ auxiliary functions for hotels bot (decorators, check warnings, etc)
 from src.bot_text import current_choice, commands,\
     common_commands, bot_answers, warnings_dict, answer_callback_warnings
 from src.bot_stages import stages
-from telebot.types import Message, CallbackQuery, InlineKeyboardMarkup
+from telebot.types import Message, CallbackQuery, InlineQuery, InlineKeyboardMarkup
 from telebot.apihelper import ApiTelegramException
 from src.base import UserRequest
+from src.metrics import stage_scope, increment
+from src.funnel import current_user, enter_stage, finish_search
+from src.profiling import profile_update
+from src.tracing import trace
+from src.lifecycle import handling_update
 from db.userstates_db import *
+from db.state_backends import StateConflictError
 from typing import Dict, Any, Optional, Callable, Union, Tuple, List
 from functools import wraps
 from bot_settings import bot
 from re import match
 from datetime import date, timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def update_context(func: Callable) -> Callable:
+    """
+    Decorator for handlers of incoming updates. Handles the update in single unit of work:
+    every user state is loaded from DB once, decorators and stage functions get the same
+    UserRequest instance and all changes are written to DB when the handler is finished.
+    Updates of one user are handled one by one (see db.userstates_db.user_lock).
+    Handlers in progress are drained on shutdown (see src.lifecycle).
+    Handling time is recorded as handler.latency.{handler name} metric, user states I/O
+    made outside of stages (including writing at the end of update) is attributed to the handler.
+    Rapidapi calls made while handling the update are counted for the user's search (see src.funnel).
+    Handling is profiled if profiling is enabled (see src.profiling) and traced
+    as root span update.{handler name} if tracing is enabled (see src.tracing).
+    If user's state was changed by another process while handling, the changes aren't written
+    and the user is asked to repeat the last action.
+    A handler called by another handler joins the context of the outer one (like nested unit of work),
+    so the update is counted, traced, locked and profiled once.
+    """
+
+    @wraps(func)
+    def wrapped_func(update: Union[Message, CallbackQuery, InlineQuery]) -> Any:
+        if current_user.get() is not None:
+            return func(update)
+        token = current_user.set(update.from_user.id)
+        try:
+            with handling_update(), trace(f"update.{func.__name__}", user_id=update.from_user.id), \
+                    stage_scope(func.__name__, kind="handler"), user_lock(update.from_user.id), unit_of_work(), \
+                    profile_update(handler=func.__name__, user_id=update.from_user.id):
+                return func(update)
+        except StateConflictError as error:
+            increment("user_states.conflicts")
+            logger.warning("update of user %s is not saved: %s", update.from_user.id, error)
+            bot.send_message(text=bot_answers["state_conflict"],
+                             chat_id=update.from_user.id)
+        finally:
+            current_user.reset(token)
+
+    return wrapped_func
 
 
 def set_stage(func: Callable) -> Callable:
 
-    """ Decorator to set stage to UserRequest instances stage parameter. """
+    """
+    Decorator to set stage to UserRequest instances stage parameter.
+    Time of the stage is recorded as stage.latency.{stage name} metric, users reaching
+    the stage are counted as stage.transitions.{stage name}, upstream calls and user states I/O
+    made by the stage are attributed to it (see src.metrics).
+    """
 
     @wraps(func)
     def wrapped_func(*args, **kwargs) -> Any:
@@ -32,15 +85,33 @@ def set_stage(func: Callable) -> Callable:
                 user = kwargs["user"]
             except KeyError:
                 user = UserRequest.get_user(kwargs["msg"].from_user.id)
-        if stages[user.stage] < stages[func.__name__]:
-            user.stage = func.__name__
-            update_user_state(user=user)
-        result = func(*args, **kwargs)
+        with stage_scope(func.__name__):
+            if stages[user.stage] < stages[func.__name__]:
+                enter_stage(user=user, stage=func.__name__)
+                user.stage = func.__name__
+                update_user_state(user=user)
+                increment(f"stage.transitions.{func.__name__}")
+            result = func(*args, **kwargs)
         return result
 
     return wrapped_func
 
 
+def is_calendar_callback(calendar_id: int) -> Callable[[CallbackQuery], bool]:
+    """
+    Creates predicate for callbacks of calendar keyboard (same as DetailedTelegramCalendar.func,
+    but telegram_bot_calendar isn't imported until the first calendar is built).
+
+    :param calendar_id: Calendar id. 1 if check_in, 2 if check_out
+    :type calendar_id: int
+    :return: predicate for callback query handler.
+    :rtype: Callable[[CallbackQuery], bool]
+    """
+
+    prefix = f"cbcal_{calendar_id}"
+    return lambda call: call.data.startswith(prefix)
+
+
 def remove_keyboard(chat_id: int, msg_id: int) -> bool:
     """
     Removes keyboard from message. Returns True if keyboard was exist.
@@ -88,9 +159,12 @@ def create_calendar_kwargs(_id: int, user: UserRequest) -> Dict[str, Union[str,
             "min_date": user.check_in + timedelta(days=1),
             "max_date": user.check_in + timedelta(days=366),
         })
-    if getattr(user, equals[_id]):
-        button = {"text": f"{current_choice['em']} {current_choice['text']}: {getattr(user, equals[_id])}",
-                  "callback_data": user.memory["dates"][equals[_id]]["last_callback"]}
+    chosen = getattr(user, equals[_id])
+    if chosen:
+        # compacted states keep dates but not memory, so the callback is built from the date
+        callback = user.memory["dates"][equals[_id]].get("last_callback") or f"cbcal_{_id}_s_d_{chosen:%Y_%m_%d}"
+        button = {"text": f"{current_choice['em']} {current_choice['text']}: {chosen}",
+                  "callback_data": callback}
         kwargs.update({'additional_buttons': [button]})
 
     return kwargs
@@ -98,7 +172,8 @@ def create_calendar_kwargs(_id: int, user: UserRequest) -> Dict[str, Union[str,
 
 def define_next_stage(next_func: Callable, attr: Any) -> Callable:
     """
-    Decorator to set attributes values
+    Decorator to set attributes values.
+    Time of the decorated function is recorded as stage.latency.{function name} metric.
 
     :param next_func:
     :param attr:
@@ -108,8 +183,9 @@ def define_next_stage(next_func: Callable, attr: Any) -> Callable:
     def next_stage_decorator(func: Callable) -> Callable:
         @wraps(func)
         def wrapped_func(call) -> None:
-            result = func(call)
-            instance = UserRequest.get_user(user_id=call.message.chat.id)
+            with stage_scope(func.__name__):
+                result = func(call)
+            instance = UserRequest.get_user(user_id=call.from_user.id)
             if result:
                 setattr(instance, attr, result)
                 update_user_state(instance)
@@ -287,6 +363,7 @@ def prepare_instance_to_new_search(user: UserRequest, new_command: str) -> UserR
     """
     Clears user's 'start search pool'. Remove all reply markups related to previous query.
     Remove user from user_state DB. Assign new command to instance and updates DB.
+    Unfinished previous search is counted as abandoned (see src.funnel).
 
     :param user: UserRequest instance needed to be restored.
     :type user: UserRequest
@@ -306,8 +383,10 @@ def prepare_instance_to_new_search(user: UserRequest, new_command: str) -> UserR
         bot.delete_message(chat_id=user.user_id,
                            message_id=msg)
     user.start_search_pool = []
+    finish_search(user=user, completed=False)
     user = UserRequest.reboot(user_id=user.user_id)
     user.command = new_command
+    enter_stage(user=user, stage="set_location")
     user.stage = "set_location"
     update_user_state(user)
     return user
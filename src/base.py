@@ -7,8 +7,10 @@ from typing import Dict, List, Optional, Union, Any, Tuple
 from abc import ABC
 from datetime import date
 from re import search
+from time import time
 from db.userstates_db import *
-from src.bot_text import current_choice, kb_text
+from src.bot_text import current_choice, kb_text, main_message_text_dict
+from bot_settings import DATE_FLEX
 
 
 class UserRequest:
@@ -51,9 +53,26 @@ class UserRequest:
         :max_price (Optional[float]): max price per night.
         :distance (Optional[float]): max distance from hotel to city center.
         :stage (str): current user stage (see stages at src.bot_stages.py)
+        :next_step (Optional[str]): name of the function which has to handle
+            next user's text message (see next_step_handlers at main.py).
+        :next_step_expires (Optional[float]): timestamp after which next_step is expired.
+        :last_touched (float): time of last state update.
+        :stage_entered (float): time when user entered current stage (see src.funnel).
+        :search_finished (bool): True if current search is completed or counted as abandoned (see src.funnel).
+        :compare_destinations (Dict[str, str]): other locations to compare with destination_id
+            (dict destinationId: location name, see src.hotels_api.compare_hotels_dicts).
+        :date_flex (int): max shift of dates in days to find cheaper dates (0 if dates are fixed,
+            see src.hotels_api.flex_hotels_dicts).
 
     """
 
+    next_step_ttl: int = 60 * 60
+    compact_attrs: Tuple[str, ...] = ("command", "stage", "destination_id", "location_name",
+                                      "hotel_count", "check_in", "check_out", "total_room",
+                                      "adults", "children", "need_photo", "min_price",
+                                      "max_price", "distance", "last_touched", "stage_entered",
+                                      "search_finished", "compare_destinations", "date_flex")
+
     def __init__(self, user_id):
 
         self.user_id: int = user_id
@@ -73,11 +92,13 @@ class UserRequest:
         self.memory: Dict[str, Any] = \
             {
             "location": dict(),
+            "compare": dict(),
             "hotel_count": dict(),
             "dates": {
                 "check_in": {},
                 "check_out": {}
             },
+            "flex": dict(),
             "rooms": dict(),
             "finish": ""
         }
@@ -89,6 +110,26 @@ class UserRequest:
         self.max_price: Optional[float] = None
         self.distance: Optional[float] = None
         self.stage: str = "start"
+        self.next_step: Optional[str] = None
+        self.next_step_expires: Optional[float] = None
+        self.last_touched: float = time()
+        self.stage_entered: float = time()
+        self.search_finished: bool = False
+        self.compare_destinations: Dict[str, str] = dict()
+        self.date_flex: int = 0
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """
+        Restores pickled instance from DB.
+        Attributes which are missed in states saved by previous versions get default values.
+
+        :param state: pickled instance __dict__.
+        :type state: Dict[str, Any]
+        :return: None
+        """
+
+        self.__init__(user_id=state["user_id"])
+        self.__dict__.update(state)
 
     @classmethod
     def get_user(cls, user_id: int) -> 'UserRequest':
@@ -104,7 +145,9 @@ class UserRequest:
         user_in_db = get_user_state_from_db(user_id=user_id)
         if user_in_db:
             return user_in_db
-        return UserRequest(user_id=user_id)
+        user = UserRequest(user_id=user_id)
+        remember_user_state(user=user)
+        return user
 
     @property
     def start_search(self):
@@ -132,6 +175,34 @@ class UserRequest:
         self._cur_step = step
         update_user_state(self)
 
+    def expect_step(self, step: str) -> None:
+        """
+        Saves a name of function which has to handle next user's text message.
+        Expectation will be expired after next_step_ttl seconds.
+
+        :param step: name of the function (see next_step_handlers at main.py).
+        :type step: str
+        :return: None
+        """
+
+        self.next_step = step
+        self.next_step_expires = time() + self.next_step_ttl
+
+    def pop_expected_step(self) -> Optional[str]:
+        """
+        Returns a name of function which has to handle next user's text message
+        and clears the expectation. Returns None if expectation doesn't exist or expired.
+
+        :return: name of the function if expectation exists and isn't expired else None.
+        :rtype: Optional[str]
+        """
+
+        step = self.next_step
+        if step and self.next_step_expires < time():
+            step = None
+        self.next_step, self.next_step_expires = None, None
+        return step
+
     def add_child(self, age: int, room: int) -> None:
         """
         Adds a child using his age to passed room.
@@ -184,19 +255,74 @@ class UserRequest:
         except AttributeError:
             self.need_photo = False
 
-    def children_dict_formatting(self) -> None:
+    def children_dict_formatting(self) -> Dict[str, str]:
         """
-        Method to format children dict to 'dict[str, str]'
+        Method to format children dict to 'dict[str, str]'.
+        Children dict of instance stays unchanged.
 
-        :return: None
+        :return: formatted children dict.
+        :rtype: Dict[str, str]
         """
 
+        children = dict()
         for key, value in self.children.items():
             if value:
-                new_val = [str(i) for i in value]
-                self.children[key] = ", ".join(new_val)
+                children[key] = ", ".join([str(i) for i in value])
             else:
-                self.children[key] = ""
+                children[key] = ""
+        return children
+
+    def set_memory_line(self, key: str, after: str, text: Optional[str]) -> None:
+        """
+        Sets line of main message which is kept in memory after the line of another key
+        (the key is added to states saved by previous versions).
+
+        :param key: memory key of the line.
+        :type key: str
+        :param after: memory key of the previous line.
+        :type after: str
+        :param text: text of the line, None to hide the line.
+        :type text: Optional[str]
+        :return: None
+        """
+
+        memory = {memory_key: value for memory_key, value in self.memory.items() if memory_key != key}
+        self.memory = dict()
+        for memory_key, value in memory.items():
+            self.memory[memory_key] = value
+            if memory_key == after:
+                self.memory[key] = {"text": text} if text else dict()
+
+    def set_compare_destinations(self, destinations: Dict[str, str]) -> None:
+        """
+        Sets locations to compare and the line about them in main message
+        (memory "compare" key goes after "location").
+
+        :param destinations: dict destinationId: location name.
+        :type destinations: Dict[str, str]
+        :return: None
+        """
+
+        self.compare_destinations = destinations
+        self.set_memory_line(key="compare", after="location",
+                             text=main_message_text_dict["compare"].format(", ".join(destinations.values()))
+                             if destinations else None)
+        update_user_state(self)
+
+    def set_date_flex(self, days: int) -> None:
+        """
+        Sets max shift of dates and the line about it in main message
+        (memory "flex" key goes after "dates").
+
+        :param days: max shift of dates in days, 0 if dates are fixed.
+        :type days: int
+        :return: None
+        """
+
+        self.date_flex = days
+        self.set_memory_line(key="flex", after="dates",
+                             text=main_message_text_dict["flex"].format(days) if days else None)
+        update_user_state(self)
 
     def prepare_request_data(self) -> Tuple[Dict[str, Union[date, str]], Dict[str, str], Optional[Dict[str, str]]]:
         """
@@ -215,9 +341,21 @@ class UserRequest:
             "min_price": self.min_price,
             "max_price": self.max_price
         }
-        if self.children:
-            self.children_dict_formatting()
-        return request_data, self._adults, self.children
+        return request_data, self._adults, self.children_dict_formatting()
+
+    def compact(self) -> 'UserRequest':
+        """
+        Creates a copy of instance which keeps only search parameters (see compact_attrs).
+        Messages, keyboards and next step expectation are dropped.
+
+        :return: compacted UserRequest instance.
+        :rtype: UserRequest
+        """
+
+        user = UserRequest(user_id=self.user_id)
+        for attr in self.compact_attrs:
+            setattr(user, attr, getattr(self, attr))
+        return user
 
     @classmethod
     def reboot(cls, user_id: int) -> 'UserRequest':
@@ -296,22 +434,33 @@ class ScenarioKeyboards(ABC):
         return edit_kb
 
     @classmethod
-    def generate_set_location_kb(cls, locations: Dict[str, str]) -> InlineKeyboardMarkup:
+    def generate_set_location_kb(cls, locations: Dict[str, str], query: Optional[str] = None,
+                                 prefix: str = "id") -> InlineKeyboardMarkup:
         """
         Creates an InlineKeyboardMarkup instance with list of locations to choose.
         buttons text is got from `location` keys, buttons callback is got from
         `locations` values.
+        If query is passed (locations were found in the local gazetteer) the last button
+        asks to search the query in rapidapi. The button is skipped if the query
+        doesn't fit to callback data (64 bytes).
 
         :param locations: dict with pairs 'location name': 'location id'.
         :type locations: Dict[str, str]
+        :param query: city name from user.
+        :type query: Optional[str]
+        :param prefix: prefix of callback data ("cmp" for locations to compare).
+        :type prefix: str
         :return: InlineKeyboardMarkup instance with list of locations to choose.
         :rtype: InlineKeyboardMarkup
         """
 
         keyboard = InlineKeyboardMarkup(row_width=1)
         buttons = [InlineKeyboardButton(text=location,
-                                        callback_data=f"id={location_id}")
+                                        callback_data=f"{prefix}={location_id}")
                    for location, location_id in locations.items()]
+        if query and len(f"loc={query}".encode()) <= 64:
+            buttons.append(InlineKeyboardButton(text=kb_text["more_locations"],
+                                                callback_data=f"loc={query}"))
         return keyboard.add(*buttons)
 
     @classmethod
@@ -338,6 +487,61 @@ class ScenarioKeyboards(ABC):
                                                callback_data="finish"))
         return edit_rooms_kb
 
+    @classmethod
+    def inline_location(cls) -> InlineKeyboardMarkup:
+        """
+        Creates an InlineKeyboardMarkup instance with a button which starts inline query
+        to the bot in current chat (typeahead of cities, see src.inline_mode).
+
+        :return: a keyboard to search a city in inline mode.
+        :rtype: InlineKeyboardMarkup
+        """
+
+        keyboard = InlineKeyboardMarkup()
+        return keyboard.add(InlineKeyboardButton(text=kb_text["inline_location"],
+                                                 switch_inline_query_current_chat=""))
+
+    @classmethod
+    def clear_comparison(cls) -> InlineKeyboardMarkup:
+        """
+        Creates an InlineKeyboardMarkup instance with a button to remove all locations to compare.
+
+        :return: a keyboard to cancel comparison.
+        :rtype: InlineKeyboardMarkup
+        """
+
+        keyboard = InlineKeyboardMarkup()
+        return keyboard.add(InlineKeyboardButton(text=kb_text["clear_comparison"],
+                                                 callback_data="compare_clear"))
+
+    @classmethod
+    def watch_search(cls, fingerprint: str) -> InlineKeyboardMarkup:
+        """
+        Creates an InlineKeyboardMarkup instance with a button to watch prices of the search.
+
+        :param fingerprint: fingerprint of the search (see src.price_watch.search_fingerprint).
+        :type fingerprint: str
+        :return: a keyboard with one button.
+        :rtype: InlineKeyboardMarkup
+        """
+
+        return InlineKeyboardMarkup().add(InlineKeyboardButton(text=kb_text["watch"],
+                                                               callback_data=f"watch={fingerprint}"))
+
+    @classmethod
+    def unwatch(cls, job_id: int) -> InlineKeyboardMarkup:
+        """
+        Creates an InlineKeyboardMarkup instance with a button to stop watching prices of the search.
+
+        :param job_id: id of the saved search.
+        :type job_id: int
+        :return: a keyboard with one button.
+        :rtype: InlineKeyboardMarkup
+        """
+
+        return InlineKeyboardMarkup().add(InlineKeyboardButton(text=kb_text["unwatch"],
+                                                               callback_data=f"unwatch={job_id}"))
+
     @classmethod
     def num_of_hotels(cls) -> InlineKeyboardMarkup:
         """
@@ -480,6 +684,13 @@ class ScenarioKeyboards(ABC):
         if user.memory["dates"]["check_out"]:
             buttons.append(InlineKeyboardButton(text=kb_text["main_edit_kb_details"]["check_out"],
                                                 callback_data="check_out"))
+            if DATE_FLEX["enabled"]:
+                flex_text = kb_text["main_edit_kb_details"]["flex"].format(user.date_flex) \
+                    if user.date_flex else kb_text["main_edit_kb_details"]["flex_off"]
+                buttons.append(InlineKeyboardButton(text=flex_text,
+                                                    callback_data="flex"))
+        buttons.append(InlineKeyboardButton(text=kb_text["main_edit_kb_details"]["compare"],
+                                            callback_data="compare"))
         buttons.append(InlineKeyboardButton(text=kb_text["back"],
                                             callback_data="change_back"))
         return edit_prev_data_kb.add(button, *buttons)
@@ -532,6 +743,8 @@ class ScenarioKeyboards(ABC):
 DEF_KEYBOARDS = {
     "main_changes": ScenarioKeyboards.generate_edit_kb("main"),
     "num_of_hotels": ScenarioKeyboards.num_of_hotels(),
+    "inline_location": ScenarioKeyboards.inline_location(),
+    "clear_comparison": ScenarioKeyboards.clear_comparison(),
     "need_photo": ScenarioKeyboards.is_photo(need=False),
     "need_photo_true": ScenarioKeyboards.is_photo(need=True)
 }
@@ -0,0 +1,77 @@
+"""
+Bootstrap of the bot process. Importing bot modules only registers handlers:
+user states storage, history DB and calendar are initialized on the first use,
+background services are started here and stopped on shutdown (see src.lifecycle).
+"""
+
+from threading import Thread
+from src.sweeper import start_sweeper
+from src.funnel import start_funnel_flusher
+from src.tracing import start_tracing
+from src.metrics_sinks import start_sinks
+from src.lifecycle import install_signal_handlers, on_shutdown, load_snapshot
+from db.userstates_db import get_backend
+from db.history_db import init_db
+from src.gazetteer import get_gazetteer
+from src.price_watch import start_price_watch
+from src.quota import start_quota_sync
+from src.hotels_api import quota
+from bot_settings import METRICS_SINKS, LIFECYCLE, GAZETTEER, PRICE_WATCH
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up() -> None:
+    """
+    Initializes lazy resources before the first updates need them and loads caches
+    saved on the last shutdown.
+
+    :return: None
+    """
+
+    if LIFECYCLE["snapshot"]:
+        logger.info("%s cached responses are loaded", load_snapshot(LIFECYCLE["snapshot"]))
+    get_backend()
+    init_db()
+    if GAZETTEER["enabled"]:
+        get_gazetteer()
+    import telegram_bot_calendar  # noqa: F401
+
+
+def bootstrap(warm: bool = True, signals: bool = True, sweeper: bool = True,
+              metrics_sinks: str = METRICS_SINKS, price_watch: bool = True) -> None:
+    """
+    Starts background services of the bot: user states sweeper, funnel flusher,
+    traces and metrics exporters, price watch scheduler (see src.price_watch), syncing
+    of rapidapi monthly budget (see src.quota). Sets SIGTERM and SIGINT handlers
+    for graceful shutdown (must be called from main thread).
+
+    :param warm: True to initialize lazy resources in background thread (see warm_up).
+    :type warm: bool
+    :param signals: False if shutdown is controlled by another process (see src.supervisor).
+    :type signals: bool
+    :param sweeper: False if user states DB is swept by another process.
+    :type sweeper: bool
+    :param metrics_sinks: urls of metrics exporters (see src.metrics_sinks.start_sinks).
+    :type metrics_sinks: str
+    :param price_watch: False if saved searches are checked by another process.
+    :type price_watch: bool
+    :return: None
+    """
+
+    if signals:
+        install_signal_handlers()
+    if sweeper:
+        on_shutdown(start_sweeper().set)
+    if price_watch and PRICE_WATCH["enabled"]:
+        on_shutdown(start_price_watch().set)
+    start_funnel_flusher()
+    on_shutdown(start_quota_sync(quota).set)
+    on_shutdown(quota.sync)
+    start_tracing()
+    for sink in start_sinks(metrics_sinks):
+        on_shutdown(sink.stop)
+    if warm:
+        Thread(target=warm_up, name="warm_up", daemon=True).start()
@@ -9,10 +9,11 @@ common_commands = {
              "💲 /highprice - Найду для тебя самые дорогие отели\n"
              "🤑 /bestdeal - Найду отели в указанном диапазоне цен не дальше определенного расстояния от центра\n"
              "📜 /history - Покажу твою историю поиска\n"
+             "🔔 /watchlist - Покажу поиски, за ценами которых я слежу\n"
              "ℹ /help - Расскажу о доступных командах\n"
 }
 
-commands = ["/lowprice", "/highprice", "/bestdeal", "/history"]
+commands = ["/lowprice", "/highprice", "/bestdeal", "/history", "/watchlist"]
 
 bot_answers = {
 
@@ -20,11 +21,15 @@ bot_answers = {
 
     "wrong_format": "Неверный формат ввода, попробуйте снова.",
 
+    "state_conflict": "Не успел сохранить последнее действие 🙈 Повтори его, пожалуйста.",
+
     "location": {
         "set_location": "Выбери один из городов",
         "backup": "Упс! по этому запросу локаций не найдено 🥴. Попробуй еще раз 🙃",
         "start": "Введи город для поиска",
         "check_start_cycle": "Заверши выбор локации или начни новый поиск 🤡",
+        "inline_no_search": "Город из подсказок можно выбрать только во время поиска. "
+                            "Начни поиск командой /lowprice, /highprice или /bestdeal 🙃",
     },
 
     "hotel_count": {
@@ -52,10 +57,29 @@ bot_answers = {
                            "Но их можно посмотреть по ссылке в конце сообщения	🤗.\n\n",
             "not_found": "К сожалению по этому запросу ничего не нашлось 😔",
             "nearest_hotel": "\nБлижайший отель по допустимой цене находится на расстоянии {} км от центра.",
-            "less_than_required": "К сожалению, я смог найти только {}"
+            "less_than_required": "К сожалению, я смог найти только {}",
+            "stale": "Сервис отелей сейчас недоступен 🛠\n"
+                     "Показываю результаты такого же недавнего поиска - цены и наличие мест могли измениться.",
+            "comparison": "Сравниваю отели: {}",
+            "comparison_missing": "\nНе дождался ответа по городам: {} ⏳",
+            "date_flex": "Даты ±{} дн.: для каждого отеля показаны самые дешевые даты 📅",
+            "date_flex_missing": "\nНе успел проверить даты: {} ⏳"
         }
     },
 
+    "compare": {
+        "set_compare": "Введи город для сравнения (можно добавить ещё {})",
+        "choose": "Выбери город для сравнения",
+        "added": "Добавлен город для сравнения: {}",
+        "cleared": "Сравнение отменено",
+        "limit": "Можно сравнить не больше {} городов",
+        "date_flex": "Сравнение городов не работает с гибкими датами: сначала выключи гибкие даты",
+    },
+
+    "date_flex": {
+        "compare": "Гибкие даты не работают при сравнении городов: сначала отмени сравнение",
+    },
+
     "ask_about_children": "В номере {} будут жить дети?",
 
     "set_price": {
@@ -86,11 +110,13 @@ answer_callback_warnings = {
 
 main_message_text_dict = {
     "location": "Локация:  {}",
+    "compare": "Сравнить с:  {}",
     "hotel_count": "Кол-во отелей:  {}",
     "dates": {
         "check_in": "Дата заезда:  {}",
         "check_out": "Дата выезда:  {}",
     },
+    "flex": "Гибкие даты:  ±{} дн.",
     "adults": "Взрослые: {}",
     "children": "Дети: {}",
     "room_header": "========🏕 номер {} 🏕========\n",
@@ -121,6 +147,28 @@ history_dict = {
              "Самое время ее начать 😉"
 }
 
+price_watch_dict = {
+    "offer": "Могу следить за ценами этого поиска и написать, когда они снизятся 🔔",
+    "saved": "Слежу за ценами 👀\nСписок поисков: /watchlist",
+    "exists": "Я уже слежу за ценами этого поиска 👀",
+    "limit": "Можно следить не больше чем за {} поисками. Удали лишние в /watchlist",
+    "outdated": "Этот поиск уже изменился. Чтобы следить за ценами, повтори поиск 🙃",
+    "empty": "Я пока не слежу за ценами.\nПосле поиска отелей нажми \"Следить за ценами\" 🔔",
+    "item": "{location}\nКоманда: {command}\nДаты: {check_in} — {check_out}",
+    "removed": "Больше не слежу за ценами этого поиска",
+    "header": "🔔 Цены изменились: {location}, {check_in} — {check_out}\n\n",
+    "drop": "📉 [{name}]({link}{id}/): {old}$ → {new}$ за ночь\n",
+    "new": "🆕 [{name}]({link}{id}/): {new}$ за ночь\n"
+}
+
+funnel_dict = {
+    "header": "📊 Воронка поиска за {} дн.\n\n",
+    "stage": "{stage}: входов {entries}, ушли {abandoned} ({percent:.0f}%), "
+             "в среднем {time:.1f} с, запросов к API впустую {calls}\n",
+    "search": "\nПоиск выполнен: {}, запросов к API в выполненных поисках: {}\n",
+    "wrong_days": "Укажи число дней, например: /funnel 30"
+}
+
 hotels_api_dict = {
     "errors": {
         "distance": "Не указано",
@@ -128,6 +176,8 @@ hotels_api_dict = {
     },
     "main_message": {
         "hotel": "Отель",
+        "city": "Город",
+        "dates": "Даты",
         "rating": "Рейтинг",
         "address": "Адрес",
         "center": "До центра",
@@ -144,6 +194,9 @@ kb_text = {
         "hotel_count": "Изменить кол-во отелей",
         "check_in": "Изменить дату заезда",
         "check_out": "Изменить дату выезда",
+        "compare": "Сравнить с другим городом",
+        "flex": "Гибкие даты: ±{} дн. 🔄",
+        "flex_off": "Гибкие даты: нет 🔄",
     },
     "main_edit_kb_rooms": {
         "edit": "Редактировать",
@@ -165,6 +218,11 @@ kb_text = {
         "delete_room": "Удалить один из номеров",
     },
     "delete_rooms": "Удалить {}-й номер",
+    "more_locations": "Нет нужного варианта 🔎",
+    "inline_location": "Подсказки городов 🔎",
+    "clear_comparison": "Без сравнения",
+    "watch": "Следить за ценами 🔔",
+    "unwatch": "Не следить",
 }
 
 
@@ -0,0 +1,212 @@
+"""
+In-process caches with expiration time and limited size.
+A cache may have shared second level (SQLite file) to share values between
+bot processes of one host (see src.supervisor).
+"""
+
+from collections import OrderedDict
+from threading import Lock, local
+from time import time
+from typing import Any, Hashable, Optional, Tuple, List
+import pickle
+import sqlite3
+
+
+class SharedStore:
+    """
+    Values with storing time in SQLite file in WAL mode shared by processes of one host.
+    Every thread uses its own connection. The oldest values are removed when there are
+    more than `maxsize` values.
+
+    Args:
+        :path (str):   path to SQLite file.
+        :maxsize (int):   max number of values.
+    """
+
+    trim_every = 100
+
+    def __init__(self, path: str, maxsize: int):
+        self.path: str = path
+        self.maxsize: int = maxsize
+        self.connections = local()
+        self.writes: int = 0
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                               "(key TEXT PRIMARY KEY, stored REAL NOT NULL, value BLOB NOT NULL)")
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Returns connection of current thread. Creates it if it doesn't exist.
+
+        :return: connection to SQLite file.
+        :rtype: sqlite3.Connection
+        """
+
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self.connections.connection = connection
+        return connection
+
+    def get(self, key: Hashable) -> Optional[Tuple[float, Any]]:
+        """
+        Returns value and its storing time.
+
+        :param key: key of value (its repr is used as key in DB).
+        :type key: Hashable
+        :return: storing time and value or None if value isn't stored.
+        :rtype: Optional[Tuple[float, Any]]
+        """
+
+        row = self.connection().execute("SELECT stored, value FROM cache WHERE key = ?", (repr(key),)).fetchone()
+        if row is None:
+            return None
+        return row[0], pickle.loads(row[1])
+
+    def set(self, key: Hashable, stored: float, value: Any) -> None:
+        """
+        Writes value. Removes the oldest values every trim_every writes.
+
+        :param key: key of value (its repr is used as key in DB).
+        :type key: Hashable
+        :param stored: storing time.
+        :type stored: float
+        :param value: value to write.
+        :return: None
+        """
+
+        self.writes += 1
+        with self.connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO cache (key, stored, value) VALUES (?, ?, ?)",
+                               (repr(key), stored, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            if self.writes % self.trim_every == 0:
+                connection.execute("DELETE FROM cache WHERE key IN "
+                                   "(SELECT key FROM cache ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+                                   (self.maxsize,))
+
+
+class TTLCache:
+    """
+    Cache which keeps up to `maxsize` values for `ttl` seconds.
+    The least recently used value is removed when the cache is full.
+    Expired values stay in cache until they are pushed out and can be got as stale ones.
+
+    Args:
+        :maxsize (int):   max number of values.
+        :ttl (float):   time in seconds while value is fresh.
+        :shared (Optional[SharedStore]):   second level shared with other processes, None after creation
+            (is set by worker processes of the supervisor, see src.supervisor). Values are written
+            to both levels, missing values are read from the shared level.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.values: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self.lock = Lock()
+        self.shared: Optional[SharedStore] = None
+
+    def get(self, key: Hashable, allow_stale: bool = False, max_age: Optional[float] = None) -> Optional[Any]:
+        """
+        Returns cached value.
+
+        :param key: key of value.
+        :type key: Hashable
+        :param allow_stale: True if expired value may be returned.
+        :type allow_stale: bool
+        :param max_age: time in seconds while value is fresh for this call (ttl by default).
+        :type max_age: Optional[float]
+        :return: value if it is in cache (and fresh if allow_stale is False) else None.
+        """
+
+        with self.lock:
+            item = self.values.get(key)
+        if item is None and self.shared is not None:
+            item = self.shared.get(key)
+            if item is not None:
+                with self.lock:
+                    self.values.setdefault(key, item)
+                    while len(self.values) > self.maxsize:
+                        self.values.popitem(last=False)
+        if item is None:
+            return None
+        stored, value = item
+        if not allow_stale and time() - stored > (self.ttl if max_age is None else max_age):
+            return None
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        Puts value to cache.
+
+        :param key: key of value.
+        :type key: Hashable
+        :param value: value to cache.
+        :return: None
+        """
+
+        stored = time()
+        with self.lock:
+            self.values[key] = stored, value
+            self.values.move_to_end(key)
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        if self.shared is not None:
+            self.shared.set(key, stored, value)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """
+        Removes value from cache.
+
+        :param key: key of value.
+        :type key: Hashable
+        :return: removed value or None if it wasn't in cache or was expired.
+        """
+
+        with self.lock:
+            item = self.values.pop(key, None)
+        if item is None or time() - item[0] > self.ttl:
+            return None
+        return item[1]
+
+    def dump(self) -> List[Tuple[Hashable, float, Any]]:
+        """
+        Returns all values with their storing time (for snapshot of the cache).
+
+        :return: list of (key, storing time, value) from the least recently used.
+        :rtype: List[Tuple[Hashable, float, Any]]
+        """
+
+        with self.lock:
+            return [(key, stored, value) for key, (stored, value) in self.values.items()]
+
+    def load(self, items: List[Tuple[Hashable, float, Any]]) -> int:
+        """
+        Puts values from snapshot of the cache keeping their storing time.
+        Loaded values are older than the cached ones, values which are already in cache are not replaced.
+
+        :param items: list of (key, storing time, value) from the least recently used.
+        :type items: List[Tuple[Hashable, float, Any]]
+        :return: number of loaded values.
+        :rtype: int
+        """
+
+        loaded = 0
+        with self.lock:
+            for key, stored, value in reversed(items[-self.maxsize:]):
+                if key in self.values:
+                    continue
+                self.values[key] = stored, value
+                self.values.move_to_end(key, last=False)
+                loaded += 1
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return loaded
+
+    def __len__(self) -> int:
+        return len(self.values)
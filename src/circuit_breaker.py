@@ -0,0 +1,114 @@
+"""
+Circuit breaker for requests to rapidapi endpoints.
+"""
+
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import Deque
+from src.metrics import set_gauge, increment
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+states_gauge = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an endpoint when it fails or answers too slowly.
+    Calls which are slower than `slow_call` seconds are counted as failed.
+    The breaker opens when the share of failed calls among last `window` calls exceeds `error_rate`.
+    After `open_timeout` seconds it lets one probe call through (half-open state):
+    success of the probe closes the breaker, failure opens it again.
+
+    Args:
+        :name (str):   name of the breaker (endpoint) for metrics.
+        :window (int):   number of last calls to count error rate.
+        :min_calls (int):   min number of calls in window to open the breaker.
+        :error_rate (float):   share of failed calls to open the breaker.
+        :slow_call (float):   latency in seconds which is counted as failure.
+        :open_timeout (float):   time in seconds before probe call.
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, error_rate: float = 0.5,
+                 slow_call: float = 5, open_timeout: float = 30):
+        self.name: str = name
+        self.min_calls: int = min_calls
+        self.error_rate: float = error_rate
+        self.slow_call: float = slow_call
+        self.open_timeout: float = open_timeout
+        self.calls: Deque[bool] = deque(maxlen=window)
+        self.state: str = CLOSED
+        self.opened_at: float = 0
+        self.probe_in_flight: bool = False
+        self.lock = Lock()
+
+    def allow(self) -> bool:
+        """
+        Checks if a call may be made.
+
+        :return: True if the call may be made else False.
+        :rtype: bool
+        """
+
+        with self.lock:
+            if self.state == OPEN and monotonic() - self.opened_at >= self.open_timeout:
+                self.set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+        increment(f"circuit_breaker.{self.name}.rejected")
+        return False
+
+    def cancel(self) -> None:
+        """
+        Registers that allowed call wasn't made.
+
+        :return: None
+        """
+
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record(self, success: bool, latency: float) -> None:
+        """
+        Registers result of a call.
+
+        :param success: True if the call succeeded.
+        :type success: bool
+        :param latency: duration of the call in seconds.
+        :type latency: float
+        :return: None
+        """
+
+        failed = not success or latency > self.slow_call
+        with self.lock:
+            if self.state == HALF_OPEN and self.probe_in_flight:
+                self.probe_in_flight = False
+                self.calls.clear()
+                self.set_state(OPEN if failed else CLOSED)
+                return
+            self.calls.append(failed)
+            if self.state == CLOSED and len(self.calls) >= self.min_calls \
+                    and sum(self.calls) / len(self.calls) > self.error_rate:
+                self.set_state(OPEN)
+
+    def set_state(self, state: str) -> None:
+        """
+        Changes state of the breaker. Must be called under lock.
+
+        :param state: new state.
+        :type state: str
+        :return: None
+        """
+
+        self.state = state
+        if state == OPEN:
+            self.opened_at = monotonic()
+            increment(f"circuit_breaker.{self.name}.opened")
+        set_gauge(f"circuit_breaker.{self.name}.state", states_gauge[state])
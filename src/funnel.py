@@ -0,0 +1,224 @@
+"""
+Funnel of search scenarios: entries of stages (see src.bot_stages), transitions between them,
+time spent in stages, abandoned searches and rapidapi calls made for them.
+Counters are aggregated in process and periodically added to DB (see db.funnel_db).
+"""
+
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import date, timedelta
+from threading import Thread, Event, Lock
+from time import time
+from typing import Dict, Tuple, Optional
+from src.bot_stages import stages
+from src.bot_text import funnel_dict
+from db.funnel_db import add_funnel_values, get_funnel_values
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+search_stage = "search"
+funnel_stages = tuple(stages) + (search_stage,)
+flush_interval = 60
+calls_idle_ttl = 60 * 60 * 24
+
+current_user: ContextVar[Optional[int]] = ContextVar("current_user", default=None)
+
+funnel_values: Dict[Tuple[str, str], float] = defaultdict(float)
+search_calls: Dict[int, Tuple[int, float]] = dict()
+funnel_lock = Lock()
+
+
+def enter_stage(user: 'UserRequest', stage: str) -> None:
+    """
+    Counts entry of the stage and transition from user's current stage.
+    Must be called before user.stage is changed.
+
+    :param user: user entering the stage.
+    :type user: UserRequest
+    :param stage: name of the stage.
+    :type stage: str
+    :return: None
+    """
+
+    now = time()
+    with funnel_lock:
+        funnel_values[(stage, "entries")] += 1
+        funnel_values[(user.stage, f"to:{stage}")] += 1
+        if user.stage != "start":
+            funnel_values[(user.stage, "time")] += now - user.stage_entered
+            funnel_values[(user.stage, "time_count")] += 1
+    user.stage_entered = now
+    user.search_finished = False
+
+
+def finish_search(user: 'UserRequest', completed: bool) -> None:
+    """
+    Counts the end of user's search: the search is completed (hotels are shown)
+    or abandoned at the current stage (a new search is started or the session became idle).
+    Rapidapi calls made for abandoned search are counted as wasted.
+
+    :param user: user whose search is finished.
+    :type user: UserRequest
+    :param completed: True if hotels were searched.
+    :type completed: bool
+    :return: None
+    """
+
+    if user.search_finished or user.stage == "start":
+        return
+    user.search_finished = True
+    with funnel_lock:
+        calls, _ = search_calls.pop(user.user_id, (0, 0))
+        funnel_values[(user.stage, "time")] += time() - user.stage_entered
+        funnel_values[(user.stage, "time_count")] += 1
+        if completed:
+            funnel_values[(user.stage, f"to:{search_stage}")] += 1
+            funnel_values[(search_stage, "entries")] += 1
+            funnel_values[(search_stage, "calls")] += calls
+        else:
+            funnel_values[(user.stage, "abandoned")] += 1
+            funnel_values[(user.stage, "wasted_calls")] += calls
+
+
+def count_call() -> None:
+    """
+    Counts rapidapi call for the search of the user whose update is handled (see current_user).
+
+    :return: None
+    """
+
+    user_id = current_user.get()
+    if user_id is None:
+        return
+    with funnel_lock:
+        calls, _ = search_calls.get(user_id, (0, 0))
+        search_calls[user_id] = calls + 1, time()
+
+
+def drop_idle_calls(idle_ttl: float = calls_idle_ttl) -> int:
+    """
+    Removes rapidapi calls counters of users who made no calls for idle_ttl seconds.
+    Idle searches are finished by the sweeper which may run in another process
+    (see src.supervisor), so every process cleans its own counters.
+
+    :param idle_ttl: time in seconds since the last call of the user.
+    :type idle_ttl: float
+    :return: number of removed counters.
+    :rtype: int
+    """
+
+    threshold = time() - idle_ttl
+    with funnel_lock:
+        idle = [user_id for user_id, (_, last_call) in search_calls.items() if last_call < threshold]
+        for user_id in idle:
+            del search_calls[user_id]
+    return len(idle)
+
+
+def pop_funnel_values() -> Dict[Tuple[str, str], float]:
+    """
+    Returns counters aggregated since the last call and resets them.
+
+    :return: dict (stage, metric): value.
+    :rtype: Dict[Tuple[str, str], float]
+    """
+
+    with funnel_lock:
+        values = dict(funnel_values)
+        funnel_values.clear()
+    return values
+
+
+def flush_funnel() -> None:
+    """
+    Adds aggregated counters to DB. If DB isn't available, counters are returned
+    to the aggregated ones and are added on the next flush.
+
+    :return: None
+    """
+
+    values = pop_funnel_values()
+    if not values:
+        return
+    try:
+        add_funnel_values(day=date.today(), values=values)
+    except Exception:
+        with funnel_lock:
+            for key, value in values.items():
+                funnel_values[key] += value
+        raise
+
+
+def flush(stop_event: Event, interval: int) -> None:
+    """
+    Adds counters to DB and removes idle calls counters every `interval` seconds until stop_event is set.
+    Errors are logged, so the flusher keeps running.
+
+    :param stop_event: event to stop flushing.
+    :type stop_event: Event
+    :param interval: time between flushes in seconds.
+    :type interval: int
+    :return: None
+    """
+
+    while not stop_event.wait(interval):
+        try:
+            flush_funnel()
+            drop_idle_calls()
+        except Exception:
+            logger.exception("funnel flush failed")
+    try:
+        flush_funnel()
+    except Exception:
+        logger.exception("funnel flush failed")
+
+
+def start_funnel_flusher(interval: int = flush_interval) -> Event:
+    """
+    Starts flushing of funnel counters in daemon thread.
+
+    :param interval: time between flushes in seconds.
+    :type interval: int
+    :return: event to stop flushing.
+    :rtype: Event
+    """
+
+    stop_event = Event()
+    Thread(target=flush, args=(stop_event, interval), name="funnel_flusher", daemon=True).start()
+    return stop_event
+
+
+def funnel_report(days: int = 7) -> str:
+    """
+    Creates text of funnel report for the last days (including counters which aren't flushed yet).
+
+    :param days: number of days in report.
+    :type days: int
+    :return: text of report.
+    :rtype: str
+    """
+
+    values = get_funnel_values(since=date.today() - timedelta(days=days - 1))
+    with funnel_lock:
+        for key, value in funnel_values.items():
+            values[key] = values.get(key, 0) + value
+
+    text = funnel_dict["header"].format(days)
+    for stage in funnel_stages:
+        entries = values.get((stage, "entries"), 0)
+        if not entries:
+            continue
+        if stage == search_stage:
+            text += funnel_dict["search"].format(int(entries), int(values.get((stage, "calls"), 0)))
+            continue
+        abandoned = values.get((stage, "abandoned"), 0)
+        time_count = values.get((stage, "time_count"), 0)
+        text += funnel_dict["stage"].format(stage=stage,
+                                            entries=int(entries),
+                                            abandoned=int(abandoned),
+                                            percent=abandoned / entries * 100,
+                                            time=values.get((stage, "time"), 0) / time_count if time_count else 0,
+                                            calls=int(values.get((stage, "wasted_calls"), 0)))
+    return text
@@ -0,0 +1,333 @@
+"""
+Local gazetteer of destinations built from rapidapi responses to location searches
+(see GAZETTEER in bot_settings). Names are normalised to latin keys, so "Санкт-Петербург",
+"sankt peterburg" and "Sankt-Peterbourg" have the same key. Locations are found by the key
+of a query answered before, by the key of a location name, by prefix of names (trie)
+and by similarity of names trigrams. Rapidapi is called only if there is no confident match.
+"""
+
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple, Any
+from re import sub
+from unicodedata import normalize, combining
+from src.metrics import increment
+from db.gazetteer_db import save_locations, load_locations
+from bot_settings import GAZETTEER
+import logging
+
+logger = logging.getLogger(__name__)
+
+transliteration = dict(zip(
+    "абвгдеёжзийклмнопрстуфхцчшщъыьэюя",
+    ["a", "b", "v", "g", "d", "e", "e", "zh", "z", "i", "i", "k", "l", "m", "n", "o", "p", "r", "s",
+     "t", "u", "f", "kh", "ts", "ch", "sh", "shch", "", "y", "", "e", "yu", "ya"]
+))
+
+spelling_variants = (("shch", "sh"), ("sch", "sh"), ("kh", "h"), ("ck", "k"), ("ph", "f"),
+                     ("w", "v"), ("x", "ks"), ("q", "k"), ("j", "i"), ("y", "i"))
+
+fuzzy_margin = 0.1
+
+
+class LocalLocations(dict):
+    """
+    Locations found in the gazetteer without rapidapi request.
+    The user can ask to search the query in rapidapi if needed location isn't among them.
+    """
+
+
+def normalise(text: str) -> str:
+    """
+    Creates key of location name or query: cyrillic letters are transliterated, diacritics
+    and all characters except latin letters and digits are removed, spelling variants
+    are replaced with one form and doubled letters are collapsed.
+
+    :param text: location name or query.
+    :type text: str
+    :return: normalised key (may be empty).
+    :rtype: str
+    """
+
+    text = "".join(char for char in normalize("NFKD", text.lower()) if not combining(char))
+    key = sub(r"[^a-z0-9]", "", "".join(transliteration.get(char, char) for char in text))
+    for variant, replacement in spelling_variants:
+        key = key.replace(variant, replacement)
+    return sub(r"(.)\1+", r"\1", key)
+
+
+def trigrams(key: str) -> Set[str]:
+    """
+    Splits key to trigrams (with padding, so short keys have trigrams too).
+
+    :param key: normalised key.
+    :type key: str
+    :return: set of trigrams.
+    :rtype: Set[str]
+    """
+
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Gazetteer:
+    """
+    Index of locations from rapidapi responses.
+
+    Args:
+        :locations (Dict[str, str]):   "location name": "destinationId".
+        :queries (Dict[str, List[str]]):   key of query: location names from response to it.
+        :names (Dict[str, List[str]]):   key of city name (location name before the first comma):
+            location names with this city name.
+        :trie (Dict[str, Any]):   prefix tree of names keys. Every node is a dict
+            "next character": node, node of the whole key has the key under "" key.
+        :trigrams_index (Dict[str, Set[str]]):   trigram: names keys containing it.
+        :fuzzy_threshold (float):   min similarity (Dice coefficient of trigrams) of fuzzy match.
+        :min_prefix (int):   min length of query key to match names by prefix or similarity.
+        :max_results (int):   max number of locations in answer.
+    """
+
+    def __init__(self, fuzzy_threshold: float, min_prefix: int, max_results: int):
+        self.locations: Dict[str, str] = dict()
+        self.queries: Dict[str, List[str]] = dict()
+        self.names: Dict[str, List[str]] = dict()
+        self.trie: Dict[str, Any] = dict()
+        self.trigrams_index: Dict[str, Set[str]] = dict()
+        self.fuzzy_threshold: float = fuzzy_threshold
+        self.min_prefix: int = min_prefix
+        self.max_results: int = max_results
+        self.lock = Lock()
+
+    def add(self, query: str, locations: Dict[str, str]) -> None:
+        """
+        Adds rapidapi response to location search to the index.
+
+        :param query: normalised query.
+        :type query: str
+        :param locations: dict "location name": "destinationId" in order of rapidapi response.
+        :type locations: Dict[str, str]
+        :return: None
+        """
+
+        with self.lock:
+            self.queries[query] = list(locations)
+            for caption, destination_id in locations.items():
+                self.locations[caption] = destination_id
+                name = normalise(caption.split(",")[0])
+                if not name:
+                    continue
+                captions = self.names.setdefault(name, [])
+                if caption in captions:
+                    continue
+                captions.append(caption)
+                if len(captions) == 1:
+                    self._index_name(name)
+
+    def _index_name(self, name: str) -> None:
+        """
+        Adds new name key to the trie and the trigrams index.
+
+        :param name: key of city name.
+        :type name: str
+        :return: None
+        """
+
+        node = self.trie
+        for char in name:
+            node = node.setdefault(char, dict())
+        node[""] = name
+        for trigram in trigrams(name):
+            self.trigrams_index.setdefault(trigram, set()).add(name)
+
+    def names_by_prefix(self, prefix: str, limit: int) -> List[str]:
+        """
+        Finds names keys starting with prefix.
+
+        :param prefix: normalised prefix.
+        :type prefix: str
+        :param limit: max number of keys (search stops when it is exceeded).
+        :type limit: int
+        :return: up to limit + 1 names keys.
+        :rtype: List[str]
+        """
+
+        node = self.trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        names, nodes = [], [node]
+        while nodes and len(names) <= limit:
+            node = nodes.pop()
+            for char, child in node.items():
+                if char:
+                    nodes.append(child)
+                else:
+                    names.append(child)
+        return names[:limit + 1]
+
+    def similar_names(self, key: str) -> List[Tuple[float, str]]:
+        """
+        Finds names keys similar to key by trigrams.
+
+        :param key: normalised query.
+        :type key: str
+        :return: list of (similarity, name key) from the most similar,
+            names with similarity less than fuzzy_threshold are skipped.
+        :rtype: List[Tuple[float, str]]
+        """
+
+        key_trigrams = trigrams(key)
+        shared: Dict[str, int] = dict()
+        for trigram in key_trigrams:
+            for name in self.trigrams_index.get(trigram, ()):
+                shared[name] = shared.get(name, 0) + 1
+        similar = []
+        for name, count in shared.items():
+            similarity = 2 * count / (len(key_trigrams) + len(name) + 1)
+            if similarity >= self.fuzzy_threshold:
+                similar.append((similarity, name))
+        return sorted(similar, reverse=True)
+
+    def lookup(self, query: str) -> Optional[Dict[str, str]]:
+        """
+        Finds locations by query if the match is confident: the same query was answered before,
+        query is a known city name, query is a prefix of a few known names or query is similar
+        to one known name much more than to others.
+
+        :param query: query from user.
+        :type query: str
+        :return: dict "location name": "destinationId" or None if there is no confident match.
+        :rtype: Optional[Dict[str, str]]
+        """
+
+        key = normalise(query)
+        if not key:
+            return None
+        with self.lock:
+            kind, captions = "query", self.queries.get(key)
+            if not captions:
+                kind, captions = "name", self.names.get(key)
+            if not captions and len(key) < self.min_prefix:
+                return None
+            if not captions:
+                names = self.names_by_prefix(key, limit=self.max_results)
+                if len(names) <= self.max_results:
+                    kind, captions = "prefix", [caption for name in sorted(names, key=len)
+                                                for caption in self.names[name]]
+            if not captions:
+                similar = self.similar_names(key)
+                if similar and (len(similar) == 1 or similar[0][0] - similar[1][0] >= fuzzy_margin):
+                    kind, captions = "fuzzy", self.names[similar[0][1]]
+            if not captions:
+                return None
+            increment(f"gazetteer.hits.{kind}")
+            return LocalLocations((caption, self.locations[caption]) for caption in captions[:self.max_results])
+
+    def suggest(self, query: str, limit: int) -> Dict[str, str]:
+        """
+        Finds locations for typeahead of inline queries (matches needn't be confident):
+        response to the same query, locations with the same name, names starting with query
+        and similar names.
+
+        :param query: part of city name typed by user.
+        :type query: str
+        :param limit: max number of locations.
+        :type limit: int
+        :return: dict "location name": "destinationId" from the best match.
+        :rtype: Dict[str, str]
+        """
+
+        key = normalise(query)
+        suggestions: Dict[str, str] = dict()
+        if not key:
+            return suggestions
+        with self.lock:
+            names = [key] + sorted(self.names_by_prefix(key, limit=limit), key=len)
+            if len(key) >= self.min_prefix:
+                names += [name for similarity, name in self.similar_names(key)]
+            for caption in self.queries.get(key, []) + [caption for name in names
+                                                        for caption in self.names.get(name, [])]:
+                suggestions.setdefault(caption, self.locations[caption])
+                if len(suggestions) >= limit:
+                    break
+        return suggestions
+
+    def destination(self, caption: str) -> Optional[str]:
+        """
+        Returns destinationId of location.
+
+        :param caption: location name from rapidapi response.
+        :type caption: str
+        :return: destinationId or None if location isn't known.
+        :rtype: Optional[str]
+        """
+
+        with self.lock:
+            return self.locations.get(caption)
+
+
+gazetteer: Optional[Gazetteer] = None
+gazetteer_lock = Lock()
+
+
+def get_gazetteer() -> Gazetteer:
+    """
+    Returns the gazetteer. It is loaded from DB on the first call (so importing
+    of bot modules doesn't open DB). Locations saved by other bot processes
+    (see src.supervisor) after loading are added on the next start.
+
+    :return: the gazetteer.
+    :rtype: Gazetteer
+    """
+
+    global gazetteer
+    if gazetteer is None:
+        with gazetteer_lock:
+            if gazetteer is None:
+                index = Gazetteer(fuzzy_threshold=GAZETTEER["fuzzy_threshold"],
+                                  min_prefix=GAZETTEER["min_prefix"],
+                                  max_results=GAZETTEER["max_results"])
+                responses: Dict[str, Dict[str, str]] = dict()
+                for query, caption, destination_id in load_locations():
+                    responses.setdefault(query, dict())[caption] = destination_id
+                for query, locations in responses.items():
+                    index.add(query, locations)
+                logger.info("gazetteer is loaded: %s locations", len(index.locations))
+                gazetteer = index
+    return gazetteer
+
+
+def find_locations(city: str) -> Optional[Dict[str, str]]:
+    """
+    Finds locations in the gazetteer (if it is enabled).
+
+    :param city: city name from user.
+    :type city: str
+    :return: dict "location name": "destinationId" or None if there is no confident match.
+    :rtype: Optional[Dict[str, str]]
+    """
+
+    if not GAZETTEER["enabled"]:
+        return None
+    locations = get_gazetteer().lookup(city)
+    if locations is None:
+        increment("gazetteer.misses")
+    return locations
+
+
+def remember_locations(city: str, locations: Dict[str, str]) -> None:
+    """
+    Adds rapidapi response to location search to the gazetteer and saves it to DB.
+
+    :param city: city name from user.
+    :type city: str
+    :param locations: dict "location name": "destinationId" in order of rapidapi response.
+    :type locations: Dict[str, str]
+    :return: None
+    """
+
+    query = normalise(city)
+    if not GAZETTEER["enabled"] or not query or not locations:
+        return
+    get_gazetteer().add(query, locations)
+    save_locations(query, locations)
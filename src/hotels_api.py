@@ -4,15 +4,29 @@ All requests to Rapidapi. Processing of the received results.
 
 import requests
 from math import ceil
-from datetime import datetime
-from typing import Tuple, Dict, List, Optional, Any, Union
+from datetime import datetime, date, timedelta
+from typing import Tuple, Dict, List, Optional, Any, Union, Callable, Hashable
 from json import loads, JSONDecodeError
 from re import sub
+from threading import Lock, Event
+from time import monotonic
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextvars import copy_context
+from functools import partial
 from src.bot_text import hotels_api_dict, hotels_rating
-from bot_settings import headers
+from src.metrics import increment, observe, increment_for_stage, observe_for_stage
+from src.funnel import count_call
+from src.tracing import span
+from src.quota import QuotaManager, HIGH_PRIORITY, LOW_PRIORITY
+from src.circuit_breaker import CircuitBreaker
+from src.cache import TTLCache
+from src.gazetteer import find_locations, remember_locations
+from bot_settings import headers, HOTELS_API_URL, RAPIDAPI_LIMITS, HEDGED_REQUESTS, PREFETCH, COMPARISON, \
+    DATE_FLEX, FRESH_RESPONSES
 
 
-url = "https://hotels4.p.rapidapi.com/"
+url = HOTELS_API_URL
 
 
 sort_order = {
@@ -29,10 +43,314 @@ endpoints = {
 
 }
 
+endpoints_priority = {
+    endpoints["location"]: HIGH_PRIORITY,
+    endpoints["hotels_list"]: HIGH_PRIORITY,
+    endpoints["photo"]: LOW_PRIORITY
+}
+
+quota = QuotaManager(per_second=RAPIDAPI_LIMITS["per_second"],
+                     monthly=RAPIDAPI_LIMITS["monthly"])
+
+endpoints_names = {endpoint: name for name, endpoint in endpoints.items()}
+
+breakers = {endpoint: CircuitBreaker(name=name) for name, endpoint in endpoints.items()}
+
+fresh_responses_ttl = {endpoint: FRESH_RESPONSES[name] for name, endpoint in endpoints.items()}
+
+last_responses = TTLCache(maxsize=2000, ttl=60 * 60 * 24)
+prefetched_responses = TTLCache(maxsize=1000, ttl=PREFETCH["ttl"])
+
+request_timeout = 15
+
+comparison_executor = ThreadPoolExecutor(max_workers=COMPARISON["max_destinations"] * 4,
+                                         thread_name_prefix="comparison")
+flex_executor = ThreadPoolExecutor(max_workers=DATE_FLEX["concurrency"],
+                                   thread_name_prefix="date_flex")
+
+
+class StaleResponse(str):
+    """
+    Text of the last rapidapi response to the same request.
+    Is returned instead of new response if rapidapi is unavailable.
+    """
+
+
+class InFlightCall:
+    """
+    Call to rapidapi which is in progress.
+
+    Args:
+        :done (Event):   is set when the call is finished.
+        :result (Optional[str]):   result of the call.
+        :error (Optional[Exception]):   exception raised by the call.
+    """
+
+    def __init__(self):
+        self.done: Event = Event()
+        self.result: Optional[str] = None
+        self.error: Optional[Exception] = None
+
+
+class SingleFlight:
+    """
+    Shares one in-flight call between concurrent identical calls.
+    Callers which came while the call is in progress get its result instead of making their own call.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls: Dict[Hashable, InFlightCall] = dict()
+
+    def do(self, key: Hashable, func: Callable[..., Optional[str]], *args, **kwargs) -> Optional[str]:
+        """
+        Makes the call or waits for identical call in progress.
+
+        :param key: key of identical calls.
+        :type key: Hashable
+        :param func: function to call.
+        :type func: Callable[..., Optional[str]]
+        :return: result of the call.
+        :rtype: Optional[str]
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+
+        if not leader:
+            increment("hotels_api.coalesced")
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+single_flight = SingleFlight()
+
+
+class Hedger:
+    """
+    Hedged requests: if the request hasn't answered within a delay, the second identical
+    request is made and the first successful answer is taken. The delay is a percentile
+    of recent latencies. Share of hedged requests is limited by budget, so hedging
+    can't double the quota use.
+    The loser is cancelled if it hasn't started yet, otherwise its answer is ignored.
+
+    Args:
+        :percentile (float):   percentile of recent latencies to use as delay (from 0 to 100).
+        :budget (float):   max share of requests which may be hedged.
+        :min_delay (float):   min delay in seconds.
+        :default_delay (float):   delay in seconds while there are not enough latencies.
+        :window (int):   number of recent latencies to count percentile.
+    """
+
+    min_samples = 20
+
+    def __init__(self, percentile: float, budget: float, min_delay: float = 0.3,
+                 default_delay: float = 3, window: int = 200):
+        self.percentile: float = percentile
+        self.budget: float = budget
+        self.min_delay: float = min_delay
+        self.default_delay: float = default_delay
+        self.latencies: deque = deque(maxlen=window)
+        self.requests: int = 0
+        self.hedges: int = 0
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedged_request")
+
+    def delay(self) -> float:
+        """
+        Returns time to wait before the second request.
+
+        :return: delay in seconds.
+        :rtype: float
+        """
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.min_samples:
+            return self.default_delay
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[index])
+
+    def take_hedge(self) -> bool:
+        """
+        Checks the hedge budget and takes one hedge from it.
+
+        :return: True if the second request may be made.
+        :rtype: bool
+        """
+
+        with self.lock:
+            if self.hedges + 1 > self.requests * self.budget:
+                return False
+            self.hedges += 1
+            return True
+
+    def timed_call(self, func: Callable[..., Optional[str]], **kwargs) -> Optional[str]:
+        """
+        Calls the function and remembers its latency.
+
+        :param func: function making the request.
+        :type func: Callable[..., Optional[str]]
+        :return: result of the function.
+        :rtype: Optional[str]
+        """
+
+        start = monotonic()
+        result = func(**kwargs)
+        with self.lock:
+            self.latencies.append(monotonic() - start)
+        return result
+
+    def call(self, func: Callable[..., Optional[str]], **kwargs) -> Optional[str]:
+        """
+        Makes hedged request. Every attempt runs in a copy of the caller's context
+        (stage of scenario, current user and trace are kept).
+
+        :param func: function making the request.
+        :type func: Callable[..., Optional[str]]
+        :return: the first successful result (None if both requests failed).
+        :rtype: Optional[str]
+        """
+
+        start = monotonic()
+        with self.lock:
+            self.requests += 1
+        futures = [self.executor.submit(copy_context().run, self.timed_call, func, **kwargs)]
+        done, _ = wait(futures, timeout=self.delay())
+        if not done and self.take_hedge():
+            increment("hotels_api.hedged")
+            futures.append(self.executor.submit(copy_context().run, self.timed_call, func, **kwargs))
+
+        result = None
+        pending = set(futures)
+        while pending and result is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and future.result() is not None:
+                    result = future.result()
+                    break
+        for future in pending:
+            future.cancel()
+        if len(futures) > 1 and futures[-1] in done and result is not None:
+            increment("hotels_api.hedge_won")
+        observe(f"hotels_api.hedged_latency.{endpoints_names.get(kwargs.get('endpoint'))}", monotonic() - start)
+        return result
+
+
+hedger = Hedger(percentile=HEDGED_REQUESTS["percentile"],
+                budget=HEDGED_REQUESTS["budget"])
+
+hedged_endpoints = (endpoints["hotels_list"],)
+
+
+def request_key(_url: str, endpoint: str, querystring: Dict[str, str]) -> Hashable:
+    """
+    Creates key of request to rapidapi for caches.
+
+    :param _url: rapidapi url.
+    :type _url: str
+    :param endpoint: one of endpoints to get locations, list of hotels or hotels photo.
+    :type endpoint: str
+    :param querystring: request params.
+    :type querystring: Dict[str, str]
+    :return: key of request.
+    :rtype: Hashable
+    """
+
+    return _url, endpoint, tuple(sorted(querystring.items()))
 
-def request_to_hotels_api(_url: str, endpoint: str, querystring: Dict[str, str]) -> Optional[str]:
+
+def request_to_hotels_api(_url: str, endpoint: str, querystring: Dict[str, str],
+                          prefetch: bool = False, priority: Optional[int] = None,
+                          quota_timeout: Optional[float] = None) -> Optional[str]:
     """
     Makes all requests to rapidapi.
+    Concurrent identical requests share one call to rapidapi (see SingleFlight).
+    If rapidapi is unavailable returns the last response to the same request
+    as StaleResponse (if it exists).
+    Requests to hotels list are hedged if it's enabled in settings (see Hedger).
+    Prefetched response (see src.prefetch) is returned without new call and is removed from cache.
+    The last response to the same request is returned without new call while it is fresh
+    (see FRESH_RESPONSES in bot_settings).
+    Calls are traced as hotels_api.request spans (see src.tracing).
+
+    :param _url: rapidapi url.
+    :type _url: str
+    :param endpoint: one of endpoints to get locations, list of hotels or hotels photo.
+    :type endpoint: str
+    :param querystring: request params.
+    :type: Optional[str]
+    :param prefetch: True if the request is speculative. Its response is kept
+        in prefetched responses cache, stale response isn't returned.
+    :type prefetch: bool
+    :param priority: priority of the call in QuotaManager (priority of endpoint by default).
+    :type priority: Optional[int]
+    :param quota_timeout: max time to wait for per second budget (see QuotaManager.acquire).
+    :type quota_timeout: Optional[float]
+    :return: text of the response in cases if code of request is ok.
+    :rtype: str
+    """
+
+    key = request_key(_url=_url, endpoint=endpoint, querystring=querystring)
+    if prefetch:
+        increment("hotels_api.prefetches")
+    else:
+        increment("hotels_api.requests")
+        prefetched = prefetched_responses.pop(key)
+        if prefetched is not None:
+            increment("hotels_api.prefetch_hits")
+            return prefetched
+    cached = last_responses.get(key, max_age=fresh_responses_ttl[endpoint])
+    if cached is not None:
+        increment("hotels_api.cache_hits")
+        return cached
+
+    fetch = fetch_from_hotels_api
+    if HEDGED_REQUESTS["enabled"] and endpoint in hedged_endpoints:
+        fetch = partial(hedger.call, fetch_from_hotels_api)
+    with span("hotels_api.request", endpoint=endpoints_names[endpoint], prefetch=prefetch) as current:
+        response = single_flight.do(key, fetch,
+                                    _url=_url, endpoint=endpoint, querystring=querystring, priority=priority,
+                                    quota_timeout=quota_timeout)
+        if current:
+            current.attributes["ok"] = response is not None
+    if response is not None:
+        last_responses.set(key, response)
+        if prefetch:
+            prefetched_responses.set(key, response)
+        return response
+    if prefetch:
+        return None
+
+    stale_response = last_responses.get(key, allow_stale=True)
+    if stale_response is not None:
+        increment("hotels_api.stale_responses")
+        return StaleResponse(stale_response)
+
+
+def fetch_from_hotels_api(_url: str, endpoint: str, querystring: Dict[str, str],
+                          priority: Optional[int] = None, quota_timeout: Optional[float] = None) -> Optional[str]:
+    """
+    Makes a request to rapidapi if the plan budget allows it (see QuotaManager)
+    and endpoint's circuit breaker is not open (see CircuitBreaker).
+    Number and duration of requests are attributed to the current stage of scenario (see src.metrics)
+    and to the search of the current user (see src.funnel).
 
     :param _url: rapidapi url.
     :type _url: str
@@ -40,31 +358,66 @@ def request_to_hotels_api(_url: str, endpoint: str, querystring: Dict[str, str])
     :type endpoint: str
     :param querystring: request params.
     :type: Optional[str]
+    :param priority: priority of the call in QuotaManager (priority of endpoint by default).
+    :type priority: Optional[int]
+    :param quota_timeout: max time to wait for per second budget (see QuotaManager.acquire).
+    :type quota_timeout: Optional[float]
     :return: text of the response in cases if code of request is ok.
     :rtype: str
     """
 
+    if priority is None:
+        priority = endpoints_priority.get(endpoint, HIGH_PRIORITY)
+    breaker = breakers[endpoint]
+    if not breaker.allow():
+        return None
+    if not quota.acquire(priority=priority, timeout=quota_timeout):
+        breaker.cancel()
+        return None
+
+    increment("hotels_api.upstream_calls")
+    increment_for_stage("stage.upstream_calls")
+    count_call()
+    start = monotonic()
     try:
         response = requests.request(method="GET",
-                                    url=url + endpoint,
+                                    url=_url + endpoint,
                                     headers=headers,
-                                    params=querystring)
-        if response.status_code == requests.codes.ok:
-            return response.text
-    except requests.exceptions.Timeout:
+                                    params=querystring,
+                                    timeout=request_timeout)
+    except requests.exceptions.RequestException:
+        response = None
+
+    latency = monotonic() - start
+    observe_for_stage("stage.upstream_latency", latency)
+    if response is None:
+        breaker.record(success=False, latency=latency)
         return None
+    observe(f"hotels_api.latency.{endpoints_names[endpoint]}", latency)
+    breaker.record(success=response.status_code < 500, latency=latency)
+    quota.update(status_code=response.status_code,
+                 response_headers=response.headers)
+    if response.status_code == requests.codes.ok:
+        return response.text
 
 
-def get_locale(city: str) -> Optional[Dict[str, str]]:
+def get_locale(city: str, local: bool = True) -> Optional[Dict[str, str]]:
     """
     Get supposed locations by city name.
+    Confident matches are found in the local gazetteer, rapidapi is requested only for misses.
 
     :param city: city name from user.
     :type city: str
+    :param local: False to skip the gazetteer and request rapidapi.
+    :type local: bool
     :return: dict["City name": "destinationId"]
     :rtype: Optional[Dict[str, str]]
     """
 
+    if local:
+        supposed_locations = find_locations(city)
+        if supposed_locations:
+            return supposed_locations
     supposed_locations = dict()
     querystring = {
         "query": city,
@@ -84,6 +437,9 @@ def get_locale(city: str) -> Optional[Dict[str, str]]:
                 supposed_locations[destination] = destination_id
         except (JSONDecodeError, KeyError, TypeError):
             supposed_locations = None
+        else:
+            if not isinstance(response, StaleResponse):
+                remember_locations(querystring["query"], supposed_locations)
     return supposed_locations
 
 
@@ -140,7 +496,7 @@ def calculate_price(hotel: Dict, timedelta: int) -> Tuple[str, str]:
     return price_per_night, full_price
 
 
-def get_hotel_photos(hotel_id: int, num_of_photo: int) -> Optional[List[str]]:
+def get_hotel_photos(hotel_id: int, num_of_photo: int, quota_timeout: Optional[float] = None) -> Optional[List[str]]:
     """
     Finds hotel photos links.
 
@@ -148,6 +504,8 @@ def get_hotel_photos(hotel_id: int, num_of_photo: int) -> Optional[List[str]]:
     :type hotel_id: int
     :param num_of_photo: count of photo
     :type num_of_photo: int
+    :param quota_timeout: max time to wait for per second budget (see QuotaManager.acquire).
+    :type quota_timeout: Optional[float]
     :return: List with photos urls.
     :rtype: Optional[List[str]]
     """
@@ -155,7 +513,8 @@ def get_hotel_photos(hotel_id: int, num_of_photo: int) -> Optional[List[str]]:
     querystring = {"id": str(hotel_id)}
     response = request_to_hotels_api(_url=url,
                                      endpoint=endpoints["photo"],
-                                     querystring=querystring)
+                                     querystring=querystring,
+                                     quota_timeout=quota_timeout)
     if response:
         try:
             resp = loads(response)
@@ -219,18 +578,15 @@ def sort_price(hotel: Dict[Any, Any]) -> Union[float, int]:
         return 0
 
 
-def get_hotels_dict(destination_id: str, hotel_count: str, check_in: datetime,
-                    check_out: datetime, adults: Dict[str, str], command: str,
-                    min_price: Optional[str] = "", max_price: Optional[str] = "",
-                    children: Optional[Dict[str, str]] = None,
-                    distance: Optional[float] = None) -> Tuple[Optional[Dict[int, Dict[str, str]]], Optional[float]]:
+def hotels_list_querystring(destination_id: str, check_in: datetime, check_out: datetime,
+                            adults: Dict[str, str], command: str,
+                            min_price: Optional[str] = "", max_price: Optional[str] = "",
+                            children: Optional[Dict[str, str]] = None) -> Dict[str, str]:
     """
-    Creates dict with hotels info.
+    Creates params of request to get list of hotels.
 
     :param destination_id: id of location
     :type destination_id: str
-    :param hotel_count: number of hotels needed to be found
-    :type hotel_count: str
     :param check_in: check-in date
     :type check_in: datetime
     :param check_out: check-out date
@@ -245,14 +601,10 @@ def get_hotels_dict(destination_id: str, hotel_count: str, check_in: datetime,
     :type max_price: Optional[str]
     :param children: info about children in room
     :type children: Optional[Dict[str, str]]
-    :param distance: max distance from hotel to city center (/bestdeal scenario)
-    :type distance: Optional[float]
-    :return: dict with hotels info according to filters, might be empty. In these cases
-        returns min distance from hotel to city center (/bestdeal scenario).
-    :rtype: Tuple[Optional[Dict[int, Dict[str, str]]], Optional[float]]
+    :return: request params.
+    :rtype: Dict[str, str]
     """
-    summary = dict()
-    min_distance = None
+
     querystring = {
         "destinationId": destination_id,
         "pageNumber": "1",
@@ -271,9 +623,42 @@ def get_hotels_dict(destination_id: str, hotel_count: str, check_in: datetime,
             "priceMin": str(int(min_price)),
             "priceMax": str(int(max_price)),
         })
+    return querystring
+
+
+def search_hotels(destination_id: str, hotel_count: str, check_in: datetime,
+                  check_out: datetime, adults: Dict[str, str], command: str,
+                  min_price: Optional[str] = "", max_price: Optional[str] = "",
+                  children: Optional[Dict[str, str]] = None,
+                  distance: Optional[float] = None,
+                  priority: Optional[int] = None,
+                  quota_timeout: Optional[float] = None) -> Tuple[Optional[List[Dict]], Optional[float], bool]:
+    """
+    Requests hotels list and sorts it according to command.
+    Params are the same as in get_hotels_dict, priority and quota_timeout are passed to request_to_hotels_api.
+
+    :return: up to hotel_count sorted hotels dicts from rapidapi (None if response isn't got or
+        can't be parsed). If there are no hotels returns min distance from hotel to city center
+        (/bestdeal scenario). The last value is True if hotels were got from the last response
+        to the same request because rapidapi is unavailable.
+    :rtype: Tuple[Optional[List[Dict]], Optional[float], bool]
+    """
+
+    sorted_hotels = None
+    min_distance = None
+    querystring = hotels_list_querystring(destination_id=destination_id,
+                                          check_in=check_in,
+                                          check_out=check_out,
+                                          adults=adults,
+                                          command=command,
+                                          min_price=min_price,
+                                          max_price=max_price,
+                                          children=children)
     response = request_to_hotels_api(_url=url,
                                      endpoint=endpoints["hotels_list"],
-                                     querystring=querystring)
+                                     querystring=querystring,
+                                     priority=priority,
+                                     quota_timeout=quota_timeout)
     if response:
         try:
             resp = loads(response)
@@ -284,18 +669,225 @@ def get_hotels_dict(destination_id: str, hotel_count: str, check_in: datetime,
                                         hotels=resp["data"]["body"]["searchResults"]["results"],
                                         distance=distance)
             if sorted_hotels:
-                if len(sorted_hotels) > int(hotel_count):
-                    sorted_hotels = sorted_hotels[:int(hotel_count)]
-
-                timedelta = find_timedelta(check_in=check_in,
-                                           check_out=check_out)
-                for hotel in sorted_hotels:
-                    summary.update(format_hotel_info(hotel=hotel,
-                                                     timedelta=timedelta))
+                sorted_hotels = sorted_hotels[:int(hotel_count)]
             else:
                 min_distance = min([find_city_center_distance(hotel) for hotel in
                                     resp["data"]["body"]["searchResults"]["results"]])
-    return summary, min_distance
+    return sorted_hotels, min_distance, isinstance(response, StaleResponse)
+
+
+def get_hotels_dict(destination_id: str, hotel_count: str, check_in: datetime,
+                    check_out: datetime, adults: Dict[str, str], command: str,
+                    min_price: Optional[str] = "", max_price: Optional[str] = "",
+                    children: Optional[Dict[str, str]] = None,
+                    distance: Optional[float] = None) -> Tuple[Optional[Dict[int, Dict[str, str]]],
+                                                               Optional[float], bool]:
+    """
+    Creates dict with hotels info.
+
+    :param destination_id: id of location
+    :type destination_id: str
+    :param hotel_count: number of hotels needed to be found
+    :type hotel_count: str
+    :param check_in: check-in date
+    :type check_in: datetime
+    :param check_out: check-out date
+    :type check_out: datetime
+    :param adults: info about adults in rooms
+    :type adults: Dict[str, str]
+    :param command: user's command for searching hotels.
+    :type command: str
+    :param min_price: min cost per night in /bestdeal scenario
+    :type min_price: Optional[str]
+    :param max_price: max cost per night in /bestdeal scenario
+    :type max_price: Optional[str]
+    :param children: info about children in room
+    :type children: Optional[Dict[str, str]]
+    :param distance: max distance from hotel to city center (/bestdeal scenario)
+    :type distance: Optional[float]
+    :return: dict with hotels info according to filters, might be empty. In these cases
+        returns min distance from hotel to city center (/bestdeal scenario).
+        The last value is True if hotels were got from the last response
+        to the same request because rapidapi is unavailable.
+    :rtype: Tuple[Optional[Dict[int, Dict[str, str]]], Optional[float], bool]
+    """
+    summary = dict()
+    sorted_hotels, min_distance, stale = search_hotels(destination_id=destination_id,
+                                                       hotel_count=hotel_count,
+                                                       check_in=check_in,
+                                                       check_out=check_out,
+                                                       adults=adults,
+                                                       command=command,
+                                                       min_price=min_price,
+                                                       max_price=max_price,
+                                                       children=children,
+                                                       distance=distance)
+    if sorted_hotels:
+        timedelta = find_timedelta(check_in=check_in,
+                                   check_out=check_out)
+        for hotel in sorted_hotels:
+            summary.update(format_hotel_info(hotel=hotel,
+                                             timedelta=timedelta))
+    return summary, min_distance, stale
+
+
+def compare_hotels_dicts(destinations: Dict[str, str], timeout: float,
+                         **search: Any) -> Tuple[Dict[int, Dict[str, str]], List[str], bool]:
+    """
+    Searches hotels in several destinations concurrently with the same dates and rooms
+    and merges them into one ranking according to command: by price for /lowprice and /highprice,
+    by distance to city center for /bestdeal. Every destination gives up to hotel_count hotels,
+    the best hotel_count hotels of all destinations are returned.
+    Destinations which aren't answered within timeout are skipped (their responses
+    are cached when they are got, so the next search is faster).
+
+    :param destinations: dict "destinationId": "location name".
+    :type destinations: Dict[str, str]
+    :param timeout: common deadline of all searches in seconds.
+    :type timeout: float
+    :param search: params of get_hotels_dict except destination_id.
+    :return: dict with hotels info (every hotel has name of its location), names of locations
+        without results within timeout and True if any hotels were got from the last response
+        to the same request because rapidapi is unavailable.
+    :rtype: Tuple[Dict[int, Dict[str, str]], List[str], bool]
+    """
+
+    futures = {comparison_executor.submit(copy_context().run, search_hotels,
+                                          destination_id=destination_id, **search): name
+               for destination_id, name in destinations.items()}
+    done, _ = wait(futures, timeout=timeout)
+    ranked: List[Tuple[str, Dict]] = []
+    missing: List[str] = []
+    stale = False
+    for future, name in futures.items():
+        if future not in done or future.exception() is not None:
+            increment("hotels_api.comparison_missing")
+            missing.append(name)
+            continue
+        hotels, _, from_stale = future.result()
+        stale = stale or from_stale
+        ranked.extend((name, hotel) for hotel in hotels or [])
+
+    if search["command"] == "/bestdeal":
+        ranked.sort(key=lambda item: find_city_center_distance(item[1]))
+    else:
+        ranked.sort(key=lambda item: sort_price(item[1]), reverse=search["command"] == "/highprice")
+    del ranked[int(search["hotel_count"]):]
+    timedelta = find_timedelta(check_in=search["check_in"],
+                               check_out=search["check_out"])
+    summary = dict()
+    for name, hotel in ranked:
+        for hotel_id, info in format_hotel_info(hotel=hotel, timedelta=timedelta).items():
+            summary[hotel_id] = {hotels_api_dict["main_message"]["city"]: name, **info}
+    return summary, missing, stale
+
+
+def shifted_dates(check_in: date, check_out: date, flex_days: int) -> List[Tuple[date, date]]:
+    """
+    Creates stay windows of the same length shifted by up to flex_days days in both directions.
+    Windows starting before today are skipped.
+
+    :param check_in: check-in date chosen by user.
+    :type check_in: date
+    :param check_out: check-out date chosen by user.
+    :type check_out: date
+    :param flex_days: max shift in days.
+    :type flex_days: int
+    :return: list of (check-in, check-out), the chosen dates go first.
+    :rtype: List[Tuple[date, date]]
+    """
+
+    windows = [(check_in, check_out)]
+    for shift in sorted(range(-flex_days, flex_days + 1), key=abs)[1:]:
+        shifted_check_in = check_in + timedelta(days=shift)
+        if shifted_check_in >= date.today():
+            windows.append((shifted_check_in, check_out + timedelta(days=shift)))
+    return windows
+
+
+def nightly_price(hotel: Dict[Any, Any]) -> float:
+    """
+    Finds price per night to choose the cheapest dates of hotel.
+
+    :param hotel: Dict with hotel info.
+    :type hotel: Dict[Any, Any]
+    :return: price per night or infinity if price isn't found.
+    :rtype: float
+    """
+
+    return sort_price(hotel) or float("inf")
+
+
+def flex_hotels_dicts(flex_days: int, timeout: float,
+                      **search: Any) -> Tuple[Dict[int, Dict[str, str]], Optional[float], bool,
+                                              List[Tuple[date, date]]]:
+    """
+    Searches hotels with dates shifted by up to flex_days days (see shifted_dates) concurrently
+    (up to DATE_FLEX["concurrency"] requests at a time). Requests share the cache of responses
+    and the plan budget with other searches, requests for shifted dates have low priority
+    in QuotaManager, so they are skipped when the monthly budget is almost spent.
+    Every request waits for per second budget until the deadline, so windows are paced
+    by the token bucket instead of being rejected.
+    Hotels found for several windows are shown once with the cheapest price per night,
+    the result is ranked according to command and trimmed to hotel_count.
+    Windows which aren't answered within timeout are skipped.
+
+    :param flex_days: max shift of dates in days.
+    :type flex_days: int
+    :param timeout: common deadline of all searches in seconds.
+    :type timeout: float
+    :param search: params of get_hotels_dict.
+    :return: dict with hotels info (every hotel has its dates), min distance from hotel
+        to city center if nothing is found (/bestdeal scenario), True if any hotels
+        were got from the last response to the same request because rapidapi is unavailable
+        and skipped windows (not answered, rejected by the budget or failed).
+    :rtype: Tuple[Dict[int, Dict[str, str]], Optional[float], bool, List[Tuple[date, date]]]
+    """
+
+    deadline = monotonic() + timeout
+    windows = shifted_dates(check_in=search.pop("check_in"),
+                            check_out=search.pop("check_out"),
+                            flex_days=flex_days)
+
+    def search_window(check_in: date, check_out: date, priority: Optional[int]) -> Tuple[
+            Optional[List[Dict]], Optional[float], bool]:
+        return search_hotels(check_in=check_in, check_out=check_out, priority=priority,
+                             quota_timeout=max(0.0, deadline - monotonic()), **search)
+
+    futures = {flex_executor.submit(copy_context().run, search_window,
+                                    check_in=check_in, check_out=check_out,
+                                    priority=None if position == 0 else LOW_PRIORITY): (check_in, check_out)
+               for position, (check_in, check_out) in enumerate(windows)}
+    done, _ = wait(futures, timeout=timeout)
+    cheapest: Dict[Any, Tuple[Dict, Tuple[date, date]]] = dict()
+    min_distances: List[float] = []
+    missing: List[Tuple[date, date]] = []
+    stale = False
+    for future, window in futures.items():
+        if future not in done or future.exception() is not None or future.result()[0] is None:
+            increment("hotels_api.date_flex_missing")
+            missing.append(window)
+            continue
+        hotels, min_distance, from_stale = future.result()
+        stale = stale or from_stale
+        if isinstance(min_distance, float):
+            min_distances.append(min_distance)
+        for hotel in hotels or []:
+            known = cheapest.get(hotel["id"])
+            if known is None or nightly_price(hotel) < nightly_price(known[0]):
+                cheapest[hotel["id"]] = hotel, window
+
+    ranked = list(cheapest.values())
+    if search["command"] == "/bestdeal":
+        ranked.sort(key=lambda item: find_city_center_distance(item[0]))
+    else:
+        ranked.sort(key=lambda item: sort_price(item[0]), reverse=search["command"] == "/highprice")
+    summary = dict()
+    for hotel, (check_in, check_out) in ranked[:int(search["hotel_count"])]:
+        nights = find_timedelta(check_in=check_in, check_out=check_out)
+        for hotel_id, info in format_hotel_info(hotel=hotel, timedelta=nights).items():
+            summary[hotel_id] = {hotels_api_dict["main_message"]["dates"]: f"{check_in} — {check_out}", **info}
+    return summary, min(min_distances) if min_distances and not summary else None, stale, missing
 
 
 def get_rating(hotel: Dict[Any, Any]) -> str:
@@ -0,0 +1,55 @@
+"""
+Typeahead of destinations for inline queries (see INLINE_MODE in bot_settings).
+Queries are answered from the local gazetteer (see src.gazetteer). Rapidapi is requested only
+if there is no confident local match, the query is long enough, the user didn't cause a request
+during the last fallback_interval seconds and there are free fallback slots,
+so typing doesn't cause a rapidapi request per keystroke.
+"""
+
+from threading import BoundedSemaphore
+from typing import Dict, Tuple
+from src.cache import TTLCache
+from src.gazetteer import get_gazetteer, normalise
+from src.hotels_api import get_locale
+from src.metrics import increment
+from bot_settings import INLINE_MODE, GAZETTEER
+
+enabled = INLINE_MODE["enabled"] and GAZETTEER["enabled"]
+
+fallback_slots = BoundedSemaphore(INLINE_MODE["fallback_concurrency"])
+recent_fallbacks = TTLCache(maxsize=10000, ttl=INLINE_MODE["fallback_interval"])
+
+
+def suggest_locations(query: str, user_id: int) -> Tuple[Dict[str, str], bool]:
+    """
+    Finds locations for inline query.
+
+    :param query: part of city name typed by user.
+    :type query: str
+    :param user_id: id of user.
+    :type user_id: int
+    :return: dict "location name": "destinationId" and True if the answer is complete
+        (there is a confident local match or rapidapi was requested).
+    :rtype: Tuple[Dict[str, str], bool]
+    """
+
+    gazetteer = get_gazetteer()
+    limit = INLINE_MODE["max_results"]
+    suggestions = gazetteer.suggest(query, limit=limit)
+    if gazetteer.lookup(query) is not None:
+        increment("inline.local_answers")
+        return suggestions, True
+    if len(normalise(query)) < INLINE_MODE["fallback_min_length"] or recent_fallbacks.get(user_id) \
+            or not fallback_slots.acquire(blocking=False):
+        increment("inline.fallbacks_skipped")
+        return suggestions, False
+
+    recent_fallbacks.set(user_id, True)
+    increment("inline.fallbacks")
+    try:
+        locations = dict(get_locale(city=query, local=False) or dict())
+    finally:
+        fallback_slots.release()
+    for caption, destination_id in suggestions.items():
+        locations.setdefault(caption, destination_id)
+    return dict(list(locations.items())[:limit]), True
@@ -0,0 +1,194 @@
+"""
+Graceful shutdown and warm restart of the bot process (see LIFECYCLE in bot_settings).
+On SIGTERM (or SIGINT) polling of updates is stopped, handlers in progress are drained
+until the deadline, funnel counters, metrics and traces are flushed and the cache of the last
+rapidapi responses (src.hotels_api.last_responses, raw responses to locations, hotels lists and
+photos requests) is saved to snapshot file. Prefetched responses aren't saved.
+The snapshot is loaded on the next start, so restart doesn't cause a burst of rapidapi calls.
+"""
+
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, List, Iterator, Dict
+from src.cache import TTLCache
+from src.hotels_api import last_responses
+from src.funnel import flush_funnel
+from src.tracing import flush_traces
+from src.prefetch import stop_prefetches
+from db.history_db import close_db
+from bot_settings import bot, LIFECYCLE
+import logging
+import os
+import pickle
+import signal
+
+
+logger = logging.getLogger(__name__)
+
+snapshot_caches: Dict[str, TTLCache] = {
+    "last_responses": last_responses
+}
+
+drain_check_interval = 0.05
+
+in_flight = 0
+in_flight_lock = Lock()
+stop_callbacks: List[Callable[[], None]] = []
+shutting_down = False
+
+
+@contextmanager
+def handling_update() -> Iterator[None]:
+    """
+    Context manager to count handlers in progress (see update_context).
+
+    :return: None
+    """
+
+    global in_flight
+    with in_flight_lock:
+        in_flight += 1
+    try:
+        yield
+    finally:
+        with in_flight_lock:
+            in_flight -= 1
+
+
+def on_shutdown(callback: Callable[[], None]) -> None:
+    """
+    Registers function stopping background service. Functions are called on shutdown
+    after handlers are drained.
+
+    :param callback: function without arguments.
+    :type callback: Callable[[], None]
+    :return: None
+    """
+
+    stop_callbacks.append(callback)
+
+
+def request_shutdown(signum: int, frame) -> None:
+    """
+    Handler of SIGTERM and SIGINT: stops polling of new updates. Polling returns
+    when the current getUpdates request is finished, then main calls shutdown.
+
+    :param signum: number of signal.
+    :type signum: int
+    :param frame: current stack frame.
+    :return: None
+    """
+
+    logger.info("signal %s received, stopping polling", signal.Signals(signum).name)
+    bot.stop_polling()
+
+
+def install_signal_handlers() -> None:
+    """
+    Sets request_shutdown as SIGTERM and SIGINT handler (must be called from main thread).
+
+    :return: None
+    """
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, request_shutdown)
+
+
+def drain(timeout: float) -> bool:
+    """
+    Waits until updates received by polling are handled.
+    Updates are idle when task queue of bot's workers is empty and there are no handlers
+    in progress on two checks in a row (a worker may have taken the task but not started the handler yet).
+
+    :param timeout: max waiting time in seconds.
+    :type timeout: float
+    :return: True if all updates were handled.
+    :rtype: bool
+    """
+
+    deadline = monotonic() + timeout
+    idle_checks = 0
+    while idle_checks < 2:
+        queued = bot.worker_pool.tasks.qsize() if bot.worker_pool else 0
+        idle_checks = idle_checks + 1 if not queued and not in_flight else 0
+        if monotonic() >= deadline:
+            logger.warning("drain timeout: %s updates in progress, %s queued", in_flight, queued)
+            return False
+        sleep(drain_check_interval)
+    return True
+
+
+def save_snapshot(path: str) -> int:
+    """
+    Saves caches to snapshot file (written to temporary file and renamed, so the snapshot
+    isn't broken if the process is killed while writing).
+
+    :param path: path to snapshot file.
+    :type path: str
+    :return: number of saved values.
+    :rtype: int
+    """
+
+    snapshot = {name: cache.dump() for name, cache in snapshot_caches.items()}
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.tmp", "wb") as file:
+        pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+    return sum(len(items) for items in snapshot.values())
+
+
+def load_snapshot(path: str) -> int:
+    """
+    Loads caches from snapshot file saved on the last shutdown.
+    Values keep their storing time, so expired responses are only used as stale ones.
+
+    :param path: path to snapshot file.
+    :type path: str
+    :return: number of loaded values.
+    :rtype: int
+    """
+
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, "rb") as file:
+            snapshot = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        logger.exception("snapshot %s isn't loaded", path)
+        return 0
+    return sum(cache.load(snapshot.get(name, [])) for name, cache in snapshot_caches.items())
+
+
+def shutdown() -> None:
+    """
+    Finishes the process gracefully: drains handlers up to LIFECYCLE["drain_timeout"] seconds,
+    stops background services, flushes funnel counters and traces, closes DB
+    and saves snapshot of caches to LIFECYCLE["snapshot"].
+
+    :return: None
+    """
+
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    bot.stop_polling()
+    start = monotonic()
+    drained = drain(timeout=LIFECYCLE["drain_timeout"])
+    stop_prefetches()
+
+    for step in [*stop_callbacks, flush_funnel, partial(flush_traces, timeout=5), close_db]:
+        try:
+            step()
+        except Exception:
+            logger.exception("shutdown step %s failed", getattr(step, "__name__", step))
+    if LIFECYCLE["snapshot"]:
+        try:
+            logger.info("%s cached responses are saved", save_snapshot(LIFECYCLE["snapshot"]))
+        except OSError:
+            logger.exception("snapshot of caches isn't saved")
+    logger.info("bot is stopped in %.1f s (drained: %s)", monotonic() - start, drained)
@@ -0,0 +1,230 @@
+"""
+In-process metrics of the bot (counters, gauges and histograms).
+Metrics of upstream calls and user states I/O are also attributed to the current stage
+of the scenario (see stage_scope). Metrics are exported by sinks from src.metrics_sinks.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple, List, Iterator
+
+
+counters: Dict[str, float] = dict()
+gauges: Dict[str, float] = dict()
+histograms: Dict[str, 'Histogram'] = dict()
+metrics_lock = Lock()
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+current_stage: ContextVar[str] = ContextVar("current_stage", default="other")
+
+
+class Histogram:
+    """
+    Distribution of observed values by buckets.
+
+    Args:
+        :buckets (Tuple[float, ...]):   upper bounds of buckets (ascending).
+        :counts (List[int]):   number of values in every bucket. The last one is for values
+            greater than the last bound.
+        :sum (float):   sum of all values.
+        :count (int):   number of values.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = latency_buckets):
+        self.buckets: Tuple[float, ...] = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        """
+        Adds value to distribution.
+
+        :param value: observed value.
+        :type value: float
+        :return: None
+        """
+
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimates percentile as upper bound of bucket which contains it.
+
+        :param percent: percentile (from 0 to 100).
+        :type percent: float
+        :return: estimated percentile (inf if it is greater than the last bound).
+        :rtype: float
+        """
+
+        rank = self.count * percent / 100
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> Dict[str, float]:
+        """
+        Returns summary of distribution.
+
+        :return: dict with count, sum and estimated p50, p90, p99.
+        :rtype: Dict[str, float]
+        """
+
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99)
+        }
+
+    def copy(self) -> 'Histogram':
+        """
+        Returns a copy of distribution.
+
+        :return: new histogram with the same values.
+        :rtype: Histogram
+        """
+
+        histogram = Histogram(buckets=self.buckets)
+        histogram.counts, histogram.sum, histogram.count = list(self.counts), self.sum, self.count
+        return histogram
+
+
+def increment(name: str, value: float = 1) -> None:
+    """
+    Increases counter by passed value. Creates the counter if it doesn't exist.
+
+    :param name: name of the counter.
+    :type name: str
+    :param value: value to add.
+    :type value: float
+    :return: None
+    """
+
+    with metrics_lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float) -> None:
+    """
+    Sets current value of the gauge.
+
+    :param name: name of the gauge.
+    :type name: str
+    :param value: current value.
+    :type value: float
+    :return: None
+    """
+
+    with metrics_lock:
+        gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    """
+    Adds value to histogram. Creates the histogram if it doesn't exist.
+
+    :param name: name of the histogram.
+    :type name: str
+    :param value: observed value.
+    :type value: float
+    :return: None
+    """
+
+    with metrics_lock:
+        if name not in histograms:
+            histograms[name] = Histogram()
+        histograms[name].observe(value)
+
+
+def get_metrics() -> Dict[str, Dict[str, float]]:
+    """
+    Returns a copy of all metrics.
+
+    :return: dict with counters, gauges and histograms summaries.
+    :rtype: Dict[str, Dict[str, float]]
+    """
+
+    with metrics_lock:
+        return {
+            "counters": dict(counters),
+            "gauges": dict(gauges),
+            "histograms": {name: histogram.to_dict() for name, histogram in histograms.items()}
+        }
+
+
+def get_histograms() -> Dict[str, Histogram]:
+    """
+    Returns copies of all histograms (with buckets, unlike get_metrics).
+
+    :return: histograms by names.
+    :rtype: Dict[str, Histogram]
+    """
+
+    with metrics_lock:
+        return {name: histogram.copy() for name, histogram in histograms.items()}
+
+
+@contextmanager
+def stage_scope(name: str, kind: str = "stage") -> Iterator[None]:
+    """
+    Context manager to measure a stage of scenario (or a handler of updates).
+    Records {kind}.latency.{name} histogram and {kind}.calls.{name}, {kind}.errors.{name} counters.
+    Metrics recorded by increment_for_stage and observe_for_stage inside the scope are attributed to the stage.
+
+    :param name: name of the stage.
+    :type name: str
+    :param kind: kind of measured scope ("stage" or "handler").
+    :type kind: str
+    :return: None
+    """
+
+    token = current_stage.set(name)
+    start = monotonic()
+    try:
+        yield
+    except Exception:
+        increment(f"{kind}.errors.{name}")
+        raise
+    finally:
+        current_stage.reset(token)
+        observe(f"{kind}.latency.{name}", monotonic() - start)
+        increment(f"{kind}.calls.{name}")
+
+
+def increment_for_stage(name: str, value: float = 1) -> None:
+    """
+    Increases counter {name}.{current stage} by passed value.
+
+    :param name: name of the counter without stage.
+    :type name: str
+    :param value: value to add.
+    :type value: float
+    :return: None
+    """
+
+    increment(f"{name}.{current_stage.get()}", value)
+
+
+def observe_for_stage(name: str, value: float) -> None:
+    """
+    Adds value to histogram {name}.{current stage}.
+
+    :param name: name of the histogram without stage.
+    :type name: str
+    :param value: observed value.
+    :type value: float
+    :return: None
+    """
+
+    observe(f"{name}.{current_stage.get()}", value)
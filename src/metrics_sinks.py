@@ -0,0 +1,328 @@
+"""
+Export of in-process metrics (see src.metrics): Prometheus text endpoint, StatsD and log.
+"""
+
+from abc import ABC, abstractmethod
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Event
+from typing import Dict, List, Tuple, Optional
+from urllib.parse import urlparse, parse_qs
+from src.metrics import get_metrics, get_histograms, Histogram, metrics_lock, counters, gauges
+import json
+import logging
+import re
+import socket
+
+
+logger = logging.getLogger(__name__)
+
+default_interval = 60
+metrics_prefix = "hotels_bot"
+
+labelled_families = ("stage", "handler", "worker")
+
+
+def format_value(value: float) -> str:
+    """
+    Formats value of metric without exponent (1000000000 instead of 1e+09).
+
+    :param value: value of metric.
+    :type value: float
+    :return: formatted value.
+    :rtype: str
+    """
+
+    if value == int(value):
+        return str(int(value))
+    return f"{value:.6f}".rstrip("0")
+
+
+class MetricsSink(ABC):
+    """
+    Abstract exporter of metrics.
+    """
+
+    @abstractmethod
+    def start(self) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+class PeriodicSink(MetricsSink, ABC):
+    """
+    Exporter which sends metrics every interval seconds from daemon thread.
+
+    Args:
+        :interval (float):   time between exports in seconds.
+        :stop_event (Event):   event to stop exporting.
+    """
+
+    def __init__(self, interval: float = default_interval):
+        self.interval: float = interval
+        self.stop_event: Event = Event()
+
+    def start(self) -> None:
+        Thread(target=self.run, name=type(self).__name__, daemon=True).start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.export()
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.export()
+            except Exception:
+                logger.exception("metrics export failed")
+
+    @abstractmethod
+    def export(self) -> None:
+        pass
+
+
+class LogSink(PeriodicSink):
+    """
+    Writes all metrics to log in json.
+    """
+
+    def export(self) -> None:
+        logger.info("metrics: %s", json.dumps(get_metrics(), sort_keys=True))
+
+
+class StatsDSink(PeriodicSink):
+    """
+    Sends metrics to StatsD server over UDP. Counters are sent as increments since the last export,
+    histograms as count and sum increments and p50, p90, p99 gauges.
+
+    Args:
+        :address (Tuple[str, int]):   host and port of StatsD server.
+        :prefix (str):   prefix of all metrics names.
+        :sent_counters (Dict[str, float]):   values of counters at the last export.
+    """
+
+    max_packet = 1400
+
+    def __init__(self, host: str, port: int, prefix: str = metrics_prefix, interval: float = 10):
+        super().__init__(interval=interval)
+        self.address: Tuple[str, int] = (host, port)
+        self.prefix: str = prefix
+        self.sent_counters: Dict[str, float] = dict()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def delta(self, name: str, value: float) -> float:
+        """
+        Returns increment of the counter since the last export.
+
+        :param name: name of the counter.
+        :type name: str
+        :param value: current value.
+        :type value: float
+        :return: increment.
+        :rtype: float
+        """
+
+        result = value - self.sent_counters.get(name, 0)
+        self.sent_counters[name] = value
+        return result
+
+    def lines(self) -> List[str]:
+        """
+        Creates StatsD lines for all metrics.
+
+        :return: lines in StatsD format.
+        :rtype: List[str]
+        """
+
+        metrics = get_metrics()
+        lines = []
+        for name, value in metrics["counters"].items():
+            delta = self.delta(name, value)
+            if delta:
+                lines.append(f"{self.prefix}.{name}:{format_value(delta)}|c")
+        for name, value in metrics["gauges"].items():
+            lines.append(f"{self.prefix}.{name}:{format_value(value)}|g")
+        for name, summary in metrics["histograms"].items():
+            for key in ("count", "sum"):
+                delta = self.delta(f"{name}.{key}", summary[key])
+                if delta:
+                    lines.append(f"{self.prefix}.{name}.{key}:{format_value(delta)}|c")
+            for key in ("p50", "p90", "p99"):
+                if summary[key] != float("inf"):
+                    lines.append(f"{self.prefix}.{name}.{key}:{format_value(summary[key])}|g")
+        return lines
+
+    def export(self) -> None:
+        packet = ""
+        for line in self.lines():
+            if packet and len(packet) + len(line) + 1 > self.max_packet:
+                self.socket.sendto(packet.encode(), self.address)
+                packet = ""
+            packet = f"{packet}\n{line}" if packet else line
+        if packet:
+            self.socket.sendto(packet.encode(), self.address)
+
+
+def prometheus_name(name: str) -> Tuple[str, str]:
+    """
+    Converts name of metric to Prometheus name and labels.
+    Metrics of stages, handlers and workers (stage.latency.set_check_in) get stage name as label
+    (hotels_bot_stage_latency{stage="set_check_in"}).
+
+    :param name: name of metric.
+    :type name: str
+    :return: Prometheus name and labels string (empty if there are no labels).
+    :rtype: Tuple[str, str]
+    """
+
+    labels = ""
+    parts = name.split(".")
+    if parts[0] in labelled_families and len(parts) == 3:
+        labels = f'{{{parts[0]}="{parts[2]}"}}'
+        parts = parts[:2]
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join([metrics_prefix] + parts)), labels
+
+
+def prometheus_text() -> str:
+    """
+    Creates text exposition of all metrics in Prometheus format.
+
+    :return: metrics in Prometheus text format.
+    :rtype: str
+    """
+
+    with metrics_lock:
+        metrics = {"counter": dict(counters), "gauge": dict(gauges)}
+    histograms = get_histograms()
+
+    families: Dict[str, Tuple[str, List[str]]] = dict()
+    for kind, values in metrics.items():
+        for name, value in sorted(values.items()):
+            metric, labels = prometheus_name(name)
+            if kind == "counter":
+                metric += "_total"
+            families.setdefault(metric, (kind, []))[1].append(f"{metric}{labels} {format_value(value)}")
+    for name, histogram in sorted(histograms.items()):
+        metric, labels = prometheus_name(name)
+        families.setdefault(metric, ("histogram", []))[1].extend(histogram_lines(metric, labels, histogram))
+
+    text = []
+    for metric, (kind, lines) in families.items():
+        text.append(f"# TYPE {metric} {kind}")
+        text.extend(lines)
+    return "\n".join(text) + "\n"
+
+
+def histogram_lines(metric: str, labels: str, histogram: Histogram) -> List[str]:
+    """
+    Creates Prometheus lines of histogram (cumulative buckets, sum and count).
+
+    :param metric: Prometheus name of histogram.
+    :type metric: str
+    :param labels: labels of histogram.
+    :type labels: str
+    :param histogram: histogram.
+    :type histogram: Histogram
+    :return: lines in Prometheus format.
+    :rtype: List[str]
+    """
+
+    bucket_labels = labels[1:-1] + "," if labels else ""
+    lines, total = [], 0
+    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+        total += count
+        le = "+Inf" if bound == float("inf") else format_value(bound)
+        lines.append(f'{metric}_bucket{{{bucket_labels}le="{le}"}} {total}')
+    lines.append(f"{metric}_sum{labels} {format_value(histogram.sum)}")
+    lines.append(f"{metric}_count{labels} {histogram.count}")
+    return lines
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    """
+    Handler of Prometheus scrapes (GET /metrics).
+    """
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class PrometheusSink(MetricsSink):
+    """
+    HTTP endpoint /metrics for Prometheus.
+
+    Args:
+        :address (Tuple[str, int]):   host and port to listen.
+        :server (Optional[ThreadingHTTPServer]):   started server.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.address: Tuple[str, int] = (host, port)
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> None:
+        self.server = ThreadingHTTPServer(self.address, PrometheusHandler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, name="prometheus_sink", daemon=True).start()
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def create_sink(sink_url: str) -> MetricsSink:
+    """
+    Creates exporter of metrics by its url:
+        log:60 (interval in seconds)
+        statsd://host:port?prefix=hotels_bot&interval=10
+        prometheus://host:port
+
+    :param sink_url: url of exporter.
+    :type sink_url: str
+    :return: exporter of metrics.
+    :rtype: MetricsSink
+    :raise ValueError: if url scheme is unknown.
+    """
+
+    scheme, path = sink_url.split(":", 1)
+    if scheme == "log":
+        return LogSink(interval=float(path or default_interval))
+    parsed = urlparse(sink_url)
+    if scheme == "statsd":
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        return StatsDSink(host=parsed.hostname or "localhost",
+                          port=parsed.port or 8125,
+                          prefix=params.get("prefix", metrics_prefix),
+                          interval=float(params.get("interval", 10)))
+    if scheme == "prometheus":
+        return PrometheusSink(host=parsed.hostname or "0.0.0.0", port=parsed.port or 9100)
+    raise ValueError(f"unknown metrics sink {sink_url}")
+
+
+def start_sinks(sinks_urls: str) -> List[MetricsSink]:
+    """
+    Starts exporters of metrics.
+
+    :param sinks_urls: comma separated urls of exporters (see create_sink). Empty string disables export.
+    :type sinks_urls: str
+    :return: started exporters.
+    :rtype: List[MetricsSink]
+    """
+
+    sinks = [create_sink(sink_url.strip()) for sink_url in sinks_urls.split(",") if sink_url.strip()]
+    for sink in sinks:
+        sink.start()
+    return sinks
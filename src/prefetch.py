@@ -0,0 +1,157 @@
+"""
+Speculative prefetch of hotels list and hotels photos while the user is still answering
+the last questions of the search (photos, price, distance).
+"""
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextvars import copy_context
+from json import loads, JSONDecodeError
+from threading import Event
+from typing import Dict, Any, Hashable, List, Optional
+from src.base import UserRequest
+from src.cache import TTLCache
+from src.hotels_api import url, endpoints, hotels_list_querystring, request_to_hotels_api, \
+    request_key, prefetched_responses, sort_hotels
+from bot_settings import PREFETCH
+
+
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+stopped = Event()
+
+
+class Prefetch:
+    """
+    Prefetch started for a user.
+
+    Args:
+        :key (Hashable):   key of hotels list request.
+        :keys (List[Hashable]):   keys of all prefetched requests (list and photos).
+        :cancelled (Event):   is set when the user changed the search.
+        :future (Optional[Future]):   the prefetch task.
+    """
+
+    def __init__(self, key: Hashable):
+        self.key: Hashable = key
+        self.keys: List[Hashable] = [key]
+        self.cancelled = Event()
+        self.future: Optional[Future] = None
+
+
+prefetches = TTLCache(maxsize=1000, ttl=PREFETCH["ttl"])
+
+
+def start_prefetch(user: UserRequest) -> None:
+    """
+    Starts prefetch of hotels list for the user's search and photos of hotels
+    which will probably be shown. Photos in /bestdeal scenario are prefetched
+    only when max distance is known.
+    Prefetch of the same hotels list which is already started is reused.
+    Upstream calls of prefetch are attributed to the stage which started it (see src.metrics).
+
+    :param user: user which has filled all params of hotels list request.
+    :type user: UserRequest
+    :return: None
+    """
+
+    if not PREFETCH["enabled"] or stopped.is_set():
+        return
+    request_data, adults, children = user.prepare_request_data()
+    del request_data["hotel_count"]
+    querystring = hotels_list_querystring(**request_data,
+                                          adults=adults,
+                                          children=children,
+                                          command=user.command)
+    key = request_key(_url=url, endpoint=endpoints["hotels_list"], querystring=querystring)
+
+    prefetch = Prefetch(key=key)
+    previous = prefetches.get(user.user_id)
+    if previous is not None:
+        if previous.key == key:
+            previous.cancelled.set()
+            prefetch.keys = previous.keys
+        else:
+            cancel_prefetch(user_id=user.user_id)
+
+    prefetches.set(user.user_id, prefetch)
+    prefetch.future = executor.submit(copy_context().run, prefetch_hotels,
+                                      prefetch=prefetch,
+                                      querystring=querystring,
+                                      command=user.command,
+                                      hotel_count=int(user.hotel_count),
+                                      distance=user.distance)
+
+
+def prefetch_hotels(prefetch: Prefetch, querystring: Dict[str, str], command: str,
+                    hotel_count: int, distance: Optional[float]) -> None:
+    """
+    Prefetch task. Gets hotels list (if it isn't prefetched yet) and photos of the first hotels.
+
+    :param prefetch: the prefetch.
+    :type prefetch: Prefetch
+    :param querystring: params of hotels list request.
+    :type querystring: Dict[str, str]
+    :param command: user's command for searching hotels.
+    :type command: str
+    :param hotel_count: number of hotels which will be shown.
+    :type hotel_count: int
+    :param distance: max distance from hotel to city center (/bestdeal scenario).
+    :type distance: Optional[float]
+    :return: None
+    """
+
+    response = prefetched_responses.get(prefetch.key)
+    if response is None:
+        response = request_to_hotels_api(_url=url,
+                                         endpoint=endpoints["hotels_list"],
+                                         querystring=querystring,
+                                         prefetch=True)
+    if not response or not PREFETCH["photos"] or (command == "/bestdeal" and distance is None):
+        return
+
+    try:
+        hotels: List[Dict[str, Any]] = sort_hotels(command=command,
+                                                   hotels=loads(response)["data"]["body"]["searchResults"]["results"],
+                                                   distance=distance)
+    except (JSONDecodeError, KeyError, TypeError):
+        return
+    for hotel in hotels[:hotel_count]:
+        if prefetch.cancelled.is_set():
+            return
+        photo_querystring = {"id": str(hotel["id"])}
+        prefetch.keys.append(request_key(_url=url, endpoint=endpoints["photo"], querystring=photo_querystring))
+        if prefetched_responses.get(prefetch.keys[-1]) is None:
+            request_to_hotels_api(_url=url,
+                                  endpoint=endpoints["photo"],
+                                  querystring=photo_querystring,
+                                  prefetch=True)
+
+
+def cancel_prefetch(user_id: int) -> None:
+    """
+    Cancels the user's prefetch and removes prefetched responses when the user changes the search.
+    Request which is already sent to rapidapi can't be stopped.
+
+    :param user_id: id of user.
+    :type user_id: int
+    :return: None
+    """
+
+    prefetch = prefetches.pop(user_id)
+    if prefetch is None:
+        return
+    prefetch.cancelled.set()
+    if prefetch.future is not None:
+        prefetch.future.cancel()
+    for key in prefetch.keys:
+        prefetched_responses.pop(key)
+
+
+def stop_prefetches() -> None:
+    """
+    Cancels prefetches which haven't started on shutdown. New prefetches can't be started after that.
+
+    :return: None
+    """
+
+    stopped.set()
+    executor.shutdown(wait=False, cancel_futures=True)
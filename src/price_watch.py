@@ -0,0 +1,370 @@
+"""
+Watching of saved searches for price drops (see PRICE_WATCH in bot_settings).
+Identical searches of different users are kept as one query (see query_key), so every check
+makes one rapidapi request for all watchers. The scheduler checks up to checks_per_tick overdue
+queries every tick seconds and reschedules them with jitter, so checks are spread over time.
+Prices are compared with the snapshot of the previous check and only changes are sent
+to watchers through the batched notifier.
+"""
+
+from threading import Thread, Event, Lock
+from collections import deque
+from datetime import date
+from hashlib import sha1
+from json import dumps, loads
+from math import ceil
+from random import uniform
+from time import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from telebot.apihelper import ApiTelegramException
+from src.base import UserRequest
+from src.bot_text import price_watch_dict, hotels_link
+from src.hotels_api import search_hotels, sort_price
+from src.quota import LOW_PRIORITY
+from src.metrics import increment, set_gauge
+from db.price_watch_db import count_user_watches, add_watch, remove_user_watches, remove_queries, \
+    get_due_queries, save_check, get_watchers
+from bot_settings import bot, PRICE_WATCH
+import logging
+
+logger = logging.getLogger(__name__)
+
+schedule_jitter = 0.1
+fingerprint_length = 16
+
+
+def watch_params(user: UserRequest) -> Dict[str, Any]:
+    """
+    Collects params of user's search which are needed to repeat it.
+
+    :param user: user which made the search.
+    :type user: UserRequest
+    :return: params of search_hotels (dates in ISO format).
+    :rtype: Dict[str, Any]
+    """
+
+    _, adults, children = user.prepare_request_data()
+    return {
+        "destination_id": user.destination_id,
+        "hotel_count": user.hotel_count,
+        "check_in": user.check_in.isoformat(),
+        "check_out": user.check_out.isoformat(),
+        "adults": adults,
+        "children": children,
+        "command": user.command,
+        "min_price": user.min_price,
+        "max_price": user.max_price,
+        "distance": user.distance
+    }
+
+
+def query_key(params: Dict[str, Any]) -> str:
+    """
+    Creates key of the query: searches with the same params have the same key.
+
+    :param params: params of the search (see watch_params).
+    :type params: Dict[str, Any]
+    :return: hex digest of params.
+    :rtype: str
+    """
+
+    return sha1(dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def search_fingerprint(user: UserRequest) -> str:
+    """
+    Creates short key of user's current search for callback data of "watch" button,
+    so the button of previous search doesn't save the changed search.
+
+    :param user: user which made the search.
+    :type user: UserRequest
+    :return: beginning of the query key.
+    :rtype: str
+    """
+
+    return query_key(watch_params(user))[:fingerprint_length]
+
+
+def save_watch(user: UserRequest, fingerprint: str) -> str:
+    """
+    Subscribes user to price changes of the finished search.
+
+    :param user: user which made the search.
+    :type user: UserRequest
+    :param fingerprint: fingerprint of the search from callback data (see search_fingerprint).
+    :type fingerprint: str
+    :return: result: "saved", "exists", "limit" or "outdated" (the search was changed).
+    :rtype: str
+    """
+
+    if not (user.search_finished and user.destination_id and user.check_in and user.check_out):
+        return "outdated"
+    params = watch_params(user)
+    key = query_key(params)
+    if not key.startswith(fingerprint):
+        return "outdated"
+    if count_user_watches(telegram_id=user.user_id) >= PRICE_WATCH["max_per_user"]:
+        return "limit"
+    now = time()
+    if not add_watch(telegram_id=user.user_id, query_key=key, params=dumps(params),
+                     location=user.location_name, first_check=now, created=now):
+        return "exists"
+    increment("price_watch.saved")
+    return "saved"
+
+
+def price_snapshot(hotels: List[Dict[Any, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Creates snapshot of prices.
+
+    :param hotels: hotels dicts from rapidapi.
+    :type hotels: List[Dict[Any, Any]]
+    :return: dict "hotel id": {"name": hotel name, "price": price per night (0 if it isn't found)}.
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+
+    return {str(hotel["id"]): {"name": hotel["name"], "price": sort_price(hotel)} for hotel in hotels}
+
+
+def find_changes(old: Dict[str, Dict[str, Any]],
+                 new: Dict[str, Dict[str, Any]]) -> List[Tuple[str, Optional[float], Dict[str, Any]]]:
+    """
+    Compares snapshots of prices: finds hotels which became cheaper at least by min_drop
+    and hotels which appeared in the search results.
+
+    :param old: snapshot of the previous check.
+    :type old: Dict[str, Dict[str, Any]]
+    :param new: snapshot of the current check.
+    :type new: Dict[str, Dict[str, Any]]
+    :return: list of (hotel id, previous price or None for new hotel, hotel from new snapshot).
+    :rtype: List[Tuple[str, Optional[float], Dict[str, Any]]]
+    """
+
+    changes = []
+    for hotel_id, hotel in new.items():
+        previous = old.get(hotel_id)
+        if not hotel["price"]:
+            continue
+        if previous is None:
+            changes.append((hotel_id, None, hotel))
+        elif previous["price"] and hotel["price"] <= previous["price"] * (1 - PRICE_WATCH["min_drop"]):
+            changes.append((hotel_id, previous["price"], hotel))
+    return changes
+
+
+def format_changes(location: str, params: Dict[str, Any],
+                   changes: List[Tuple[str, Optional[float], Dict[str, Any]]]) -> str:
+    """
+    Creates text of notification (MARKDOWN parse mode).
+
+    :param location: location name.
+    :type location: str
+    :param params: params of the search.
+    :type params: Dict[str, Any]
+    :param changes: changes of prices (see find_changes).
+    :type changes: List[Tuple[str, Optional[float], Dict[str, Any]]]
+    :return: text of message.
+    :rtype: str
+    """
+
+    text = price_watch_dict["header"].format(location=location, check_in=params["check_in"],
+                                             check_out=params["check_out"])
+    for hotel_id, previous, hotel in changes:
+        line = price_watch_dict["new"] if previous is None else price_watch_dict["drop"]
+        text += line.format(name=hotel["name"], link=hotels_link["link"], id=hotel_id,
+                            old=ceil(previous or 0), new=ceil(hotel["price"]))
+    return text
+
+
+def next_check_time(now: float) -> float:
+    """
+    Calculates time of the next check with jitter, so queries saved at the same time
+    are checked at different times.
+
+    :param now: current time.
+    :type now: float
+    :return: timestamp of the next check.
+    :rtype: float
+    """
+
+    return now + PRICE_WATCH["interval"] * uniform(1 - schedule_jitter, 1 + schedule_jitter)
+
+
+def check_query(key: str, params_json: str, location: str, snapshot_json: Optional[str]) -> int:
+    """
+    Repeats the search and notifies watchers about changes of prices.
+    The first check only saves the snapshot. If rapidapi doesn't answer (or the plan budget
+    is almost spent, checks have low priority) the snapshot is kept till the next check.
+
+    :param key: key of the query.
+    :type key: str
+    :param params_json: params of the search (JSON).
+    :type params_json: str
+    :param location: location name.
+    :type location: str
+    :param snapshot_json: snapshot of the previous check (JSON) or None.
+    :type snapshot_json: Optional[str]
+    :return: number of queued notifications.
+    :rtype: int
+    """
+
+    params = loads(params_json)
+    search = dict(params, check_in=date.fromisoformat(params["check_in"]),
+                  check_out=date.fromisoformat(params["check_out"]))
+    hotels, _, stale = search_hotels(**search, priority=LOW_PRIORITY)
+    increment("price_watch.checks")
+    if hotels is None or stale:
+        increment("price_watch.failed_checks")
+        save_check(query_key=key, next_check=next_check_time(time()))
+        return 0
+
+    snapshot = price_snapshot(hotels)
+    save_check(query_key=key, next_check=next_check_time(time()), snapshot=dumps(snapshot))
+    if snapshot_json is None:
+        return 0
+    changes = find_changes(old=loads(snapshot_json), new=snapshot)
+    if not changes:
+        return 0
+
+    text = format_changes(location=location, params=params, changes=changes)
+    watchers = get_watchers(query_key=key)
+    for telegram_id in watchers:
+        notifier.put(telegram_id=telegram_id, text=text)
+    increment("price_watch.notifications", len(watchers))
+    return len(watchers)
+
+
+def run_checks(now: float) -> int:
+    """
+    Checks up to checks_per_tick overdue queries. Queries with check-in date in the past are removed.
+
+    :param now: current time.
+    :type now: float
+    :return: number of checked queries.
+    :rtype: int
+    """
+
+    due = get_due_queries(timestamp=now, limit=PRICE_WATCH["checks_per_tick"])
+    expired = [key for key, params, _, _ in due if date.fromisoformat(loads(params)["check_in"]) < date.today()]
+    if expired:
+        remove_queries(query_keys=expired)
+        increment("price_watch.expired", len(expired))
+    checked = 0
+    for key, params, location, snapshot in due:
+        if key in expired:
+            continue
+        try:
+            check_query(key=key, params_json=params, location=location, snapshot_json=snapshot)
+        except Exception:
+            logger.exception("price watch check of %s failed", key)
+            save_check(query_key=key, next_check=next_check_time(now))
+        checked += 1
+    return checked
+
+
+class Notifier:
+    """
+    Batched sender of notifications: messages are queued by the scheduler and sent
+    by batch_size messages every interval seconds, so a check with many watchers doesn't exceed
+    Telegram limits. Users who blocked the bot are unsubscribed from all queries.
+
+    Args:
+        :batch_size (int):   max number of messages sent at once.
+        :interval (float):   time between batches in seconds.
+        :queue (Deque[Tuple[int, str]]):   queued (telegram id, text).
+    """
+
+    def __init__(self, batch_size: int, interval: float):
+        self.batch_size: int = batch_size
+        self.interval: float = interval
+        self.queue: Deque[Tuple[int, str]] = deque()
+        self.lock = Lock()
+
+    def put(self, telegram_id: int, text: str) -> None:
+        """
+        Queues notification.
+
+        :param telegram_id: telegram id of user.
+        :type telegram_id: int
+        :param text: text of message (MARKDOWN parse mode).
+        :type text: str
+        :return: None
+        """
+
+        with self.lock:
+            self.queue.append((telegram_id, text))
+
+    def send_batch(self) -> int:
+        """
+        Sends up to batch_size queued notifications.
+
+        :return: number of processed notifications.
+        :rtype: int
+        """
+
+        with self.lock:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            set_gauge("price_watch.queued", len(self.queue))
+        for telegram_id, text in batch:
+            try:
+                bot.send_message(text=text,
+                                 chat_id=telegram_id,
+                                 parse_mode="MARKDOWN",
+                                 disable_web_page_preview=True)
+            except ApiTelegramException as error:
+                increment("price_watch.failed_notifications")
+                if error.error_code == 403:
+                    remove_user_watches(telegram_id=telegram_id)
+        return len(batch)
+
+    def run(self, stop_event: Event) -> None:
+        """
+        Sends batches every interval seconds until stop_event is set, then sends the rest.
+
+        :param stop_event: event to stop sending.
+        :type stop_event: Event
+        :return: None
+        """
+
+        while not stop_event.wait(self.interval):
+            self.send_batch()
+        while self.send_batch():
+            pass
+
+
+notifier = Notifier(batch_size=PRICE_WATCH["batch_size"], interval=PRICE_WATCH["batch_interval"])
+
+
+def watch(stop_event: Event, tick: float) -> None:
+    """
+    Runs checks every `tick` seconds until stop_event is set.
+    Errors are logged, so the scheduler keeps running.
+
+    :param stop_event: event to stop checks.
+    :type stop_event: Event
+    :param tick: time between runs in seconds.
+    :type tick: float
+    :return: None
+    """
+
+    while not stop_event.wait(tick):
+        try:
+            run_checks(now=time())
+        except Exception:
+            logger.exception("price watch checks failed")
+
+
+def start_price_watch(tick: Optional[float] = None) -> Event:
+    """
+    Starts the scheduler of checks and the notifier in daemon threads.
+
+    :param tick: time between runs of checks in seconds (PRICE_WATCH["tick"] by default).
+    :type tick: Optional[float]
+    :return: event to stop both threads.
+    :rtype: Event
+    """
+
+    stop_event = Event()
+    Thread(target=watch, args=(stop_event, tick or PRICE_WATCH["tick"]), name="price_watch", daemon=True).start()
+    Thread(target=notifier.run, args=(stop_event,), name="price_watch_notifier", daemon=True).start()
+    return stop_event
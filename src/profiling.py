@@ -0,0 +1,322 @@
+"""
+Opt-in profiling of updates handling (see PROFILING in bot_settings).
+A fraction of updates is profiled with cProfile, updates handled longer than slow_threshold
+are profiled with sampling of their stacks. Profiles are written to rotating directory,
+file names contain handler name and stage of the user.
+
+Report with top functions of saved profiles:
+    python -m src.profiling --top 20
+    python -m src.profiling --handler go_to_searching --sort tottime
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from cProfile import Profile
+from datetime import datetime
+from threading import Thread, Lock, get_ident
+from time import monotonic, sleep
+from typing import Dict, Iterator, Optional, List, Tuple
+from bot_settings import PROFILING
+import argparse
+import io
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+sampling_interval = 0.01
+
+sampled_updates: Dict[int, 'SampledUpdate'] = dict()
+sampled_lock = Lock()
+sampler: Optional[Thread] = None
+
+
+class SampledUpdate:
+    """
+    Stacks samples of update which is handled in a thread.
+
+    Args:
+        :thread_id (int):   id of thread handling the update.
+        :stacks (Counter):   number of samples of every stack ("file:function;file:function").
+    """
+
+    def __init__(self, thread_id: int):
+        self.thread_id: int = thread_id
+        self.stacks: Counter = Counter()
+
+
+def frame_name(frame) -> str:
+    """
+    Creates name of stack frame "file:function:line".
+
+    :param frame: stack frame.
+    :return: name of frame.
+    :rtype: str
+    """
+
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}"
+
+
+def sample_stacks() -> None:
+    """
+    Samples stacks of all updates in progress every sampling_interval seconds.
+
+    :return: None
+    """
+
+    while True:
+        sleep(sampling_interval)
+        with sampled_lock:
+            updates = list(sampled_updates.values())
+        if not updates:
+            continue
+        frames = sys._current_frames()
+        for update in updates:
+            frame, stack = frames.get(update.thread_id), []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                update.stacks[";".join(reversed(stack))] += 1
+
+
+def start_sampler() -> None:
+    """
+    Starts sampling thread if it isn't started yet.
+
+    :return: None
+    """
+
+    global sampler
+    with sampled_lock:
+        if sampler is None:
+            sampler = Thread(target=sample_stacks, name="profiling_sampler", daemon=True)
+            sampler.start()
+
+
+def user_stage(user_id: int) -> str:
+    """
+    Returns stage of the user from current unit of work (without loading the state from DB).
+
+    :param user_id: id of user.
+    :type user_id: int
+    :return: stage of user or "unknown".
+    :rtype: str
+    """
+
+    from db.userstates_db import current_unit
+
+    unit = current_unit.get()
+    user = unit.users.get(user_id) if unit else None
+    return getattr(user, "stage", None) or "unknown"
+
+
+def save_profile(handler: str, stage: str, latency: float, extension: str, content: bytes) -> str:
+    """
+    Writes profile to PROFILING["directory"]. The oldest profiles are removed
+    when there are more than PROFILING["max_files"] files.
+
+    :param handler: name of handler.
+    :type handler: str
+    :param stage: stage of user.
+    :type stage: str
+    :param latency: handling time in seconds.
+    :type latency: float
+    :param extension: "prof" for cProfile stats, "folded" for sampled stacks.
+    :type extension: str
+    :param content: content of file.
+    :type content: bytes
+    :return: path of profile.
+    :rtype: str
+    """
+
+    directory = PROFILING["directory"]
+    os.makedirs(directory, exist_ok=True)
+    name = f"{datetime.now():%Y%m%d-%H%M%S-%f}_{handler}_{stage}_{latency * 1000:.0f}ms.{extension}"
+    path = os.path.join(directory, name)
+    with open(path, "wb") as file:
+        file.write(content)
+
+    profiles = sorted(os.listdir(directory))
+    for old_name in profiles[:max(0, len(profiles) - PROFILING["max_files"])]:
+        try:
+            os.remove(os.path.join(directory, old_name))
+        except OSError:
+            pass
+    return path
+
+
+@contextmanager
+def profile_update(handler: str, user_id: int) -> Iterator[None]:
+    """
+    Context manager to profile handling of update. Does nothing if profiling is disabled.
+    Profiles with cProfile PROFILING["sample_rate"] fraction of updates, other updates are sampled
+    by stacks and saved if they were handled longer than PROFILING["slow_threshold"] seconds.
+
+    :param handler: name of handler.
+    :type handler: str
+    :param user_id: id of user who sent the update.
+    :type user_id: int
+    :return: None
+    """
+
+    if not PROFILING["enabled"]:
+        yield
+        return
+
+    profile, sampled = None, None
+    if random.random() < PROFILING["sample_rate"]:
+        profile = Profile()
+    elif PROFILING["slow_threshold"]:
+        start_sampler()
+        sampled = SampledUpdate(thread_id=get_ident())
+        with sampled_lock:
+            sampled_updates[sampled.thread_id] = sampled
+
+    start = monotonic()
+    if profile:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile:
+            profile.disable()
+        latency = monotonic() - start
+        if sampled:
+            with sampled_lock:
+                sampled_updates.pop(sampled.thread_id, None)
+        try:
+            if profile:
+                profile.create_stats()
+                save_profile(handler=handler, stage=user_stage(user_id), latency=latency,
+                             extension="prof", content=marshal.dumps(profile.stats))
+            elif sampled and latency >= PROFILING["slow_threshold"] and sampled.stacks:
+                content = "\n".join(f"{stack} {count}" for stack, count in sampled.stacks.items())
+                save_profile(handler=handler, stage=user_stage(user_id), latency=latency,
+                             extension="folded", content=content.encode())
+        except OSError:
+            logger.exception("profile of %s isn't saved", handler)
+
+
+def select_profiles(directory: str, handler: Optional[str] = None,
+                    stage: Optional[str] = None) -> List[str]:
+    """
+    Finds profiles of the handler and the stage.
+
+    :param directory: directory with profiles.
+    :type directory: str
+    :param handler: name of handler (all handlers if it isn't passed).
+    :type handler: Optional[str]
+    :param stage: name of stage (all stages if it isn't passed).
+    :type stage: Optional[str]
+    :return: paths of profiles.
+    :rtype: List[str]
+    """
+
+    paths = []
+    if not os.path.isdir(directory):
+        return paths
+    for name in sorted(os.listdir(directory)):
+        try:
+            _, profile_handler, profile_stage, _ = parse_name(name)
+        except ValueError:
+            continue
+        if handler and profile_handler != handler or stage and profile_stage != stage:
+            continue
+        paths.append(os.path.join(directory, name))
+    return paths
+
+
+def parse_name(name: str) -> Tuple[str, str, str, str]:
+    """
+    Parses name of profile "{time}_{handler}_{stage}_{latency}ms.{extension}".
+    Handlers and stages names may contain underscores, stage is one of src.bot_stages
+    or "unknown".
+
+    :param name: name of profile file.
+    :type name: str
+    :return: time, handler, stage and latency.
+    :rtype: Tuple[str, str, str, str]
+    :raise ValueError: if name has wrong format.
+    """
+
+    from src.bot_stages import stages
+
+    base, extension = name.rsplit(".", 1)
+    if extension not in ("prof", "folded"):
+        raise ValueError(name)
+    timestamp, rest = base.split("_", 1)
+    rest, latency = rest.rsplit("_", 1)
+    for stage in (*stages, "unknown"):
+        if rest.endswith(f"_{stage}"):
+            return timestamp, rest[:-len(stage) - 1], stage, latency
+    raise ValueError(name)
+
+
+def report(directory: str, top: int = 20, handler: Optional[str] = None,
+           stage: Optional[str] = None, sort: str = "cumulative") -> str:
+    """
+    Aggregates saved profiles into report with top functions.
+
+    :param directory: directory with profiles.
+    :type directory: str
+    :param top: number of functions in report.
+    :type top: int
+    :param handler: name of handler (all handlers if it isn't passed).
+    :type handler: Optional[str]
+    :param stage: name of stage (all stages if it isn't passed).
+    :type stage: Optional[str]
+    :param sort: sorting of cProfile stats ("cumulative" or "tottime").
+    :type sort: str
+    :return: text of report.
+    :rtype: str
+    """
+
+    paths = select_profiles(directory=directory, handler=handler, stage=stage)
+    prof_paths = [path for path in paths if path.endswith(".prof")]
+    folded_paths = [path for path in paths if path.endswith(".folded")]
+    result = io.StringIO()
+
+    if prof_paths:
+        result.write(f"cProfile: {len(prof_paths)} sampled updates\n")
+        stats = pstats.Stats(*prof_paths, stream=result)
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+    if folded_paths:
+        inclusive, own, total = Counter(), Counter(), 0
+        for path in folded_paths:
+            with open(path) as file:
+                for line in file:
+                    stack, count = line.rsplit(" ", 1)
+                    frames = stack.split(";")
+                    total += int(count)
+                    own[frames[-1]] += int(count)
+                    for frame in set(frames):
+                        inclusive[frame] += int(count)
+        result.write(f"Stack samples: {len(folded_paths)} slow updates, {total} samples "
+                     f"({sampling_interval * 1000:.0f} ms each)\n\n")
+        result.write(f"{'own %':>8}{'total %':>9}  function\n")
+        for frame, count in own.most_common(top):
+            result.write(f"{count / total:>8.1%}{inclusive[frame] / total:>9.1%}  {frame}\n")
+
+    if not paths:
+        result.write(f"There are no profiles in {directory}\n")
+    return result.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Top functions of saved profiles of updates")
+    parser.add_argument("--dir", default=PROFILING["directory"])
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--handler", help="name of handler, e.g. go_to_searching")
+    parser.add_argument("--stage", help="stage of user, e.g. set_distance")
+    parser.add_argument("--sort", default="cumulative", choices=("cumulative", "tottime"))
+    options = parser.parse_args()
+    print(report(directory=options.dir, top=options.top, handler=options.handler,
+                 stage=options.stage, sort=options.sort))
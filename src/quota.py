@@ -0,0 +1,307 @@
+"""
+Client-side budget of requests to rapidapi according to the plan limits.
+"""
+
+from threading import Lock, Thread, Event
+from time import monotonic, sleep, time, gmtime, strftime
+from typing import Optional, Mapping, Dict
+from src.metrics import set_gauge, increment
+from db.quota_db import add_quota_usage
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+HIGH_PRIORITY = 0
+LOW_PRIORITY = 1
+
+sync_interval = 60
+
+
+class TokenBucket:
+    """
+    Token bucket to limit requests per second.
+
+    Args:
+        :rate (float):   tokens added per second.
+        :capacity (float):   max number of tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = monotonic()
+        self.lock = Lock()
+
+    def refill(self) -> None:
+        """
+        Adds tokens for time passed since last refill. Must be called under lock.
+
+        :return: None
+        """
+
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout: float, reserve: float = 0) -> bool:
+        """
+        Takes one token. Waits for it up to `timeout` seconds.
+
+        :param timeout: max time to wait for the token in seconds.
+        :type timeout: float
+        :param reserve: number of tokens which can't be taken by this call.
+        :type reserve: float
+        :return: True if the token was taken else False.
+        :rtype: bool
+        """
+
+        deadline = monotonic() + timeout
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens - reserve >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 + reserve - self.tokens) / self.rate
+            if monotonic() + wait > deadline:
+                return False
+            sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket shared by processes of one host (workers of the supervisor, see src.supervisor).
+    Tokens and the last refill time are kept in shared memory, monotonic clock is common
+    for all processes of the host.
+
+    Args:
+        :rate (float):   tokens added per second.
+        :capacity (float):   max number of tokens.
+        :state (multiprocessing.Array):   shared array of two doubles (tokens, last refill time)
+            with lock, zeros are a full bucket.
+    """
+
+    def __init__(self, rate: float, capacity: float, state):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.state = state
+        self.lock = state.get_lock()
+
+    @property
+    def tokens(self) -> float:
+        """ tokens getter """
+
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, value: float) -> None:
+        """ tokens setter """
+
+        self.state[0] = value
+
+    @property
+    def updated(self) -> float:
+        """ last refill time getter """
+
+        return self.state[1]
+
+    @updated.setter
+    def updated(self, value: float) -> None:
+        """ last refill time setter """
+
+        self.state[1] = value
+
+
+class QuotaManager:
+    """
+    Keeps requests to rapidapi within the plan limits:
+    per second limit with a token bucket and monthly limit with a counter which is
+    corrected by rate limit headers of rapidapi responses. The monthly counter is synced
+    with usage of all processes kept in DB (see sync), so it survives restarts.
+    Low priority requests (photos) are queued for a short time only and are rejected
+    when monthly budget becomes tight, so core searches keep working.
+
+    Args:
+        :per_second (float):   requests per second allowed by the plan.
+        :monthly (int):   requests per month allowed by the plan.
+        :low_priority_reserve (float):   part of monthly budget which is available
+            for high priority requests only.
+        :spent (int):   requests made since the last sync.
+        :observed (Optional[int]):   usage reported by rapidapi headers since the last sync.
+    """
+
+    high_priority_timeout = 5
+    low_priority_timeout = 0.5
+
+    def __init__(self, per_second: float, monthly: int, low_priority_reserve: float = 0.2):
+        self.bucket = TokenBucket(rate=per_second, capacity=max(1, per_second))
+        self.monthly: int = monthly
+        self.remaining: int = monthly
+        self.reset_at: Optional[float] = None
+        self.blocked_until: float = 0
+        self.low_priority_reserve: float = low_priority_reserve
+        self.spent: int = 0
+        self.observed: Optional[int] = None
+        self.lock = Lock()
+
+    def acquire(self, priority: int = HIGH_PRIORITY, timeout: Optional[float] = None) -> bool:
+        """
+        Checks the budget before a request. Waits for per second budget if it's needed.
+
+        :param priority: HIGH_PRIORITY or LOW_PRIORITY.
+        :type priority: int
+        :param timeout: max time to wait for per second budget in seconds
+            (high_priority_timeout or low_priority_timeout by default).
+        :type timeout: Optional[float]
+        :return: True if the request may be made else False.
+        :rtype: bool
+        """
+
+        with self.lock:
+            if self.reset_at and time() >= self.reset_at:
+                self.remaining, self.reset_at = self.monthly, None
+            reserve = self.monthly * self.low_priority_reserve if priority == LOW_PRIORITY else 0
+            allowed = self.remaining > reserve and monotonic() >= self.blocked_until
+        if allowed:
+            if priority == LOW_PRIORITY:
+                allowed = self.bucket.acquire(timeout=self.low_priority_timeout if timeout is None else timeout,
+                                              reserve=max(0, min(self.bucket.capacity / 2,
+                                                                 self.bucket.capacity - 1)))
+            else:
+                allowed = self.bucket.acquire(timeout=self.high_priority_timeout if timeout is None else timeout)
+
+        if not allowed:
+            increment(f"quota.rejected.{'low' if priority == LOW_PRIORITY else 'high'}")
+        else:
+            with self.lock:
+                self.remaining -= 1
+                self.spent += 1
+        self.publish()
+        return allowed
+
+    def update(self, status_code: int, response_headers: Mapping[str, str]) -> None:
+        """
+        Corrects the budget using rate limit headers of rapidapi response.
+        Stops all requests for a while if rapidapi answered 429 (Too Many Requests).
+
+        :param status_code: status code of response.
+        :type status_code: int
+        :param response_headers: headers of response.
+        :type response_headers: Mapping[str, str]
+        :return: None
+        """
+
+        headers = {key.lower(): value for key, value in response_headers.items()}
+        with self.lock:
+            try:
+                if "x-ratelimit-requests-limit" in headers:
+                    self.monthly = int(headers["x-ratelimit-requests-limit"])
+                if "x-ratelimit-requests-remaining" in headers:
+                    self.remaining = int(headers["x-ratelimit-requests-remaining"])
+                    self.observed, self.spent = self.monthly - self.remaining, 0
+                if "x-ratelimit-requests-reset" in headers:
+                    self.reset_at = time() + int(headers["x-ratelimit-requests-reset"])
+            except ValueError:
+                pass
+            if status_code == 429:
+                try:
+                    retry_after = float(headers.get("retry-after", 1))
+                except ValueError:
+                    retry_after = 1
+                self.blocked_until = monotonic() + retry_after
+                increment("quota.too_many_requests")
+        self.publish()
+
+    def sync(self) -> None:
+        """
+        Adds requests made since the last sync to usage of the current month in DB
+        (see db.quota_db) and sets remaining budget according to usage of all processes.
+        Requests are kept for the next sync if DB isn't available.
+
+        :return: None
+        """
+
+        with self.lock:
+            spent, observed = self.spent, self.observed
+            self.spent, self.observed = 0, None
+        try:
+            used = add_quota_usage(period=strftime("%Y-%m", gmtime()), spent=spent, observed=observed)
+        except Exception:
+            with self.lock:
+                self.spent += spent
+                if self.observed is None:
+                    self.observed = observed
+            raise
+        with self.lock:
+            if self.observed is None:
+                self.remaining = self.monthly - used - self.spent
+        self.publish()
+
+    def get_budget(self) -> Dict[str, float]:
+        """
+        Returns current budget.
+
+        :return: dict with monthly limit, remaining monthly budget and available per second tokens.
+        :rtype: Dict[str, float]
+        """
+
+        with self.bucket.lock:
+            self.bucket.refill()
+            tokens = self.bucket.tokens
+        return {
+            "monthly_limit": self.monthly,
+            "monthly_remaining": self.remaining,
+            "tokens": tokens
+        }
+
+    def publish(self) -> None:
+        """
+        Updates quota gauges.
+
+        :return: None
+        """
+
+        for name, value in self.get_budget().items():
+            set_gauge(f"quota.{name}", value)
+
+
+def keep_synced(manager: QuotaManager, stop_event: Event, interval: float) -> None:
+    """
+    Syncs the monthly counter at start and every `interval` seconds until stop_event is set.
+    Errors are logged, so syncing keeps running.
+
+    :param manager: quota manager to sync.
+    :type manager: QuotaManager
+    :param stop_event: event to stop syncing.
+    :type stop_event: Event
+    :param interval: time between syncs in seconds.
+    :type interval: float
+    :return: None
+    """
+
+    while True:
+        try:
+            manager.sync()
+        except Exception:
+            logger.exception("quota sync failed")
+        if stop_event.wait(interval):
+            break
+
+
+def start_quota_sync(manager: QuotaManager, interval: float = sync_interval) -> Event:
+    """
+    Starts syncing of the monthly counter in daemon thread.
+
+    :param manager: quota manager to sync.
+    :type manager: QuotaManager
+    :param interval: time between syncs in seconds.
+    :type interval: float
+    :return: event to stop syncing.
+    :rtype: Event
+    """
+
+    stop_event = Event()
+    Thread(target=keep_synced, args=(manager, stop_event, interval), name="quota_sync", daemon=True).start()
+    return stop_event
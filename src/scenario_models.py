@@ -2,14 +2,27 @@
 methods that implement the bot script (creation message texts, keyboards, etc)
 """
 
-from telegram_bot_calendar import DetailedTelegramCalendar
 from telebot.types import InputMediaPhoto
 from src.base import ScenarioKeyboards, DEF_KEYBOARDS
-from src.hotels_api import get_hotel_photos, get_hotels_dict
-from src.bot_text import main_message_text_dict, hotels_link, history_dict
+from src.hotels_api import get_hotel_photos, get_hotels_dict, compare_hotels_dicts, flex_hotels_dicts
+from src.bot_text import main_message_text_dict, hotels_link, history_dict, price_watch_dict
+from src.price_watch import search_fingerprint
 from src.auxiliary_functions import *
 from db.history_db import push_to_db, get_from_db
+from db.price_watch_db import get_user_watches
+from json import loads
 from datetime import datetime
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from contextvars import copy_context
+from functools import partial
+from src.metrics import observe, increment
+from bot_settings import COMPARISON, DATE_FLEX, PRICE_WATCH
+
+
+photos_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hotel_photos")
+photos_wait_budget = 1.5
+photos_upgrade_timeout = 20
 
 
 def generate_main_message_text(user_memory: Dict[str, Any], without_rooms=True) -> str:
@@ -68,7 +81,7 @@ def msg_text_depends_on_msg_id(user: UserRequest, additional_text: str, msg_id:
     return text + additional_text
 
 
-def build_calendar(user: Optional[UserRequest] = None, _id: int = 1) -> DetailedTelegramCalendar:
+def build_calendar(user: Optional[UserRequest] = None, _id: int = 1) -> 'DetailedTelegramCalendar':
     """
     Creates Calendar keyboards in initial stage to set check_in and check_out.
 
@@ -80,12 +93,14 @@ def build_calendar(user: Optional[UserRequest] = None, _id: int = 1) -> Detailed
     :rtype: DetailedTelegramCalendar
     """
 
+    from telegram_bot_calendar import DetailedTelegramCalendar
+
     kwargs = create_calendar_kwargs(_id=_id, user=user)
     return DetailedTelegramCalendar(**kwargs).build()
 
 
 def build_calendar_callback(call_data: str,
-                            user: Optional[UserRequest] = None, _id: int = 1) -> DetailedTelegramCalendar:
+                            user: Optional[UserRequest] = None, _id: int = 1) -> 'DetailedTelegramCalendar':
     """
     Modifies Calendar keyboards set check_in and check_out
     (shows selected years and months).
@@ -102,6 +117,8 @@ def build_calendar_callback(call_data: str,
     :rtype: DetailedTelegramCalendar
     """
 
+    from telegram_bot_calendar import DetailedTelegramCalendar
+
     kwargs = create_calendar_kwargs(_id=_id, user=user)
     return DetailedTelegramCalendar(**kwargs).process(call_data)
 
@@ -341,6 +358,19 @@ def define_location_name(user: UserRequest, call: CallbackQuery) -> None:
         user.main_message = call.message.message_id
     user.location_name = find_location_name(call_json=call.json,
                                             location_id=call.data)
+    clear_start_search(user=user)
+
+
+def clear_start_search(user: UserRequest) -> None:
+    """
+    Clears UserRequest instance start_search and start_search_pool attributes.
+    Removes all messages which were contained in start search pool.
+
+    :param user: UserRequest instance
+    :type user: UserRequest
+    :return: None
+    """
+
     user.start_search = False
     for msg in user.start_search_pool:
         bot.delete_message(chat_id=user.user_id,
@@ -350,21 +380,20 @@ def define_location_name(user: UserRequest, call: CallbackQuery) -> None:
 
 
 def prepare_hotels_message_items(_id: int, data: Dict[str, str],
-                                 need_photo: Union[bool, int]) -> Tuple[str, Union[List[InputMediaPhoto], bool]]:
+                                 photos: Optional[List[str]] = None) -> Tuple[str, Optional[List[InputMediaPhoto]]]:
     """
     Creates a text for message with hotel info.
-    Creates a list wth InputMediaPhoto if the need_photo not False.
+    Creates a list wth InputMediaPhoto if photos are passed.
 
     :param _id: hotel id. Will be used to create a link.
     :type _id: int
     :param data: a dict with all hotel info.
     :type data: Dict[str, str]
-    :param need_photo: user.need_photo argument.
-        a list with photo will be prepared if the need_photo is int.
-    :type need_photo: Union[bool, int]
+    :param photos: urls of hotel photos.
+    :type photos: Optional[List[str]]
     :return: a text for message with hotel info and a list
-        with InputMediaPhoto (in cases where need_photo not False).
-    :rtype: Tuple[str, Union[List[InputMediaPhoto], bool]]
+        with InputMediaPhoto (in cases where photos are passed).
+    :rtype: Tuple[str, Optional[List[InputMediaPhoto]]]
     """
 
     text = ""
@@ -373,51 +402,156 @@ def prepare_hotels_message_items(_id: int, data: Dict[str, str],
         text += f"{key}: {value}\n"
     url = "{0}{1}/".format(hotels_link["link"], _id)
     text += "\n[{0}]({1})".format(hotels_link["text"], url)
-    if need_photo:
-        photos = get_hotel_photos(hotel_id=_id,
-                                  num_of_photo=need_photo)
-        if photos:
-            bot_photos = [InputMediaPhoto(media=photos[i]) if i != 0
-                          else InputMediaPhoto(media=photos[i],
-                                               caption=text,
-                                               parse_mode='MARKDOWN') for i in range(len(photos))]
+    if photos:
+        bot_photos = [InputMediaPhoto(media=photos[i]) if i != 0
+                      else InputMediaPhoto(media=photos[i],
+                                           caption=text,
+                                           parse_mode='MARKDOWN') for i in range(len(photos))]
     return text, bot_photos
 
 
-def send_hotels_messages(hotels: Dict[int, Dict[str, str]], user: UserRequest) -> List[str]:
+def get_photos_result(future: Future) -> Optional[List[str]]:
     """
-    Sends messages with hotels info.
+    Returns photos got by finished future.
+
+    :param future: future of get_hotel_photos call.
+    :type future: Future
+    :return: urls of hotel photos or None if they weren't got.
+    :rtype: Optional[List[str]]
+    """
+
+    if not future.done() or future.exception() is not None:
+        return None
+    return future.result()
+
+
+def send_hotel_card(user: UserRequest, _id: int, data: Dict[str, str],
+                    photos: Optional[List[str]] = None) -> bool:
+    """
+    Sends a message with hotel info: media group if photos are passed else text message.
+    Text message notifies about photo issue if the user asked for photos.
+
+    :param user: user which will receive the message.
+    :type user: UserRequest
+    :param _id: hotel id.
+    :type _id: int
+    :param data: a dict with all hotel info.
+    :type data: Dict[str, str]
+    :param photos: urls of hotel photos.
+    :type photos: Optional[List[str]]
+    :return: True if the message was sent.
+    :rtype: bool
+    """
+
+    text, bot_photos = prepare_hotels_message_items(_id=_id,
+                                                    data=data,
+                                                    photos=photos)
+    if bot_photos:
+        try:
+            bot.send_media_group(chat_id=user.user_id,
+                                 media=bot_photos)
+            return True
+        except ApiTelegramException:
+            return False
+    elif user.need_photo:
+        text = bot_answers["search_and_res"]["show_hotels_info"]["photo_issue"] + text
+    bot.send_message(text=text,
+                     chat_id=user.user_id,
+                     parse_mode='MARKDOWN',
+                     disable_web_page_preview=True)
+    return True
+
+
+def upgrade_hotel_card(user_id: int, _id: int, data: Dict[str, str], card: Message, photos: Future) -> None:
+    """
+    Upgrades text message with hotel info in place when photos are got (is called when photos future is done).
+    Telegram can't turn text message into media group, so the message is edited to show the first photo
+    as link preview above hotel info and keeps its place among other hotels.
+    Adds notification about photo issue to the text message if photos weren't got.
+
+    :param user_id: id of user which received the message.
+    :type user_id: int
+    :param _id: hotel id.
+    :type _id: int
+    :param data: a dict with all hotel info.
+    :type data: Dict[str, str]
+    :param card: text message with hotel info.
+    :type card: Message
+    :param photos: future of get_hotel_photos call.
+    :type photos: Future
+    :return: None
+    """
+
+    text, _ = prepare_hotels_message_items(_id=_id, data=data)
+    urls = get_photos_result(photos)
+    try:
+        if urls:
+            bot.edit_message_text(text="[\u200b]({0}){1}".format(urls[0], text),
+                                  chat_id=user_id,
+                                  message_id=card.message_id,
+                                  parse_mode='MARKDOWN')
+            increment("search.cards_upgraded")
+        else:
+            bot.edit_message_text(text=bot_answers["search_and_res"]["show_hotels_info"]["photo_issue"] + text,
+                                  chat_id=user_id,
+                                  message_id=card.message_id,
+                                  parse_mode='MARKDOWN',
+                                  disable_web_page_preview=True)
+    except ApiTelegramException:
+        increment("search.cards_upgrade_failed")
+
+
+def send_hotels_messages(hotels: Dict[int, Dict[str, str]], user: UserRequest,
+                         started: Optional[float] = None, expected: Optional[int] = None) -> List[str]:
+    """
+    Sends messages with hotels info in order of hotels.
+    Photos of all hotels are requested in parallel, requests wait for rapidapi per second budget
+    up to photos_upgrade_timeout seconds. A hotel is sent with photos if they are got
+    within photos_wait_budget seconds, otherwise text message is sent at once and is upgraded
+    in place when photos are got (see upgrade_hotel_card). Upgrades are made by photos threads
+    after the function returns, so they don't hold the user's handler.
 
     :param hotels: dict with hotels info.
     :type hotels: Dict[int, Dict[str, str]]
     :param user: user which will receive the messages.
     :type user: UserRequest
+    :param started: monotonic time of search start to measure time to the first hotel.
+    :type started: Optional[float]
+    :param expected: number of hotels which should be found (user's hotel_count by default).
+    :type expected: Optional[int]
     :return: List of strings with hotels info (will be used to save search info to DB).
     :rtype: List[str]
     """
+    started = started or monotonic()
     message_counter = 0
     list_for_history_db = []
+    photos: Dict[int, Future] = dict()
+    if user.need_photo:
+        photos = {_id: photos_executor.submit(copy_context().run, get_hotel_photos,
+                                              hotel_id=_id, num_of_photo=user.need_photo,
+                                              quota_timeout=photos_upgrade_timeout)
+                  for _id in hotels}
+    deadline = monotonic() + photos_wait_budget
+
     for _id, data in hotels.items():
         list_for_history_db.append(f"{_id}***{hotels[_id]['Отель']}")
-        text, bot_photos = prepare_hotels_message_items(_id=_id,
-                                                        data=data,
-                                                        need_photo=user.need_photo)
-        if bot_photos:
-            try:
-                bot.send_media_group(chat_id=user.user_id,
-                                     media=bot_photos)
-                message_counter += 1
-                continue
-            except ApiTelegramException:
-                continue
-        elif not bot_photos and user.need_photo:
-            text = bot_answers["search_and_res"]["show_hotels_info"]["photo_issue"] + text
-        bot.send_message(text=text,
-                         chat_id=user.user_id,
-                         parse_mode='MARKDOWN',
-                         disable_web_page_preview=True)
+        if _id in photos:
+            wait([photos[_id]], timeout=max(0, deadline - monotonic()))
+        if _id in photos and not photos[_id].done():
+            text, _ = prepare_hotels_message_items(_id=_id, data=data)
+            card = bot.send_message(text=text,
+                                    chat_id=user.user_id,
+                                    parse_mode='MARKDOWN',
+                                    disable_web_page_preview=True)
+            photos[_id].add_done_callback(partial(upgrade_hotel_card, user.user_id, _id, data, card))
+        elif not send_hotel_card(user=user, _id=_id, data=data,
+                                 photos=get_photos_result(photos[_id]) if _id in photos else None):
+            continue
         message_counter += 1
-    if message_counter < int(user.hotel_count):
+        if message_counter == 1:
+            observe("search.time_to_first_hotel", monotonic() - started)
+
+    if message_counter < (expected or int(user.hotel_count)):
         text = bot_answers["search_and_res"]["show_hotels_info"]["less_than_required"].format(message_counter)
         bot.send_message(text=text,
                          chat_id=user.user_id,
@@ -457,26 +591,74 @@ def delete_room(user: UserRequest, room: int) -> None:
 def show_hotels_info(user: UserRequest) -> None:
     """
     Creates and sends the messages with hotels according to user's info.
+    If the user added locations to compare, hotels of all locations are searched concurrently
+    and sent in one ranking (see src.hotels_api.compare_hotels_dicts). Otherwise if the user chose
+    flexible dates, hotels are searched with shifted dates (see src.hotels_api.flex_hotels_dicts).
+    If hotels of one location are found the user can watch their prices (see src.price_watch).
+    The search is counted as completed in the funnel (see src.funnel).
 
     :param user: user which will receive the messages.
     :type user: UserRequest
     :return: None
     """
 
+    started = monotonic()
     querystring, adults, children = user.prepare_request_data()
-    hotels, min_distance = get_hotels_dict(**querystring,
-                                           adults=adults,
-                                           children=children,
-                                           command=user.command,
-                                           distance=user.distance)
+    destinations = {user.destination_id: user.location_name}
+    destinations.update(user.compare_destinations)
+    location = user.location_name
+    if len(destinations) > 1:
+        del querystring["destination_id"]
+        hotels, missing, stale = compare_hotels_dicts(destinations=destinations,
+                                                      timeout=COMPARISON["deadline"],
+                                                      **querystring,
+                                                      adults=adults,
+                                                      children=children,
+                                                      command=user.command,
+                                                      distance=user.distance)
+        min_distance = None
+        location = " / ".join(destinations.values())
+        text = bot_answers["search_and_res"]["show_hotels_info"]["comparison"].format(location)
+        if missing:
+            text += bot_answers["search_and_res"]["show_hotels_info"]["comparison_missing"].format(", ".join(missing))
+        bot.send_message(text=text,
+                         chat_id=user.user_id)
+    elif DATE_FLEX["enabled"] and user.date_flex:
+        hotels, min_distance, stale, missing = flex_hotels_dicts(flex_days=user.date_flex,
+                                                                 timeout=DATE_FLEX["deadline"],
+                                                                 **querystring,
+                                                                 adults=adults,
+                                                                 children=children,
+                                                                 command=user.command,
+                                                                 distance=user.distance)
+        text = bot_answers["search_and_res"]["show_hotels_info"]["date_flex"].format(user.date_flex)
+        if missing:
+            text += bot_answers["search_and_res"]["show_hotels_info"]["date_flex_missing"].format(
+                ", ".join(f"{check_in} — {check_out}" for check_in, check_out in missing))
+        bot.send_message(text=text,
+                         chat_id=user.user_id)
+    else:
+        hotels, min_distance, stale = get_hotels_dict(**querystring,
+                                                      adults=adults,
+                                                      children=children,
+                                                      command=user.command,
+                                                      distance=user.distance)
+    if stale:
+        bot.send_message(text=bot_answers["search_and_res"]["show_hotels_info"]["stale"],
+                         chat_id=user.user_id)
     if hotels:
-        list_for_db = send_hotels_messages(hotels=hotels, user=user)
+        list_for_db = send_hotels_messages(hotels=hotels, user=user, started=started,
+                                           expected=int(user.hotel_count))
         if list_for_db:
             push_to_db(telegram_id=user.user_id,
                        command=user.command,
                        date=datetime.now(),
                        hotel=list_for_db,
-                       location=user.location_name)
+                       location=location)
+        if PRICE_WATCH["enabled"] and len(destinations) == 1:
+            bot.send_message(text=price_watch_dict["offer"],
+                             chat_id=user.user_id,
+                             reply_markup=ScenarioKeyboards.watch_search(fingerprint=search_fingerprint(user)))
 
     else:
         text = bot_answers["search_and_res"]["show_hotels_info"]["not_found"]
@@ -484,6 +666,8 @@ def show_hotels_info(user: UserRequest) -> None:
             text += bot_answers["search_and_res"]["show_hotels_info"]["nearest_hotel"].format(min_distance)
         bot.send_message(text=text,
                          chat_id=user.user_id)
+    finish_search(user=user, completed=True)
+    update_user_state(user=user)
 
 
 def send_history(user: UserRequest) -> None:
@@ -507,3 +691,24 @@ def send_history(user: UserRequest) -> None:
                          chat_id=user.user_id)
 
 
+def send_watch_list(user: UserRequest) -> None:
+    """
+    Sends searches watched by user, every search with a button to stop watching it.
+
+    :param user: the user to send the searches
+    :type user: UserRequest
+    :return: None
+    """
+
+    watches = get_user_watches(telegram_id=user.user_id)
+    if not watches:
+        bot.send_message(text=price_watch_dict["empty"],
+                         chat_id=user.user_id)
+    for job_id, location, params in watches:
+        params = loads(params)
+        bot.send_message(text=price_watch_dict["item"].format(location=location,
+                                                              command=params["command"],
+                                                              check_in=params["check_in"],
+                                                              check_out=params["check_out"]),
+                         chat_id=user.user_id,
+                         reply_markup=ScenarioKeyboards.unwatch(job_id=job_id))
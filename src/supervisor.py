@@ -0,0 +1,408 @@
+"""
+Supervisor mode: several worker processes of the bot on one host (see SHARDING in bot_settings).
+The supervisor polls updates from Telegram and routes them to workers by hash of user id,
+so all updates of a user are handled by the same worker one by one. Workers share the user
+states storage (sqlite or redis), history DB, the last rapidapi responses cache (SQLite file)
+and one per second rapidapi token bucket (shared memory). Workers report their health
+to the supervisor, dead workers are restarted.
+
+Usage:
+    python -m src.supervisor --workers 4
+"""
+
+from multiprocessing import get_context
+from queue import Empty, Full
+from threading import Thread, Event
+from time import monotonic, sleep
+from typing import Dict, Any, Optional, Callable, List
+from urllib.parse import urlparse, parse_qs, urlencode
+from src.metrics import set_gauge, increment
+from src.metrics_sinks import start_sinks
+from bot_settings import bot, SHARDING, STATE_BACKEND, METRICS_SINKS, LIFECYCLE
+import argparse
+import logging
+import os
+import signal
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+log_format = "%(asctime)s %(processName)s %(name)s %(levelname)s %(message)s"
+poll_timeout = 20
+queue_size = 1000
+route_timeout = 5
+stop_timeout = LIFECYCLE["drain_timeout"] + 10
+
+
+def update_user_id(update: Dict[str, Any]) -> int:
+    """
+    Finds id of user who sent the update (message, callback query, inline query etc.).
+
+    :param update: update from getUpdates as dict.
+    :type update: Dict[str, Any]
+    :return: id of user (0 if update has no user).
+    :rtype: int
+    """
+
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+    return 0
+
+
+def shard(user_id: int, workers: int) -> int:
+    """
+    Returns index of worker handling updates of the user.
+
+    :param user_id: id of user.
+    :type user_id: int
+    :param workers: number of workers.
+    :type workers: int
+    :return: index of worker.
+    :rtype: int
+    """
+
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+def worker_path(path: str, index: int) -> str:
+    """
+    Adds index of worker to file name (traces.jsonl -> traces.1.jsonl).
+
+    :param path: path to file.
+    :type path: str
+    :param index: index of worker.
+    :type index: int
+    :return: path to file of the worker.
+    :rtype: str
+    """
+
+    base, extension = os.path.splitext(path)
+    return f"{base}.{index}{extension}"
+
+
+def worker_sinks(sinks_urls: str, index: int) -> str:
+    """
+    Creates urls of metrics exporters of the worker: Prometheus port is shifted by index + 1,
+    index of worker is added to StatsD prefix (gauges of workers don't overwrite each other).
+
+    :param sinks_urls: comma separated urls of exporters (see src.metrics_sinks.create_sink).
+    :type sinks_urls: str
+    :param index: index of worker.
+    :type index: int
+    :return: comma separated urls of the worker's exporters.
+    :rtype: str
+    """
+
+    result = []
+    for sink_url in filter(None, (sink_url.strip() for sink_url in sinks_urls.split(","))):
+        parsed = urlparse(sink_url)
+        if parsed.scheme == "prometheus":
+            sink_url = f"prometheus://{parsed.hostname or '0.0.0.0'}:{(parsed.port or 9100) + index + 1}"
+        elif parsed.scheme == "statsd":
+            params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+            params["prefix"] = f"{params.get('prefix', 'hotels_bot')}.worker{index}"
+            sink_url = parsed._replace(query=urlencode(params)).geturl()
+        result.append(sink_url)
+    return ",".join(result)
+
+
+def run_worker(index: int, updates, health, health_interval: float, supervisor_pid: int, bucket_state,
+               initializer: Optional[Callable[[], None]] = None) -> None:
+    """
+    Main function of worker process: imports bot handlers and handles updates from its queue until None is got
+    (or the supervisor is dead), then shuts down gracefully (see src.lifecycle).
+    SIGTERM and SIGINT are ignored, shutdown is controlled by the supervisor.
+
+    :param index: index of worker.
+    :type index: int
+    :param updates: queue of updates (dicts from getUpdates).
+    :param health: queue of health reports.
+    :param health_interval: time between health reports in seconds.
+    :type health_interval: float
+    :param supervisor_pid: pid of supervisor process.
+    :type supervisor_pid: int
+    :param bucket_state: shared state of per second token bucket of rapidapi requests (see SharedTokenBucket).
+    :param initializer: function called before bot modules are imported (e.g. to change settings).
+    :type initializer: Optional[Callable[[], None]]
+    :return: None
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=log_format)
+    if initializer:
+        initializer()
+
+    import bot_settings
+    if bot_settings.LIFECYCLE["snapshot"]:
+        bot_settings.LIFECYCLE["snapshot"] = worker_path(bot_settings.LIFECYCLE["snapshot"], index)
+    if bot_settings.TRACING["exporter"].startswith("json:"):
+        bot_settings.TRACING["exporter"] = worker_path(bot_settings.TRACING["exporter"], index)
+
+    from telebot.types import Update
+    import main  # noqa: F401
+    from src.bootstrap import bootstrap
+    from src.cache import SharedStore
+    from src.hotels_api import last_responses, quota
+    from src.quota import SharedTokenBucket
+    from src import lifecycle
+
+    quota.bucket = SharedTokenBucket(rate=quota.bucket.rate, capacity=quota.bucket.capacity, state=bucket_state)
+    if SHARDING["shared_cache"]:
+        last_responses.shared = SharedStore(path=SHARDING["shared_cache"], maxsize=last_responses.maxsize)
+    bootstrap(signals=False, sweeper=index == 0, price_watch=index == 0,
+              metrics_sinks=worker_sinks(bot_settings.METRICS_SINKS, index))
+
+    handled = 0
+    stopped = Event()
+
+    def report_health() -> None:
+        while not stopped.wait(health_interval):
+            times = os.times()
+            health.put({"worker": index,
+                        "pid": os.getpid(),
+                        "handled": handled,
+                        "in_flight": lifecycle.in_flight,
+                        "queued": bot_settings.bot.worker_pool.tasks.qsize() if bot_settings.bot.worker_pool else 0,
+                        "cpu_sec": round(times.user + times.system, 2)})
+
+    Thread(target=report_health, name="health_reporter", daemon=True).start()
+    while True:
+        try:
+            raw_update = updates.get(timeout=1)
+        except Empty:
+            if os.getppid() != supervisor_pid:
+                logger.error("worker %s: supervisor is dead, stopping", index)
+                break
+            continue
+        if raw_update is None:
+            break
+        bot_settings.bot.process_new_updates([Update.de_json(raw_update)])
+        handled += 1
+    stopped.set()
+    lifecycle.shutdown()
+
+
+class Worker:
+    """
+    Worker process of the supervisor.
+
+    Args:
+        :index (int):   index of worker.
+        :updates (Queue):   queue of updates routed to the worker.
+        :process (Optional[Process]):   running process.
+        :health (Dict[str, Any]):   the last health report of the worker.
+        :reported (float):   time of the last health report (monotonic).
+        :restarts (int):   number of restarts of dead process.
+    """
+
+    def __init__(self, index: int, updates):
+        self.index: int = index
+        self.updates = updates
+        self.process = None
+        self.health: Dict[str, Any] = dict()
+        self.reported: float = monotonic()
+        self.restarts: int = 0
+
+
+class Supervisor:
+    """
+    Polls updates from Telegram and routes them to worker processes by hash of user id.
+
+    Args:
+        :workers (List[Worker]):   worker processes.
+        :health_interval (float):   time between health reports of workers in seconds.
+        :initializer (Optional[Callable[[], None]]):   function called in worker process before
+            bot modules are imported (must be picklable).
+        :offset (Optional[int]):   id of the next update to get.
+        :stop_event (Event):   is set when the supervisor is stopping.
+        :bucket_state (Array):   shared state of per second token bucket of workers.
+    """
+
+    def __init__(self, workers: int, health_interval: float = 10,
+                 initializer: Optional[Callable[[], None]] = None):
+        if workers > 1 and STATE_BACKEND.startswith("vedis:"):
+            raise ValueError("Vedis storage can be used by single process only, use sqlite or redis STATE_BACKEND")
+        self.context = get_context("spawn")
+        self.health_queue = self.context.Queue()
+        self.workers: List[Worker] = [Worker(index=index, updates=self.context.Queue(maxsize=queue_size))
+                                      for index in range(workers)]
+        self.health_interval: float = health_interval
+        self.initializer: Optional[Callable[[], None]] = initializer
+        self.offset: Optional[int] = None
+        self.stop_event: Event = Event()
+        self.bucket_state = self.context.Array("d", 2)
+
+    def start_worker(self, worker: Worker) -> None:
+        """
+        Starts process of the worker.
+
+        :param worker: worker to start.
+        :type worker: Worker
+        :return: None
+        """
+
+        worker.process = self.context.Process(target=run_worker, name=f"bot_worker_{worker.index}",
+                                              args=(worker.index, worker.updates, self.health_queue,
+                                                    self.health_interval, os.getpid(), self.bucket_state,
+                                                    self.initializer))
+        worker.process.start()
+        worker.reported = monotonic()
+
+    def route(self, raw_updates: List[Dict[str, Any]]) -> None:
+        """
+        Puts updates to queues of workers. Waits up to route_timeout seconds if a queue is full,
+        then the update is dropped (the worker is stuck, it will be restarted if it's dead).
+
+        :param raw_updates: updates from getUpdates.
+        :type raw_updates: List[Dict[str, Any]]
+        :return: None
+        """
+
+        for raw_update in raw_updates:
+            worker = self.workers[shard(update_user_id(raw_update), len(self.workers))]
+            try:
+                worker.updates.put(raw_update, timeout=route_timeout)
+            except Full:
+                logger.error("queue of worker %s is full, update %s is dropped", worker.index, raw_update["update_id"])
+                increment(f"worker.dropped_updates.{worker.index}")
+            self.offset = raw_update["update_id"] + 1
+
+    def poll(self) -> None:
+        """
+        Gets updates from Telegram with long polling until the supervisor is stopped.
+
+        :return: None
+        """
+
+        from telebot import apihelper
+
+        while not self.stop_event.is_set():
+            try:
+                raw_updates = apihelper.get_updates(bot.token, offset=self.offset, timeout=poll_timeout + 10,
+                                                    long_polling_timeout=poll_timeout)
+            except Exception:
+                logger.exception("getUpdates failed")
+                sleep(3)
+                continue
+            self.route(raw_updates)
+
+    def check_health(self) -> None:
+        """
+        Reads health reports, restarts dead workers and publishes worker.* gauges.
+        Restarted worker gets new queue (the dead process may hold the lock of the old one),
+        updates routed to the dead worker are lost.
+
+        :return: None
+        """
+
+        while True:
+            try:
+                report = self.health_queue.get_nowait()
+            except Empty:
+                break
+            worker = self.workers[report["worker"]]
+            worker.health, worker.reported = report, monotonic()
+
+        for worker in self.workers:
+            if not worker.process.is_alive() and not self.stop_event.is_set():
+                logger.error("worker %s (pid %s) exited with code %s, restarting",
+                             worker.index, worker.process.pid, worker.process.exitcode)
+                worker.restarts += 1
+                worker.updates = self.context.Queue(maxsize=queue_size)
+                self.start_worker(worker)
+            silence = monotonic() - worker.reported
+            if silence > 3 * self.health_interval:
+                logger.warning("worker %s hasn't reported health for %.0f s", worker.index, silence)
+            for name in ("handled", "in_flight", "queued", "cpu_sec"):
+                set_gauge(f"worker.{name}.{worker.index}", worker.health.get(name, 0))
+            set_gauge(f"worker.restarts.{worker.index}", worker.restarts)
+            set_gauge(f"worker.silence_sec.{worker.index}", round(silence, 1))
+        logger.info("workers: %s", "; ".join(
+            f"{worker.index}: handled {worker.health.get('handled', 0)}, in flight {worker.health.get('in_flight', 0)}"
+            for worker in self.workers))
+
+    def monitor(self) -> None:
+        """
+        Checks health of workers every health_interval seconds until the supervisor is stopped.
+
+        :return: None
+        """
+
+        while not self.stop_event.wait(self.health_interval):
+            try:
+                self.check_health()
+            except Exception:
+                logger.exception("health check failed")
+
+    def request_stop(self, signum: int, frame) -> None:
+        """
+        Handler of SIGTERM and SIGINT: stops polling after the current getUpdates request.
+
+        :param signum: number of signal.
+        :type signum: int
+        :param frame: current stack frame.
+        :return: None
+        """
+
+        logger.info("signal %s received, stopping supervisor", signal.Signals(signum).name)
+        self.stop_event.set()
+
+    def stop(self) -> None:
+        """
+        Stops workers: every worker handles routed updates and shuts down gracefully.
+        Workers which aren't stopped within stop_timeout seconds are terminated.
+
+        :return: None
+        """
+
+        self.stop_event.set()
+        for worker in self.workers:
+            try:
+                worker.updates.put(None, timeout=stop_timeout)
+            except Full:
+                logger.error("worker %s doesn't take updates", worker.index)
+        deadline = monotonic() + stop_timeout
+        for worker in self.workers:
+            worker.process.join(timeout=max(0.0, deadline - monotonic()))
+            if worker.process.is_alive():
+                logger.error("worker %s isn't stopped in %s s, terminating", worker.index, stop_timeout)
+                worker.process.terminate()
+
+    def run(self, metrics_sinks: str = METRICS_SINKS, signals: bool = True) -> None:
+        """
+        Starts workers and polls updates until SIGTERM or SIGINT, then stops workers.
+
+        :param metrics_sinks: urls of the supervisor's metrics exporters (see src.metrics_sinks.start_sinks).
+        :type metrics_sinks: str
+        :param signals: True to set SIGTERM and SIGINT handlers (must be called from main thread).
+        :type signals: bool
+        :return: None
+        """
+
+        if signals:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, self.request_stop)
+        sinks = start_sinks(metrics_sinks)
+        for worker in self.workers:
+            self.start_worker(worker)
+        Thread(target=self.monitor, name="workers_monitor", daemon=True).start()
+        try:
+            self.poll()
+        finally:
+            self.stop()
+            for sink in sinks:
+                sink.stop()
+        logger.info("supervisor is stopped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the bot in several worker processes")
+    parser.add_argument("--workers", type=int, default=SHARDING["workers"])
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=log_format)
+    Supervisor(workers=options.workers, health_interval=SHARDING["health_interval"]).run()
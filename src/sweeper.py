@@ -0,0 +1,122 @@
+"""
+Background sweeping of expired data and idle sessions in user states DB.
+"""
+
+from threading import Thread, Event
+from time import time
+from typing import Tuple
+from src.base import UserRequest
+from src.metrics import set_gauge, increment
+from src.funnel import finish_search
+from db.userstates_db import get_expired_next_steps, update_user_state, \
+    get_idle_users, remove_user_state_from_db, get_store_size, unit_of_work
+from db.state_backends import StateConflictError
+import logging
+
+logger = logging.getLogger(__name__)
+
+sweep_interval = 60
+session_idle_ttl = 60 * 60 * 24
+session_expire_ttl = 60 * 60 * 24 * 30
+
+
+def sweep_expired_next_steps() -> int:
+    """
+    Clears expired next steps expectations of all users.
+    Users whose states were changed by bot while sweeping are skipped.
+
+    :return: number of cleared expectations.
+    :rtype: int
+    """
+
+    cleared = 0
+    for user_id in get_expired_next_steps(timestamp=time()):
+        try:
+            with unit_of_work():
+                user = UserRequest.get_user(user_id=user_id)
+                user.pop_expected_step()
+                update_user_state(user=user, touch=False)
+        except StateConflictError:
+            continue
+        cleared += 1
+    return cleared
+
+
+def sweep_idle_sessions() -> Tuple[int, int]:
+    """
+    Compacts sessions which weren't touched for session_idle_ttl seconds
+    (see UserRequest.compact) and removes compacted sessions which weren't
+    touched for session_expire_ttl seconds. Unfinished searches of compacted sessions
+    are counted as abandoned (see src.funnel).
+    Users whose states were changed by bot while sweeping are skipped.
+
+    :return: numbers of compacted and removed sessions.
+    :rtype: Tuple[int, int]
+    """
+
+    now = time()
+    compacted = 0
+    for user_id in get_idle_users(timestamp=now - session_idle_ttl):
+        try:
+            with unit_of_work():
+                user = UserRequest.get_user(user_id=user_id)
+                finish_search(user=user, completed=False)
+                update_user_state(user=user.compact(), touch=False, compacted=True)
+        except StateConflictError:
+            continue
+        compacted += 1
+
+    expired = get_idle_users(timestamp=now - session_expire_ttl, compacted=True)
+    for user_id in expired:
+        remove_user_state_from_db(user_id=user_id)
+
+    increment("user_states.compacted", compacted)
+    increment("user_states.expired", len(expired))
+    return compacted, len(expired)
+
+
+def measure_store_size() -> None:
+    """
+    Updates gauges of user states DB size.
+
+    :return: None
+    """
+
+    for name, value in get_store_size().items():
+        set_gauge(f"user_states.{name}", value)
+
+
+def sweep(stop_event: Event, interval: int) -> None:
+    """
+    Sweeps user states DB every `interval` seconds until stop_event is set.
+    Errors of one sweep (e.g. DB is unavailable) are logged, the next sweep is made as usual.
+
+    :param stop_event: event to stop sweeping.
+    :type stop_event: Event
+    :param interval: time between sweeps in seconds.
+    :type interval: int
+    :return: None
+    """
+
+    while not stop_event.wait(interval):
+        try:
+            sweep_expired_next_steps()
+            sweep_idle_sessions()
+            measure_store_size()
+        except Exception:
+            logger.exception("user states sweep failed")
+
+
+def start_sweeper(interval: int = sweep_interval) -> Event:
+    """
+    Starts sweeping of user states DB in daemon thread.
+
+    :param interval: time between sweeps in seconds.
+    :type interval: int
+    :return: event to stop sweeping.
+    :rtype: Event
+    """
+
+    stop_event = Event()
+    Thread(target=sweep, args=(stop_event, interval), name="states_sweeper", daemon=True).start()
+    return stop_event
@@ -0,0 +1,415 @@
+"""
+Lightweight tracing of updates handling (see TRACING in bot_settings).
+A root span is opened for every incoming update (see update_context), child spans are opened
+for requests to rapidapi, user states reads and writes, history DB queries and Telegram Bot API calls.
+Finished traces are exported to json lines file or to OTLP/HTTP collector.
+
+Slowest saved traces as trees of spans:
+    python -m src.tracing --slowest 5
+    python -m src.tracing --trace 4bf92f3577b34da6a3ce929d0e0e4736
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from queue import Queue, Full
+from threading import Thread, Lock
+from time import time_ns, monotonic
+from typing import Dict, Any, Optional, List, Iterator
+from urllib.parse import urlparse
+from telebot import apihelper
+from bot_settings import TRACING
+import argparse
+import json
+import logging
+import os
+import random
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+service_name = "hotels_bot"
+max_spans = 1000
+
+current_span: ContextVar[Optional['Span']] = ContextVar("current_span", default=None)
+
+
+class Trace:
+    """
+    Spans of one trace.
+
+    Args:
+        :trace_id (str):   id of trace (32 hex digits).
+        :spans (List[Span]):   finished spans.
+        :exported (bool):   True if the root span is finished and trace is sent to exporter.
+            Spans finished later (in background tasks) are dropped.
+    """
+
+    def __init__(self):
+        self.trace_id: str = os.urandom(16).hex()
+        self.spans: List['Span'] = []
+        self.exported: bool = False
+        self.lock = Lock()
+
+
+class Span:
+    """
+    Timed operation of the trace.
+
+    Args:
+        :name (str):   name of operation.
+        :trace (Trace):   trace of the span.
+        :span_id (str):   id of span (16 hex digits).
+        :parent_id (Optional[str]):   id of parent span (None for root span).
+        :start (int):   start time in nanoseconds since epoch.
+        :end (Optional[int]):   end time in nanoseconds since epoch.
+        :attributes (Dict[str, Any]):   attributes of operation.
+        :error (Optional[str]):   error which finished the operation.
+    """
+
+    def __init__(self, name: str, trace: Trace, parent_id: Optional[str] = None, **attributes: Any):
+        self.name: str = name
+        self.trace: Trace = trace
+        self.span_id: str = os.urandom(8).hex()
+        self.parent_id: Optional[str] = parent_id
+        self.start: int = time_ns()
+        self.end: Optional[int] = None
+        self.attributes: Dict[str, Any] = attributes
+        self.error: Optional[str] = None
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        Finishes the span. Exports the trace if the span is root.
+
+        :param error: exception which finished the operation.
+        :type error: Optional[BaseException]
+        :return: None
+        """
+
+        self.end = time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        with self.trace.lock:
+            if self.trace.exported or len(self.trace.spans) >= max_spans:
+                return
+            self.trace.spans.append(self)
+            if self.parent_id is None:
+                self.trace.exported = True
+                try:
+                    export_queue.put_nowait(self.trace)
+                except Full:
+                    logger.warning("trace %s is dropped, export queue is full", self.trace.trace_id)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Returns span as dict for json export.
+
+        :return: dict with span's data.
+        :rtype: Dict[str, Any]
+        """
+
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) / 10 ** 6, 3),
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+def start_span(name: str, **attributes: Any) -> Optional[Span]:
+    """
+    Creates child span of current span without making it current (for leaf operations
+    which start and finish in different callbacks). Returns None if there is no current trace.
+
+    :param name: name of operation.
+    :type name: str
+    :param attributes: attributes of operation.
+    :return: started span.
+    :rtype: Optional[Span]
+    """
+
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(name, trace=parent.trace, parent_id=parent.span_id, **attributes)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Context manager for child span of current span. Does nothing if there is no current trace.
+
+    :param name: name of operation.
+    :type name: str
+    :param attributes: attributes of operation.
+    :return: started span (None if there is no current trace).
+    :rtype: Iterator[Optional[Span]]
+    """
+
+    current = start_span(name, **attributes)
+    if current is None:
+        yield None
+        return
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as error:
+        current.finish(error=error)
+        raise
+    else:
+        current.finish()
+    finally:
+        current_span.reset(token)
+
+
+@contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Context manager for root span of new trace. TRACING["sample_rate"] fraction of traces is recorded.
+
+    :param name: name of operation.
+    :type name: str
+    :param attributes: attributes of operation.
+    :return: root span (None if trace isn't recorded).
+    :rtype: Iterator[Optional[Span]]
+    """
+
+    if not TRACING["enabled"] or random.random() >= TRACING["sample_rate"]:
+        yield None
+        return
+    root = Span(name, trace=Trace(), **attributes)
+    token = current_span.set(root)
+    try:
+        yield root
+    except BaseException as error:
+        root.finish(error=error)
+        raise
+    else:
+        root.finish()
+    finally:
+        current_span.reset(token)
+
+
+def send_telegram_request(method: str, url: str, **kwargs: Any) -> requests.Response:
+    """
+    Sends request to Telegram Bot API in span telegram.{method} (see apihelper.CUSTOM_REQUEST_SENDER).
+
+    :param method: http method.
+    :type method: str
+    :param url: url of Bot API method.
+    :type url: str
+    :param kwargs: params, files, timeout and proxies of request.
+    :return: response.
+    :rtype: requests.Response
+    """
+
+    with span(f"telegram.{url.rsplit('/', 1)[-1]}") as current:
+        response = apihelper._get_req_session().request(method, url, **kwargs)
+        if current:
+            current.attributes["http.status_code"] = response.status_code
+        return response
+
+
+class JSONExporter:
+    """
+    Writes every trace as json line to file. The file is rotated (to path.1) when its size
+    exceeds max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 ** 2):
+        self.path: str = path
+        self.max_bytes: int = max_bytes
+
+    def export(self, finished: Trace) -> None:
+        spans = sorted(finished.spans, key=lambda item: item.start)
+        root = next(item for item in spans if item.parent_id is None)
+        line = json.dumps({"trace_id": finished.trace_id,
+                           "name": root.name,
+                           "start": root.start,
+                           "duration_ms": root.to_dict()["duration_ms"],
+                           "spans": [item.to_dict() for item in spans]}, ensure_ascii=False, default=str)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, f"{self.path}.1")
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
+
+class OTLPExporter:
+    """
+    Sends every trace to OTLP/HTTP collector (json encoding, /v1/traces).
+    """
+
+    def __init__(self, url: str):
+        self.url: str = url if urlparse(url).path not in ("", "/") else url.rstrip("/") + "/v1/traces"
+
+    @classmethod
+    def attributes(cls, attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Converts attributes to OTLP key-value list.
+
+        :param attributes: attributes of span.
+        :type attributes: Dict[str, Any]
+        :return: OTLP attributes.
+        :rtype: List[Dict[str, Any]]
+        """
+
+        result = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                result.append({"key": key, "value": {"boolValue": value}})
+            elif isinstance(value, int):
+                result.append({"key": key, "value": {"intValue": str(value)}})
+            elif isinstance(value, float):
+                result.append({"key": key, "value": {"doubleValue": value}})
+            else:
+                result.append({"key": key, "value": {"stringValue": str(value)}})
+        return result
+
+    def export(self, finished: Trace) -> None:
+        spans = []
+        for item in finished.spans:
+            otlp_span = {"traceId": finished.trace_id,
+                         "spanId": item.span_id,
+                         "name": item.name,
+                         "kind": 2 if item.parent_id is None else 3,
+                         "startTimeUnixNano": str(item.start),
+                         "endTimeUnixNano": str(item.end),
+                         "attributes": self.attributes(item.attributes),
+                         "status": {"code": 2, "message": item.error} if item.error else {"code": 1}}
+            if item.parent_id:
+                otlp_span["parentSpanId"] = item.parent_id
+            spans.append(otlp_span)
+        body = {"resourceSpans": [{
+            "resource": {"attributes": self.attributes({"service.name": service_name})},
+            "scopeSpans": [{"scope": {"name": service_name}, "spans": spans}]
+        }]}
+        requests.post(self.url, json=body, timeout=5)
+
+
+def create_exporter(exporter_url: str):
+    """
+    Creates exporter of traces by its url:
+        json:path/to/traces.jsonl
+        otlp://host:4318 (or http://host:4318/v1/traces)
+
+    :param exporter_url: url of exporter.
+    :type exporter_url: str
+    :return: exporter of traces.
+    :raise ValueError: if url scheme is unknown.
+    """
+
+    scheme, path = exporter_url.split(":", 1)
+    if scheme == "json":
+        return JSONExporter(path=path)
+    if scheme == "otlp":
+        return OTLPExporter(url="http:" + path)
+    if scheme in ("http", "https"):
+        return OTLPExporter(url=exporter_url)
+    raise ValueError(f"unknown traces exporter {exporter_url}")
+
+
+export_queue: Queue = Queue(maxsize=1000)
+
+
+def export_traces(exporter) -> None:
+    """
+    Exports finished traces from export_queue.
+
+    :param exporter: exporter of traces.
+    :return: None
+    """
+
+    while True:
+        finished = export_queue.get()
+        try:
+            exporter.export(finished)
+        except Exception:
+            logger.exception("trace %s isn't exported", finished.trace_id)
+        finally:
+            export_queue.task_done()
+
+
+def flush_traces(timeout: float) -> bool:
+    """
+    Waits until finished traces are exported (used on shutdown).
+
+    :param timeout: max waiting time in seconds.
+    :type timeout: float
+    :return: True if all traces were exported.
+    :rtype: bool
+    """
+
+    deadline = monotonic() + timeout
+    with export_queue.all_tasks_done:
+        while export_queue.unfinished_tasks:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            export_queue.all_tasks_done.wait(remaining)
+    return True
+
+
+def start_tracing() -> None:
+    """
+    Starts exporting of traces and tracing of Telegram Bot API calls if tracing is enabled.
+
+    :return: None
+    """
+
+    if not TRACING["enabled"]:
+        return
+    apihelper.CUSTOM_REQUEST_SENDER = send_telegram_request
+    exporter = create_exporter(TRACING["exporter"])
+    Thread(target=export_traces, args=(exporter,), name="traces_exporter", daemon=True).start()
+
+
+def print_trace(saved: Dict[str, Any]) -> None:
+    """
+    Prints saved trace as tree of spans with durations and offsets from the trace start.
+
+    :param saved: trace from json lines file.
+    :type saved: Dict[str, Any]
+    :return: None
+    """
+
+    children: Dict[Optional[str], List[Dict[str, Any]]] = dict()
+    for item in saved["spans"]:
+        children.setdefault(item["parent_id"], []).append(item)
+
+    print(f"trace {saved['trace_id']} {saved['name']} {saved['duration_ms']} ms")
+
+    def print_children(parent_id: Optional[str], depth: int) -> None:
+        for item in children.get(parent_id, []):
+            offset = (item["start"] - saved["start"]) / 10 ** 6
+            attributes = " ".join(f"{key}={value}" for key, value in item["attributes"].items())
+            error = f" ERROR {item['error']}" if item["error"] else ""
+            print(f"{offset:>9.1f} ms {item['duration_ms']:>9.1f} ms  {'  ' * depth}{item['name']} {attributes}{error}")
+            print_children(item["span_id"], depth + 1)
+
+    print_children(None, 0)
+    print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Shows saved traces as trees of spans")
+    default_file = TRACING["exporter"].split(":", 1)[1] if TRACING["exporter"].startswith("json:") else None
+    parser.add_argument("--file", default=default_file)
+    parser.add_argument("--slowest", type=int, default=5, help="number of the slowest traces to show")
+    parser.add_argument("--name", help="show only traces of the handler, e.g. go_to_searching")
+    parser.add_argument("--trace", help="id of trace to show")
+    options = parser.parse_args()
+
+    with open(options.file, encoding="utf-8") as traces_file:
+        saved_traces = [json.loads(saved_line) for saved_line in traces_file if saved_line.strip()]
+    if options.trace:
+        saved_traces = [saved for saved in saved_traces if saved["trace_id"] == options.trace]
+    if options.name:
+        saved_traces = [saved for saved in saved_traces if options.name in saved["name"]]
+    for saved in sorted(saved_traces, key=lambda item: item["duration_ms"], reverse=True)[:options.slowest]:
+        print_trace(saved)
@@ -0,0 +1,31 @@
+"""
+Tests run the bot with fake Telegram Bot API and fake hotels api (see loadtest) and temporary DBs.
+The bot is configured here, before test modules import bot modules.
+"""
+
+from tempfile import mkdtemp
+from typing import Iterator
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loadtest.fake_telegram_api import FakeTelegramServer  # noqa: E402
+from loadtest.fake_hotels_api import FakeHotelsServer  # noqa: E402
+from loadtest.virtual_users import configure_bot, start_bot  # noqa: E402
+import pytest  # noqa: E402
+
+data_dir = mkdtemp(prefix="hotels_bot_tests_")
+telegram_server = FakeTelegramServer().start()
+hotels_server = FakeHotelsServer(latency=0, jitter=0).start()
+configure_bot(api_url=telegram_server.api_url, hotels_url=hotels_server.url, data_dir=data_dir, bot_threads=2)
+
+
+@pytest.fixture(scope="session")
+def telegram() -> Iterator[FakeTelegramServer]:
+    """
+    Fake Telegram server with the bot polling it.
+    """
+
+    start_bot(telegram=telegram_server, hotels_url=hotels_server.url, data_dir=data_dir, bot_threads=2)
+    yield telegram_server
@@ -0,0 +1,18 @@
+from datetime import date, timedelta
+
+
+def test_compacted_user_reenters_calendars():
+    from src.base import UserRequest
+    from src.scenario_models import build_calendar, build_calendar_callback
+
+    user = UserRequest(4001)
+    user.check_in = date.today() + timedelta(days=3)
+    user.check_out = user.check_in + timedelta(days=2)
+    user = user.compact()
+
+    for _id, chosen in ((1, user.check_in), (2, user.check_out)):
+        calendar, step = build_calendar(user=user, _id=_id)
+        assert f"cbcal_{_id}_s_d_{chosen:%Y_%m_%d}" in calendar
+        result, key, step = build_calendar_callback(call_data=f"cbcal_{_id}_s_d_{chosen:%Y_%m_%d}",
+                                                    user=user, _id=_id)
+        assert result == chosen
@@ -0,0 +1,20 @@
+from loadtest.virtual_users import VirtualUser, LoadStats
+
+
+def test_comparison_is_refused_with_flexible_dates(telegram):
+    from src.bot_text import bot_answers
+
+    user = VirtualUser(telegram=telegram, user_id=1002, stats=LoadStats(), timeout=10)
+    user.act("command", user.say("/lowprice"), user.text(bot_answers["location"]["start"]))
+    hotels = user.set_location()
+    user.act("hotel_count", user.press((hotels[0][0], "h=1")), user.buttons("cbcal_1"))
+    user.pick_date(calendar_id=1, index=3, next_prefix="cbcal_2")
+    user.pick_date(calendar_id=2, index=1, next_prefix="my_a")
+    main, = telegram.wait_for(user.user_id, lambda chat: chat.buttons("main"), timeout=0)
+    user.act("edit_main", user.press(main), user.buttons("flex"))
+    user.act("flex", user.press((main[0], "flex")), user.buttons("flex"))
+
+    telegram.wait_for(user.user_id, user.snapshot, timeout=0)
+    telegram.push_callback(user.user_id, main[0], "compare")
+    answers = telegram.wait_for(user.user_id, lambda chat: chat.answers[user.answers:], timeout=10)
+    assert answers == [bot_answers["compare"]["date_flex"]]
@@ -0,0 +1,53 @@
+import pytest
+
+
+@pytest.fixture
+def fresh_db(monkeypatch):
+    """
+    History DB module as if DB wasn't initialized yet (the initialized DB is restored after the test).
+    """
+
+    from db import history_db
+
+    monkeypatch.setattr(history_db, "engine", None)
+    monkeypatch.setattr(history_db, "metadata", None)
+    monkeypatch.setattr(history_db, "session", None)
+    monkeypatch.setattr(history_db, "create_retry_delay", 0)
+    return history_db
+
+
+def failing_create_all(monkeypatch, failures: int) -> None:
+    """
+    Makes MetaData.create_all fail as if another process was creating the same tables.
+    """
+
+    from sqlalchemy import MetaData
+    from sqlalchemy.exc import OperationalError
+
+    create_all = MetaData.create_all
+    left = [failures]
+
+    def create(self, *args, **kwargs):
+        if left[0]:
+            left[0] -= 1
+            raise OperationalError("CREATE TABLE", None, Exception("table already exists"))
+        return create_all(self, *args, **kwargs)
+
+    monkeypatch.setattr(MetaData, "create_all", create)
+
+
+def test_creation_of_tables_is_retried(fresh_db, monkeypatch):
+    failing_create_all(monkeypatch, failures=fresh_db.create_attempts - 1)
+    assert fresh_db.get_session() is not None
+
+
+def test_db_is_initialized_again_after_failure(fresh_db, monkeypatch):
+    from sqlalchemy.exc import OperationalError
+
+    failing_create_all(monkeypatch, failures=fresh_db.create_attempts)
+    with pytest.raises(OperationalError):
+        fresh_db.init_db()
+    assert fresh_db.engine is None
+
+    assert fresh_db.get_session() is not None
+    assert fresh_db.get_from_db(telegram_id=5001) is not None
@@ -0,0 +1,68 @@
+import pytest
+
+
+def store_user(user_id: int, hotel_count: str = "1") -> None:
+    """
+    Writes user state to DB bypassing current unit of work (as another process would do).
+    """
+
+    from src.base import UserRequest
+    from db.userstates_db import _write_user_state
+
+    user = UserRequest(user_id)
+    user.hotel_count = hotel_count
+    _write_user_state(user=user, compacted=False)
+
+
+def test_flush_reports_version_conflict():
+    from db.userstates_db import unit_of_work, get_user_state_from_db, update_user_state
+    from db.state_backends import StateConflictError
+
+    store_user(3001)
+    with pytest.raises(StateConflictError):
+        with unit_of_work():
+            user = get_user_state_from_db(3001)
+            user.hotel_count = "5"
+            update_user_state(user)
+            store_user(3001, hotel_count="3")
+
+    assert get_user_state_from_db(3001).hotel_count == "3"
+
+
+def test_remove_is_discarded_when_unit_raises():
+    from db.userstates_db import unit_of_work, get_user_state_from_db, remove_user_state_from_db
+
+    store_user(3002)
+    with pytest.raises(RuntimeError):
+        with unit_of_work():
+            get_user_state_from_db(3002)
+            remove_user_state_from_db(3002)
+            assert get_user_state_from_db(3002) is False
+            raise RuntimeError("handler failed")
+
+    assert get_user_state_from_db(3002)
+
+
+def test_remove_is_applied_on_flush():
+    from db.userstates_db import unit_of_work, get_user_state_from_db, remove_user_state_from_db
+
+    store_user(3003)
+    with unit_of_work():
+        get_user_state_from_db(3003)
+        remove_user_state_from_db(3003)
+
+    assert get_user_state_from_db(3003) is False
+
+
+def test_remove_conflicts_with_newer_state():
+    from db.userstates_db import unit_of_work, get_user_state_from_db, remove_user_state_from_db
+    from db.state_backends import StateConflictError
+
+    store_user(3004)
+    with pytest.raises(StateConflictError):
+        with unit_of_work():
+            get_user_state_from_db(3004)
+            store_user(3004, hotel_count="2")
+            remove_user_state_from_db(3004)
+
+    assert get_user_state_from_db(3004).hotel_count == "2"
@@ -0,0 +1,23 @@
+from types import SimpleNamespace
+
+
+def test_nested_handler_joins_outer_context():
+    from src.auxiliary_functions import update_context
+    from src import lifecycle
+    from db.userstates_db import current_unit
+
+    seen = dict()
+
+    @update_context
+    def inner(update):
+        seen["inner"] = lifecycle.in_flight, current_unit.get()
+
+    @update_context
+    def outer(update):
+        seen["outer"] = lifecycle.in_flight, current_unit.get()
+        inner(update)
+
+    outer(SimpleNamespace(from_user=SimpleNamespace(id=2001)))
+    assert seen["inner"] == seen["outer"]
+    assert seen["outer"][0] == 1
+    assert lifecycle.in_flight == 0
@@ -0,0 +1,35 @@
+from threading import Thread, Event
+from loadtest.virtual_users import VirtualUser, LoadStats
+
+
+def test_user_lock_is_reentrant():
+    from db.userstates_db import user_lock
+
+    done = Event()
+
+    def nested() -> None:
+        with user_lock(1):
+            with user_lock(1):
+                done.set()
+
+    Thread(target=nested, daemon=True).start()
+    assert done.wait(timeout=2)
+
+
+def test_sixth_child_finishes_room(telegram):
+    from src.bot_text import bot_answers
+
+    user = VirtualUser(telegram=telegram, user_id=1001, stats=LoadStats(), timeout=10)
+    user.act("command", user.say("/lowprice"), user.text(bot_answers["location"]["start"]))
+    hotels = user.set_location()
+    user.act("hotel_count", user.press((hotels[0][0], "h=1")), user.buttons("cbcal_1"))
+    user.pick_date(calendar_id=1, index=3, next_prefix="cbcal_2")
+    user.pick_date(calendar_id=2, index=1, next_prefix="my_a")
+    adults = telegram.wait_for(user.user_id, lambda chat: chat.buttons("my_a"), timeout=0)
+    children = user.act("adults", user.press((adults[0][0], "my_a2,0")), user.buttons("+,0"))
+    ages = user.act("children", user.press(children[0]), user.buttons("ch_age="))
+    for _ in range(5):
+        ages = user.act("child_age", user.press((ages[0][0], "ch_age=5,0")), user.buttons("ch_age="))
+
+    # the sixth child closes the room: the handler calls define_ask_about_children itself
+    user.act("child_age", user.press((ages[0][0], "ch_age=5,0")), user.buttons("finish"))